@@ -5,7 +5,8 @@ import shutil
 import json
 import torch
 
-from utilsMMpose import detection_inference, pose_inference
+from utilsMMpose import detection_pose_inference, init_detection_pose_models
+from utilsPoseWorker import startPoseWorker
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,6 +20,7 @@ def checkCudaPyTorch():
         logging.info("No GPU detected. Exiting.")
         raise Exception("No GPU detected. Exiting.")
 
+data_dir = "/mmpose/data"
 video_path = "/mmpose/data/video_mmpose.mov"
 output_dir = "/mmpose/data/output_mmpose"
 
@@ -36,6 +38,25 @@ if os.path.isfile(video_path):
     os.remove(video_path)
 
 checkCudaPyTorch()
+# Models are loaded once and shared by all jobs.
+models = init_detection_pose_models(model_config_person, model_ckpt_person,
+                                    model_config_pose, model_ckpt_pose)
+
+def processJob(video_path, output_dir):
+    checkCudaPyTorch()
+    # Run human detection and pose detection in a single pass.
+    pklPath = os.path.join(output_dir, 'human.pkl')
+    videoOutPath = ''
+    detection_pose_inference(model_config_person, model_ckpt_person,
+                             model_config_pose, model_ckpt_pose,
+                             video_path, pklPath, videoOutPath,
+                             bbox_thr=bbox_thr, visualize=generateVideo,
+                             models=models)
+
+# Jobs submitted through the socket (see utilsPoseWorker).
+server = startPoseWorker(data_dir, 'mmpose', processJob)
+
+# Fixed file handshake, for clients without the socket.
 while True:    
     if not os.path.isfile(video_path):
         time.sleep(0.1)
@@ -48,26 +69,10 @@ while True:
     os.makedirs(output_dir)
     
     try:
-        checkCudaPyTorch()
-        # Run human detection.
-        pathModelCkptPerson = model_ckpt_person
-        bboxPath = os.path.join(output_dir, 'box.pkl')
-        full_model_config_person = model_config_person
-        detection_inference(full_model_config_person, pathModelCkptPerson,
-                            video_path, bboxPath)        
-        
-        # Run pose detection.     
-        pathModelCkptPose = model_ckpt_pose
-        pklPath = os.path.join(output_dir, 'human.pkl')
-        videoOutPath = ''
-        full_model_config_pose = model_config_pose
-        pose_inference(full_model_config_pose, pathModelCkptPose, 
-                       video_path, bboxPath, pklPath, videoOutPath, 
-                       bbox_thr=bbox_thr, visualize=generateVideo)
+        with server.jobSlots:
+            processJob(video_path, output_dir)
         if os.path.isfile(video_path):
             os.remove(video_path)
-        if os.path.isfile(bboxPath):
-            os.remove(bboxPath)
         
         logging.info("mmpose: Done. Cleaning up")
         
@@ -1,21 +1,30 @@
 import cv2
 import numpy as np
+import os
 import pickle
+from collections import OrderedDict
 
 
 from mmpose_constants import get_flip_pair_dict
-from mmpose_utils import _xyxy2xywh, _box2cs, frame_iter
+from mmpose_utils import _xyxy2xywh, _box2cs, open_video
 from torch.utils.data import Dataset
 
 
 class CustomVideoDataset(Dataset):
     """Create custom video dataset for top down inference
 
+    Frames are decoded on demand, sequentially, and only the last
+    max_cached_frames frames are kept in memory. Instances are ordered by
+    frame, so reading them in order (shuffle=False) decodes each frame once.
+    Reading an earlier frame that is not cached anymore restarts decoding from
+    the beginning of the video.
+
     Args:
         video_path (str): Path to video file
         bbox_path (str): Path to bounding box file
                          (expects format to be xyxy [left, top, right, bottom])
         pipeline (list[dict | callable]): A sequence of data transforms
+        max_cached_frames (int): Number of decoded frames kept in memory
     """
 
     def __init__(self,
@@ -23,12 +32,20 @@ class CustomVideoDataset(Dataset):
                  bbox_path,
                  bbox_threshold,
                  pipeline,
-                 config):
+                 config,
+                 max_cached_frames=8):
 
-        # load video
-        self.capture = cv2.VideoCapture(video_path)
-        assert self.capture.isOpened(), f'Failed to load video file {video_path}'
-        self.frames = np.stack([x for x in frame_iter(self.capture)])
+        # The video is opened on first access (see _get_frame), such that
+        # each dataloader worker process has its own capture.
+        self.video_path = video_path
+        capture = open_video(video_path)
+        assert capture.isOpened(), f'Failed to load video file {video_path}'
+        capture.release()
+        self.capture = None
+        self.capture_pid = None
+        self.next_frame = 0
+        self.max_cached_frames = max_cached_frames
+        self.frame_cache = OrderedDict()
 
         # load bbox
         self.bboxs = pickle.load(open(bbox_path, "rb"))
@@ -53,28 +70,81 @@ class CustomVideoDataset(Dataset):
     def __len__(self):
         return len(self.instance_to_frame)
 
+    def _get_frame(self, frame_num):
+        """Decoded frame frame_num of the video, from the cache if possible"""
+        if frame_num in self.frame_cache:
+            self.frame_cache.move_to_end(frame_num)
+            return self.frame_cache[frame_num]
+
+        if self.capture is None or self.capture_pid != os.getpid() or \
+                frame_num < self.next_frame:
+            if self.capture is not None and self.capture_pid == os.getpid():
+                self.capture.release()
+            self.capture = open_video(self.video_path)
+            self.capture_pid = os.getpid()
+            self.next_frame = 0
+
+        # Frames without instances are skipped without being retrieved.
+        while self.next_frame < frame_num:
+            if not self.capture.grab():
+                raise IndexError(f'Frame {frame_num} not in {self.video_path}')
+            self.next_frame += 1
+        ok, img = self.capture.read()
+        if not ok:
+            raise IndexError(f'Frame {frame_num} not in {self.video_path}')
+        self.next_frame += 1
+
+        self.frame_cache[frame_num] = img
+        if len(self.frame_cache) > self.max_cached_frames:
+            self.frame_cache.popitem(last=False)
+        return img
+
     def __getitem__(self, idx):
         frame_num, detection_num = self.instance_to_frame[idx]
-        num_joints = self.cfg.data_cfg['num_joints']
         bbox_xyxy = self.bboxs[frame_num][detection_num]['bbox']
-        bbox_xywh = _xyxy2xywh(bbox_xyxy)
-        center, scale = _box2cs(self.cfg, bbox_xywh)
-
-        # joints_3d and joints_3d_visalble are place holders
-        # but bbox in image file, image file is not used but we need bbox information later
-        data = {'img': self.frames[frame_num],
-                'image_file': bbox_xyxy,
-                'center': center,
-                'scale': scale,
-                'bbox_score': bbox_xywh[4] if len(bbox_xywh) == 5 else 1,
-                'bbox_id': 0,
-                'joints_3d': np.zeros((num_joints, 3)),
-                'joints_3d_visible': np.zeros((num_joints, 3)),
-                'rotation': 0,
-                'ann_info':{
-                    'image_size': np.array(self.cfg.data_cfg['image_size']),
-                    'num_joints': num_joints,
-                    'flip_pairs': self.flip_pairs
-        }}
+        data = make_pose_input(self.cfg, self._get_frame(frame_num),
+                               bbox_xyxy, self.flip_pairs)
         data = self.pipeline(data)
         return data
+
+    def __getstate__(self):
+        # Captures and cached frames are not shared with worker processes.
+        state = self.__dict__.copy()
+        state['capture'] = None
+        state['capture_pid'] = None
+        state['frame_cache'] = OrderedDict()
+        return state
+
+
+def make_pose_input(cfg, img, bbox_xyxy, flip_pairs):
+    """Top down pose model input for one detected person, before the test
+    pipeline
+
+    Args:
+        cfg (:obj:`mmcv.Config`): pose model config
+        img (np.ndarray): BGR frame
+        bbox_xyxy (np.ndarray): [left, top, right, bottom, score] of the person
+        flip_pairs (list): keypoint flip pairs of the dataset
+    Returns:
+        dict: input data
+    """
+    num_joints = cfg.data_cfg['num_joints']
+    bbox_xywh = _xyxy2xywh(bbox_xyxy)
+    center, scale = _box2cs(cfg, bbox_xywh)
+
+    # joints_3d and joints_3d_visalble are place holders
+    # but bbox in image file, image file is not used but we need bbox information later
+    return {'img': img,
+            'image_file': bbox_xyxy,
+            'center': center,
+            'scale': scale,
+            'bbox_score': bbox_xywh[4] if len(bbox_xywh) == 5 else 1,
+            'bbox_id': 0,
+            'joints_3d': np.zeros((num_joints, 3)),
+            'joints_3d_visible': np.zeros((num_joints, 3)),
+            'rotation': 0,
+            'ann_info':{
+                'image_size': np.array(cfg.data_cfg['image_size']),
+                'num_joints': num_joints,
+                'flip_pairs': flip_pairs
+    }}
@@ -1,6 +1,15 @@
 import cv2
 import numpy as np
 
+def open_video(video_path):
+    """Open the video with its frames in their display orientation (rotation
+    metadata applied, if supported by OpenCV)"""
+    capture = cv2.VideoCapture(video_path)
+    if hasattr(cv2, 'CAP_PROP_ORIENTATION_AUTO'):
+        capture.set(cv2.CAP_PROP_ORIENTATION_AUTO, 1)
+    return capture
+
+
 def frame_iter(capture):
     while capture.grab():
         yield capture.retrieve()[1]
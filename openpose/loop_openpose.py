@@ -6,6 +6,8 @@ import ffmpeg
 import json
 import subprocess
 
+from utilsPoseWorker import startPoseWorker
+
 logging.basicConfig(level=logging.INFO)
 
 #%%
@@ -76,6 +78,7 @@ def getResolutionCommand(resolutionPoseDetection, horizontal):
 
 logging.info("Waiting for data...")
 
+data_dir = "/openpose/data"
 video_path = "/openpose/data/video_openpose.mov"
 output_dir = "/openpose/data/output_openpose"
 
@@ -87,6 +90,23 @@ resolutionPoseDetection = defaultOpenCapSettings['openpose']
 if os.path.isfile(video_path):
     os.remove(video_path)
 
+def processJob(video_path, output_dir):
+    horizontal = getVideoOrientation(video_path)
+    cmd_hr = getResolutionCommand(resolutionPoseDetection, horizontal)
+
+    check_cuda_device()
+    command = "/openpose/build/examples/openpose/openpose.bin\
+        --video {video_path}\
+        --display 0\
+        --write_json {output_dir}\
+        --render_pose 0{cmd_hr}".format(video_path=video_path, output_dir=output_dir, cmd_hr=cmd_hr)
+    if os.system(command) != 0:
+        raise Exception("OpenPose failed on {}.".format(video_path))
+
+# Jobs submitted through the socket (see utilsPoseWorker).
+server = startPoseWorker(data_dir, 'openpose', processJob)
+
+# Fixed file handshake, for clients without the socket.
 while True:    
     if not os.path.isfile(video_path):
         time.sleep(0.1)
@@ -97,18 +117,10 @@ while True:
     if os.path.isdir(output_dir):
         shutil.rmtree(output_dir)
     os.makedirs(output_dir)
-    
-    horizontal = getVideoOrientation(video_path)
-    cmd_hr = getResolutionCommand(resolutionPoseDetection, horizontal)
 
     try: 
-        check_cuda_device()
-        command = "/openpose/build/examples/openpose/openpose.bin\
-            --video {video_path}\
-            --display 0\
-            --write_json {output_dir}\
-            --render_pose 0{cmd_hr}".format(video_path=video_path, output_dir=output_dir, cmd_hr=cmd_hr)
-        os.system(command)
+        with server.jobSlots:
+            processJob(video_path, output_dir)
 
         logging.info("openpose: Done. Cleaning up")
         os.remove(video_path)
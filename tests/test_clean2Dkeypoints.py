@@ -0,0 +1,195 @@
+import time
+
+import numpy as np
+from scipy.interpolate import pchip_interpolate
+
+from utils import getOpenPoseMarkerNames, getOpenPoseFaceMarkers
+from utilsChecker import clean2Dkeypoints
+
+
+# %% Reference (per-marker loop) implementation of clean2Dkeypoints.
+def clean2Dkeypoints_loop(key2D, confidence, confidenceThreshold=0.5, nCams=2, 
+                     linearInterp=False):
+    
+    key2D_out = np.copy(key2D)
+    confidence_out = np.copy(confidence)
+    confidence_sync_out = np.copy(confidence)
+    
+    nMkrs = key2D_out.shape[0]    
+    markerNames = getOpenPoseMarkerNames()
+    
+    # Turn all 0s into nans.
+    key2D_out[key2D_out==0] = np.nan    
+    
+    # Turn low confidence values to 0s if >2 cameras and nans otherwise.
+    for i in range(nMkrs):        
+        # If a marker has at least two frames with positive confidence,
+        # then identify frames where confidence is lower than threshold.
+        if len(np.argwhere(confidence_out[i,:]>0))>2:
+            nanInds = np.where(confidence_out[i,:] < confidenceThreshold)
+        # If a marker doesn't have two frames with positive confidence,
+        # then return empty list.    
+        else:
+            nanInds = []
+            faceMarkers = getOpenPoseFaceMarkers()[0]
+            # no warning if face marker
+            if not markerNames[i] in faceMarkers:
+                print('There were <2 frames with >0 confidence for {}'.format(
+                    markerNames[i]))
+        # Turn low confidence values to 0s if >2 cameras.
+        # Frames with confidence values of 0s are ignored during triangulation.
+        if nCams>2:
+            confidence_out[i,nanInds] = 0
+        # Turn low confidence values to nans if 2 cameras.
+        # Frames with nan confidence values are splined, and nan confidences
+        # are replaced by 0.5 during triangulation.
+        else:
+            confidence_out[i,nanInds] = np.nan            
+        # Turn inleading and exiting nans into 0s
+        idx_nonnans = ~np.isnan(confidence_out[i,:])
+        idx_nonzeros  = confidence_out[i,:] != 0            
+        idx_nonnanszeros = idx_nonnans & idx_nonzeros
+        if True in idx_nonnanszeros:
+            idx_nonnanszeros_first = np.where(idx_nonnanszeros)[0][0]
+            idx_nonnanszeros_last = np.where(idx_nonnanszeros)[0][-1]
+            confidence_out[i,:idx_nonnanszeros_first] = 0
+            confidence_out[i,idx_nonnanszeros_last:] = 0 
+        else:
+            confidence_out[i,:] = 0                    
+            
+        # Turn low confidence values to 0s for confidence_sync_out whatever
+        # the number of cameras; confidence_sync_out is used for 
+        # calculating the reprojection error, and using nans rather than 
+        # 0s might affect the outcome.
+        confidence_sync_out[i,nanInds] = 0
+        # Turn inleading and exiting nans into 0s
+        idx_nonnans = ~np.isnan(confidence_sync_out[i,:])
+        idx_nonzeros  = confidence_sync_out[i,:] != 0            
+        idx_nonnanszeros = idx_nonnans & idx_nonzeros
+        if True in idx_nonnanszeros:
+            idx_nonnanszeros_first = np.where(idx_nonnanszeros)[0][0]
+            idx_nonnanszeros_last = np.where(idx_nonnanszeros)[0][-1]
+            confidence_sync_out[i,:idx_nonnanszeros_first] = 0
+            confidence_sync_out[i,idx_nonnanszeros_last:] = 0 
+        else:
+            confidence_sync_out[i,:] = 0
+        
+        # Turn keypoint values to nan if confidence is low. Keypoints with nan
+        # will be interpolated. In cases with more than 2 cameras, this will
+        # have no impact on triangulation, since corresponding confidence is 0.
+        # But with 2 cameras, we need the keypoint 2D coordinates to
+        # be interpolated. In both cases, not relying on garbage keypoints for
+        # interpolation matters when computing keypoint speeds, which are used
+        # for synchronization.            
+        key2D_out[i,nanInds,:] = np.nan
+    
+    # Helper function.
+    def nan_helper(y):
+        return np.isnan(y), lambda z: z.nonzero()[0]
+    
+    # Interpolate keypoints with nans.
+    for i in range(nMkrs):
+        for j in range(2):
+            if np.isnan(key2D_out[i,:,j]).all(): # only nans
+                key2D_out[i,:,j] = 0
+            elif np.isnan(key2D_out[i,:,j]).any():  # partially nans
+                nans, x = nan_helper(key2D_out[i,:,j])
+                if linearInterp:
+                    # Note: with linear interpolation, values are carried over
+                    # backward and forward for inleading and exiting nans.
+                    key2D_out[i,nans,j] = np.interp(x(nans), x(~nans), 
+                                                    key2D_out[i,~nans,j]) 
+                else:
+                    # Note: with cubic interpolate, values are garbage for
+                    # inleading and exiting nans.
+                    try:
+                        key2D_out[i,:,j] = pchip_interpolate(
+                            x(~nans), key2D_out[i,~nans,j], 
+                            np.arange(key2D_out.shape[1]))    
+                    except:
+                        key2D_out[i,nans,j] = np.interp(x(nans), x(~nans), 
+                                                        key2D_out[i,~nans,j])
+                        
+    # Keep track of inleading and exiting nans when less than 3 cameras.
+    if nCams>2:
+        nans_in_out = np.array([np.nan, np.nan])        
+    else:
+        _, idxFaceMarkers = getOpenPoseFaceMarkers()       
+        nans_in = []
+        nans_out = []
+        for i in range(nMkrs):
+            if i not in idxFaceMarkers:
+                idx_nans = np.isnan(confidence_out[i,:])
+                if False in idx_nans:
+                    nans_in.append(np.where(idx_nans==False)[0][0])
+                    nans_out.append(np.where(idx_nans==False)[0][-1])
+                else:
+                    nans_in.append(np.nan)
+                    nans_out.append(np.nan)                    
+        in_max = np.max(np.asarray(nans_in))
+        out_min = np.min(np.asarray(nans_out))        
+        nans_in_out = np.array([in_max, out_min])
+    
+
+    return key2D_out, confidence_out, nans_in_out, confidence_sync_out
+
+
+def makeKeypoints(nFrames=500, nMkrs=25, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(nFrames)
+    key2D = np.stack((
+        500 + 100*np.sin(2*np.pi*t/90)[None] + rng.uniform(-200,200,(nMkrs,1)),
+        900 + 50*np.cos(2*np.pi*t/60)[None] + rng.uniform(-300,300,(nMkrs,1))),
+        axis=-1)
+    confidence = rng.uniform(0.5, 1, (nMkrs, nFrames))
+    # Gaps of low confidence, undetected keypoints, and leading/trailing
+    # frames without the subject.
+    for _ in range(nMkrs*3):
+        iMkr = rng.integers(nMkrs)
+        start = rng.integers(nFrames)
+        confidence[iMkr, start:start+rng.integers(1,20)] = rng.uniform(0, .3)
+    missing = rng.uniform(size=(nMkrs, nFrames)) < 0.02
+    key2D[missing] = 0
+    confidence[missing] = 0
+    confidence[:, :10] = 0
+    confidence[:, -7:] = 0
+    confidence[3] = 0 # Marker never detected.
+    confidence[4, :-2] = 0 # Marker almost never detected.
+    confidence[5, :] = .1 # Marker always below threshold.
+    key2D[6, :, 0] = 0
+    confidence[7, 100:] = np.nan
+    return key2D, confidence
+
+
+class TestClean2Dkeypoints:
+
+    def test_matches_loop(self):
+        key2D, confidence = makeKeypoints()
+        for nCams in [2, 3]:
+            for linearInterp in [False, True]:
+                outputs = clean2Dkeypoints(
+                    key2D, confidence, confidenceThreshold=0.35, nCams=nCams,
+                    linearInterp=linearInterp)
+                outputs_loop = clean2Dkeypoints_loop(
+                    key2D, confidence, confidenceThreshold=0.35, nCams=nCams,
+                    linearInterp=linearInterp)
+                for out, out_loop in zip(outputs, outputs_loop):
+                    np.testing.assert_allclose(out, out_loop, rtol=1e-12)
+
+
+# %% Microbenchmark on a 10-minute trial at 60 fps (best of 5 runs).
+# python tests/test_clean2Dkeypoints.py
+if __name__ == '__main__':
+    import contextlib, io
+    key2D, confidence = makeKeypoints(nFrames=10*60*60)
+    for linearInterp in [False, True]:
+        for f in [clean2Dkeypoints_loop, clean2Dkeypoints]:
+            durations = []
+            for _ in range(5):
+                start = time.time()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    f(key2D, confidence, confidenceThreshold=0.35, nCams=2,
+                      linearInterp=linearInterp)
+                durations.append(time.time()-start)
+            print('{} (linearInterp={}): {:.3f} s'.format(
+                f.__name__, linearInterp, min(durations)))
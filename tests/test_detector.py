@@ -0,0 +1,235 @@
+import json
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from utils import getPoseArraysPath, loadPoseArrays
+from utils import getMMposeMarkerNames, getOpenPoseMarkerNames
+import utilsDetector
+from utilsDetector import saveJsonsAsPkl, mmposeToOpenPose, arrangeMMposePkl
+
+
+def writeJsons(jsonDir, nFrames=40, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(jsonDir)
+    allKeypoints = []
+    for c_frame in range(nFrames):
+        keypoints = [list(rng.uniform(0, 1000, 75).round(3))
+                     for _ in range(int(rng.integers(0, 3)))]
+        allKeypoints.append(keypoints)
+        with open(os.path.join(
+                jsonDir, 'trial_rotated_{:012d}_keypoints.json'.format(
+                    c_frame)), 'w') as f:
+            json.dump({'version': 1.3, 'people': [
+                {'person_id': [-1], 'pose_keypoints_2d': k}
+                for k in keypoints]}, f)
+    return allKeypoints
+
+
+class TestSaveJsonsAsPkl:
+
+    def test_pickle_and_pose_store(self, tmp_path):
+        jsonDir = str(tmp_path / 'OutputJsons' / 'trial')
+        allKeypoints = writeJsons(jsonDir)
+        pklPath = str(tmp_path / 'trial_rotated_pp.pkl')
+        saveJsonsAsPkl(jsonDir, pklPath, 'trial_rotated', nWorkers=4)
+
+        with open(pklPath, 'rb') as f:
+            frames = pickle.load(f)
+        assert len(frames) == len(allKeypoints)
+        for frame, keypoints in zip(frames, allKeypoints):
+            assert [p['pose_keypoints_2d'] for p in frame] == keypoints
+            assert [p['person_id'] for p in frame] == [
+                [i] for i in range(len(keypoints))]
+
+        keypoints, frameOffsets = loadPoseArrays(getPoseArraysPath(pklPath))
+        np.testing.assert_array_equal(
+            np.diff(frameOffsets), [len(k) for k in allKeypoints])
+        assert os.path.exists(jsonDir)
+
+    def test_delete_jsons(self, tmp_path):
+        jsonDir = str(tmp_path / 'OutputJsons' / 'trial')
+        writeJsons(jsonDir, nFrames=5)
+        pklPath = str(tmp_path / 'trial_rotated_pp.pkl')
+        saveJsonsAsPkl(jsonDir, pklPath, 'trial_rotated', deleteJsons=True)
+        assert not os.path.exists(jsonDir)
+        assert os.path.exists(getPoseArraysPath(pklPath))
+
+
+class TestArrangeMMposePkl:
+
+    def test_mmposeToOpenPose(self):
+        rng = np.random.default_rng(0)
+        predictions = rng.uniform(0, 1000, (4, 133, 3))
+        keypoints = mmposeToOpenPose(predictions)
+        assert keypoints.shape == (4, 25, 3)
+        mm = {m: i for i, m in enumerate(getMMposeMarkerNames())}
+        op = {m: i for i, m in enumerate(getOpenPoseMarkerNames())}
+        np.testing.assert_array_equal(keypoints[:,op['RKnee']],
+                                      predictions[:,mm['RKnee']])
+        np.testing.assert_array_equal(
+            keypoints[:,op['midHip'],:2],
+            (predictions[:,mm['LHip'],:2] + predictions[:,mm['RHip'],:2])/2)
+        np.testing.assert_array_equal(
+            keypoints[:,op['Neck'],2],
+            np.minimum(predictions[:,mm['LShoulder'],2],
+                       predictions[:,mm['RShoulder'],2]))
+
+    def test_arrangeMMposePkl(self, tmp_path):
+        rng = np.random.default_rng(1)
+        predictions = rng.uniform(0, 1000, (3, 133, 3)).astype(np.float32)
+        frames = [[{'preds_with_flip': predictions[0]}], [],
+                  [{'preds_with_flip': predictions[1]},
+                   {'preds_with_flip': predictions[2]}]]
+        pklPath = str(tmp_path / 'trial_rotated.pkl')
+        ppPklPath = str(tmp_path / 'trial_rotated_pp.pkl')
+        with open(pklPath, 'wb') as f:
+            pickle.dump(frames, f)
+        arrangeMMposePkl(pklPath, ppPklPath)
+        with open(ppPklPath, 'rb') as f:
+            ppFrames = pickle.load(f)
+        assert [len(frame) for frame in ppFrames] == [1, 0, 2]
+        assert ppFrames[2][1]['person_id'] == [1]
+        np.testing.assert_array_equal(
+            ppFrames[2][1]['pose_keypoints_2d'],
+            mmposeToOpenPose(predictions[2]).ravel())
+        keypoints, frameOffsets = loadPoseArrays(getPoseArraysPath(ppPklPath))
+        np.testing.assert_array_equal(frameOffsets, [0, 1, 1, 3])
+
+
+class TestRunPoseDetector:
+
+    def makeCameras(self, tmp_path, nCams):
+        CameraDirectories = {}
+        for i in range(nCams):
+            cameraDirectory = str(tmp_path / 'Cam{}'.format(i))
+            os.makedirs(os.path.join(cameraDirectory, 'InputMedia', 'trial'))
+            open(os.path.join(cameraDirectory, 'InputMedia', 'trial',
+                              'trial.mov'), 'w').close()
+            CameraDirectories['Cam{}'.format(i)] = cameraDirectory
+        return CameraDirectories
+
+    def test_cameras_run_concurrently_on_free_devices(self, tmp_path,
+                                                      monkeypatch):
+        CameraDirectories = self.makeCameras(tmp_path, 4)
+        lock = threading.Lock()
+        running = []
+        calls = []
+        def runMMposeVideo(cameraDirectory, fileName, *args, device, **kwargs):
+            with lock:
+                assert device not in running
+                running.append(device)
+                calls.append((os.path.basename(cameraDirectory), fileName))
+            time.sleep(.1)
+            with lock:
+                running.remove(device)
+        monkeypatch.setattr(utilsDetector, 'runMMposeVideo', runMMposeVideo)
+
+        start = time.time()
+        extension = utilsDetector.runPoseDetector(
+            CameraDirectories, 'InputMedia/trial/trial', '', 'trial',
+            CamParamDict=dict.fromkeys(CameraDirectories),
+            poseDetector='mmpose', devices=[0, 1])
+        assert extension == '.mov'
+        assert sorted(calls) == [('Cam{}'.format(i),
+                                  'InputMedia/trial/trial.mov')
+                                 for i in range(4)]
+        assert time.time() - start < .35
+
+    def test_local_mmpose_runs_one_camera_per_device(self, tmp_path,
+                                                     monkeypatch):
+        CameraDirectories = self.makeCameras(tmp_path, 3)
+        lock = threading.Lock()
+        running = []
+        devices = []
+        def runMMposeVideo(cameraDirectory, *args, device, **kwargs):
+            with lock:
+                assert not running
+                running.append(device)
+                devices.append(device)
+            time.sleep(.05)
+            with lock:
+                running.remove(device)
+        monkeypatch.setattr(utilsDetector, 'runMMposeVideo', runMMposeVideo)
+        utilsDetector.runPoseDetector(
+            CameraDirectories, 'InputMedia/trial/trial', '', 'trial',
+            CamParamDict=dict.fromkeys(CameraDirectories),
+            poseDetector='mmpose')
+        assert devices == ['cuda:0'] * 3
+
+    def test_error_of_first_camera_is_raised(self, tmp_path, monkeypatch):
+        CameraDirectories = self.makeCameras(tmp_path, 3)
+        def runOpenPoseVideo(cameraDirectory, *args, **kwargs):
+            camName = os.path.basename(cameraDirectory)
+            if camName != 'Cam0':
+                raise Exception(camName, camName)
+        monkeypatch.setattr(utilsDetector, 'runOpenPoseVideo',
+                            runOpenPoseVideo)
+        with pytest.raises(Exception) as e:
+            utilsDetector.runPoseDetector(
+                CameraDirectories, 'InputMedia/trial/trial', '', 'trial',
+                CamParamDict=dict.fromkeys(CameraDirectories), nWorkers=3)
+        assert e.value.args == ('Cam1', 'Cam1')
+
+
+class TestPrepareVideoForDetection:
+
+    def test_rotated_copy_only_when_needed(self, tmp_path, monkeypatch):
+        videoPath = str(tmp_path / 'trial.mov')
+        open(videoPath, 'w').close()
+        commands = []
+        monkeypatch.setattr(utilsDetector.os, 'system', commands.append)
+        rotations = {videoPath: 0}
+        monkeypatch.setattr(utilsDetector, 'getVideoDisplayRotation',
+                            rotations.get)
+
+        assert utilsDetector.prepareVideoForDetection(videoPath) == videoPath
+        rotations[videoPath] = 90
+        assert utilsDetector.prepareVideoForDetection(
+            videoPath, detectorRotates=True) == videoPath
+        assert commands == []
+
+        rotatedPath = str(tmp_path / 'trial_rotated.avi')
+        assert utilsDetector.prepareVideoForDetection(
+            videoPath, detectorRotates=False) == rotatedPath
+        assert len(commands) == 1 and commands[0].endswith(rotatedPath)
+
+        # An existing copy is always used, and not written again.
+        open(rotatedPath, 'w').close()
+        rotations[videoPath] = 0
+        assert utilsDetector.prepareVideoForDetection(videoPath) == rotatedPath
+        assert len(commands) == 1
+
+    def test_getVideoDisplayRotation(self, tmp_path, monkeypatch):
+        import utilsChecker
+        meta = {'format': {'duration': '2.5'},
+                'streams': [{'side_data_list': [
+                    {'side_data_type': 'Display Matrix', 'rotation': -90}]}]}
+        monkeypatch.setattr(utilsChecker.ffmpeg, 'probe',
+                            lambda *args, **kwargs: meta)
+        videoPath = str(tmp_path / 'trial.mov')
+        open(videoPath, 'w').close()
+        assert utilsChecker.getVideoDisplayRotation(videoPath) == 270
+        videoPath = str(tmp_path / 'trial.mp4')
+        open(videoPath, 'w').close()
+        meta['streams'] = [{'tags': {'rotate': '180'}}]
+        assert utilsChecker.getVideoDisplayRotation(videoPath) == 180
+
+
+class TestRaisePoseDetectionError:
+
+    def test_specific_and_generic_errors(self):
+        with pytest.raises(Exception) as e:
+            utilsDetector.raisePoseDetectionError(
+                Exception('Timed out.', 'timeout - openpose'))
+        assert e.value.args == ('Timed out.', 'timeout - openpose')
+        for error in [Exception('Failed.'), ConnectionError(), 
+                      OSError(2, 'No such file', 'video.mov')]:
+            with pytest.raises(Exception) as e:
+                utilsDetector.raisePoseDetectionError(error)
+            assert len(e.value.args) == 2
+            assert e.value.args[0].startswith('Pose detection failed.')
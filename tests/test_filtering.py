@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import butter, sosfiltfilt
+
+from utils import sosfiltfiltChunked, gaussianFilterChunked, lowpassFilter
+from utilsChecker import filterKeypointsButterworth, filter3DPointsButterworth
+from utilsChecker import smoothKeypoints
+
+
+def makeKeypoints(nMkrs=25, nFrames=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    walk = np.cumsum(rng.standard_normal((nMkrs, nFrames, 2)), axis=1)
+    return 500 + walk + rng.standard_normal((nMkrs, nFrames, 2))
+
+
+class TestSosfiltfiltChunked:
+
+    @pytest.mark.parametrize('chunkSize', [1, 37, 500, 5000])
+    def test_matches_sosfiltfilt(self, chunkSize):
+        key2D = makeKeypoints()
+        sos = butter(2, 12/(60/2), btype='low', output='sos')
+        expected = sosfiltfilt(sos, key2D, axis=1)
+        out = sosfiltfiltChunked(sos, key2D, axis=1, chunkSize=chunkSize)
+        np.testing.assert_allclose(out, expected, rtol=0, atol=1e-8)
+
+    def test_memmap(self, tmp_path):
+        key2D = makeKeypoints(nFrames=3000)
+        np.save(tmp_path / 'key2D.npy', key2D)
+        key2D_mm = np.load(tmp_path / 'key2D.npy', mmap_mode='r')
+        out = np.lib.format.open_memmap(tmp_path / 'key2D_filt.npy',
+                                        mode='w+', dtype=float,
+                                        shape=key2D.shape)
+        filterKeypointsButterworth(key2D_mm, 12, 60, chunkSize=256, out=out)
+        out.flush()
+        expected = filterKeypointsButterworth(key2D, 12, 60)
+        np.testing.assert_allclose(
+            np.load(tmp_path / 'key2D_filt.npy'), expected, rtol=0, atol=1e-8)
+
+    def test_3D_points_and_lowpass(self):
+        rng = np.random.default_rng(1)
+        points3D = np.cumsum(rng.standard_normal((1500, 20, 3)), axis=0)
+        np.testing.assert_allclose(
+            filter3DPointsButterworth(points3D, 6, 100, chunkSize=100),
+            filter3DPointsButterworth(points3D, 6, 100), rtol=0, atol=1e-8)
+        data = np.concatenate((np.arange(1500)[:,None]/100,
+                               points3D[:,:,0]), axis=1)
+        np.testing.assert_allclose(
+            lowpassFilter(data, 6, chunkSize=100), lowpassFilter(data, 6),
+            rtol=0, atol=1e-8)
+
+    def test_too_short(self):
+        sos = butter(2, .4, btype='low', output='sos')
+        with pytest.raises(ValueError):
+            sosfiltfiltChunked(sos, np.zeros(5))
+
+
+class TestGaussianFilterChunked:
+
+    @pytest.mark.parametrize('chunkSize', [1, 10, 333, 5000])
+    def test_matches_gaussian_filter1d(self, chunkSize):
+        key2D = makeKeypoints()
+        expected = gaussian_filter1d(key2D, 3, axis=1)
+        out = gaussianFilterChunked(key2D, 3, axis=1, chunkSize=chunkSize)
+        np.testing.assert_allclose(out, expected, rtol=0, atol=1e-10)
+
+    def test_smoothKeypoints(self):
+        key2D = makeKeypoints(nMkrs=27)
+        smoothed = smoothKeypoints(key2D, sdKernel=3, chunkSize=100)
+        np.testing.assert_allclose(smoothed, smoothKeypoints(key2D, sdKernel=3),
+                                   rtol=0, atol=1e-10)
+        np.testing.assert_array_equal(smoothed[25:], key2D[25:])
@@ -0,0 +1,69 @@
+import os
+import pickle
+
+import numpy as np
+
+from utils import poseFramesToArrays, savePoseArrays, loadPoseArrays
+from utils import convertPosePklToArrays, getPoseArraysPath
+from utilsChecker import loadPklVideo, posePklToArray, poseArraysToPeople
+
+
+def makeFrames(nFrames=50, seed=0):
+    # _pp.pkl-like frames with a varying number of people.
+    rng = np.random.default_rng(seed)
+    frames = []
+    for c_frame in range(nFrames):
+        nPeople = int(rng.integers(0, 4))
+        frames.append([
+            {'person_id': [i],
+             'pose_keypoints_2d': list(rng.uniform(0, 1000, 75))}
+            for i in range(nPeople)])
+    return frames
+
+
+class TestPoseStore:
+
+    def test_round_trip(self, tmp_path):
+        frames = makeFrames()
+        posePath = savePoseArrays(str(tmp_path / 'trial_pp.npz'),
+                                  *poseFramesToArrays(frames))
+        keypoints, frameOffsets = loadPoseArrays(posePath)
+        assert isinstance(keypoints, np.memmap)
+        assert len(frameOffsets) == len(frames) + 1
+        for c_frame, frame in enumerate(frames):
+            people = keypoints[frameOffsets[c_frame]:frameOffsets[c_frame+1]]
+            expected = np.array([p['pose_keypoints_2d'] for p in frame],
+                                dtype=np.float32).reshape(-1, 25, 3)
+            np.testing.assert_array_equal(people, expected)
+        np.testing.assert_allclose(
+            poseArraysToPeople(keypoints, frameOffsets),
+            posePklToArray(frames), rtol=1e-6)
+
+    def test_empty(self, tmp_path):
+        frames = [[] for _ in range(5)]
+        posePath = savePoseArrays(str(tmp_path / 'trial_pp.npz'),
+                                  *poseFramesToArrays(frames))
+        keypoints, frameOffsets = loadPoseArrays(posePath)
+        assert keypoints.shape == (0, 25, 3)
+        assert poseArraysToPeople(keypoints, frameOffsets).shape == (5, 1, 75)
+
+    def test_loadPklVideo_uses_current_store(self, tmp_path):
+        frames = [[{'person_id': [0], 'pose_keypoints_2d':
+                    list(np.tile([500.25, 800.5, .9], 25) + c_frame)}]
+                  for c_frame in range(20)]
+        pklPath = str(tmp_path / 'trial_rotated_pp.pkl')
+        with open(pklPath, 'wb') as f:
+            pickle.dump(frames, f)
+        posePath = convertPosePklToArrays(pklPath)
+        assert posePath == getPoseArraysPath(pklPath)
+
+        key2D, confidence = loadPklVideo(pklPath, 'trial.mov')
+        np.testing.assert_allclose(key2D[0,:,0], 500.25 + np.arange(20))
+
+        # A pickle newer than the store takes precedence.
+        frames[0][0]['pose_keypoints_2d'][0] = 0
+        with open(pklPath, 'wb') as f:
+            pickle.dump(frames, f)
+        os.utime(posePath, (1, 1))
+        key2D, _ = loadPklVideo(pklPath, 'trial.mov')
+        assert key2D[0,0,0] == 0
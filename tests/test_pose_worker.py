@@ -0,0 +1,65 @@
+import os
+import threading
+
+import pytest
+
+from utilsPoseWorker import startPoseWorker, submitPoseJob
+from utilsPoseWorker import isPoseWorkerAvailable
+
+
+def processJob(videoPath, outputDir):
+    with open(videoPath) as f:
+        content = f.read()
+    if content == 'corrupted':
+        raise ValueError('Cannot decode video.')
+    with open(os.path.join(outputDir, 'human.pkl'), 'w') as f:
+        f.write(content)
+
+
+class TestPoseWorker:
+
+    def test_concurrent_jobs(self, tmp_path):
+        dataDir = str(tmp_path / 'data')
+        os.makedirs(dataDir)
+        assert not isPoseWorkerAvailable(dataDir, 'mmpose')
+        server = startPoseWorker(dataDir, 'mmpose', processJob, nJobs=2)
+        try:
+            assert isPoseWorkerAvailable(dataDir, 'mmpose')
+            replies = {}
+            def submit(camName):
+                videoPath = str(tmp_path / (camName + '.mov'))
+                with open(videoPath, 'w') as f:
+                    f.write(camName)
+                replies[camName] = submitPoseJob(
+                    dataDir, 'mmpose', videoPath, str(tmp_path / camName))
+            threads = [threading.Thread(target=submit, args=('Cam' + str(i),))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for i in range(4):
+                camName = 'Cam' + str(i)
+                assert replies[camName]['status'] == 'done'
+                with open(str(tmp_path / camName / 'human.pkl')) as f:
+                    assert f.read() == camName
+            assert os.listdir(os.path.join(dataDir, 'jobs')) == []
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_failed_job(self, tmp_path):
+        dataDir = str(tmp_path)
+        server = startPoseWorker(dataDir, 'openpose', processJob)
+        try:
+            videoPath = str(tmp_path / 'video.mov')
+            with open(videoPath, 'w') as f:
+                f.write('corrupted')
+            with pytest.raises(Exception) as e:
+                submitPoseJob(dataDir, 'openpose', videoPath,
+                              str(tmp_path / 'output'))
+            assert e.value.args == ('Cannot decode video.',)
+        finally:
+            server.shutdown()
+            server.server_close()
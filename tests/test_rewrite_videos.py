@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+import utils
+
+
+class TestRewriteVideos:
+
+    def test_preset_only_when_scaling(self, monkeypatch):
+        commands = []
+        monkeypatch.setattr(utils.subprocess, 'run',
+                            lambda command, **kwargs: commands.append(command))
+        utils.rewriteVideos('/data/trial.mov', 60, 120, 60.,
+                            outputDir='/data/out', preset='veryfast')
+        utils.rewriteVideos('/data/trial.mov', 60, 120, 60.,
+                            imageScaleFactor=None, preset='veryfast')
+        assert commands[0][commands[0].index('-preset') + 1] == 'veryfast'
+        assert 'scale=iw/2:-1' in commands[0]
+        assert commands[0][-1] == '/data/out/trial_sync.mov'
+        assert '-preset' not in commands[1]
+        assert commands[1][commands[1].index('-vcodec') + 1] == 'copy'
+
+    def test_async_rewrites_run_in_parallel(self, monkeypatch):
+        lock = threading.Lock()
+        written = []
+        def run(command, check):
+            assert check
+            time.sleep(.1)
+            with lock:
+                written.append(command[-1])
+        monkeypatch.setattr(utils.subprocess, 'run', run)
+        monkeypatch.setattr(utils, 'videoRewriteExecutor', None)
+
+        start = time.time()
+        for i in range(4):
+            utils.rewriteVideosAsync('/data/trial.mov', 0, 10, 60.,
+                                     outputFileName='Cam{}.mp4'.format(i),
+                                     nWorkers=4)
+        assert time.time() - start < .1
+        utils.waitForVideoRewrites()
+        assert time.time() - start < .35
+        assert sorted(written) == ['/data/Cam{}.mp4'.format(i)
+                                   for i in range(4)]
+        assert utils.videoRewriteFutures == []
+
+    def test_all_rewrites_awaited_before_errors(self, monkeypatch):
+        written = []
+        def run(command, check):
+            time.sleep(.05)
+            if command[-1].endswith('Cam0.mp4'):
+                raise utils.subprocess.CalledProcessError(1, command)
+            written.append(command[-1])
+        monkeypatch.setattr(utils.subprocess, 'run', run)
+        monkeypatch.setattr(utils, 'videoRewriteExecutor', None)
+
+        for i in range(3):
+            utils.rewriteVideosAsync('/data/trial.mov', 0, 10, 60.,
+                                     outputFileName='Cam{}.mp4'.format(i),
+                                     nWorkers=1)
+        with pytest.raises(utils.subprocess.CalledProcessError):
+            utils.waitForVideoRewrites()
+        assert sorted(written) == ['/data/Cam1.mp4', '/data/Cam2.mp4']
+        assert utils.videoRewriteFutures == []
+
+        # Errors are only logged while another exception is handled.
+        utils.rewriteVideosAsync('/data/trial.mov', 0, 10, 60.,
+                                 outputFileName='Cam0.mp4')
+        utils.waitForVideoRewrites(raiseErrors=False)
+        assert utils.videoRewriteFutures == []
@@ -0,0 +1,206 @@
+import numpy as np
+import pytest
+
+from utilsChecker import cross_corr, cross_corr_multiple_timeseries
+from utilsChecker import cross_corr_fft, estimatePairwiseLags, solveSyncOffsets
+from utilsChecker import calcReprojectionErrorForSync, parabolicPeakOffset
+from utilsChecker import resampleKeypoints
+from utilsChecker import synchronizeVideoKeypoints, syncKeypointTracks
+from utilsChecker import calcReprojectionErrorForSyncSweep
+from utilsCameraPy3 import CameraRig
+from test_triangulation import makeTrial, makeCameraParams, projectPoints
+
+
+def makeSignals(nSamples=300, lag=7, seed=0):
+    # Smooth random signal and a delayed, noisy copy.
+    rng = np.random.default_rng(seed)
+    x = np.convolve(rng.standard_normal(nSamples + 2*lag + 50), 
+                    np.hanning(15), mode='same')
+    y1 = x[lag:lag+nSamples] + .05*rng.standard_normal(nSamples)
+    y2 = x[2*lag:2*lag+nSamples]
+    return y1, y2
+
+
+class TestCrossCorrFFT:
+
+    def test_matches_direct(self):
+        y1, y2 = makeSignals()
+        signals = [y1, y1[:250], np.concatenate((y1, y1[:41]))]
+        corrList = cross_corr_fft(signals, y2)
+        for y, corr in zip(signals, corrList):
+            _, lagDirect = cross_corr(y, y2)
+            _, lag = cross_corr(y, y2, corr=corr)
+            assert lag == lagDirect
+            
+            # Same normalized correlation as the direct computation.
+            N = max(len(y), len(y2))
+            y1p = np.zeros(N); y1p[:len(y)] = y
+            y2p = np.zeros(N); y2p[:len(y2)] = y2
+            corrDirect = np.correlate(y1p, y2p, mode='same') / np.correlate(
+                np.ones(N), np.ones(N), mode='same') / np.sqrt(
+                    np.dot(y1p,y1p)/N * np.dot(y2p,y2p)/N)
+            np.testing.assert_allclose(corr, corrDirect, atol=1e-10)
+        
+        _, lag = cross_corr(y1, y2, corr=corrList[0])
+        assert lag == 7
+
+    def test_multiple_timeseries(self):
+        Y1 = np.stack([makeSignals(seed=i)[0] for i in range(4)])
+        Y2 = np.stack([makeSignals(seed=i)[1] for i in range(4)])
+        corrMat = cross_corr_fft([Y1], Y2)[0]
+        assert corrMat.shape == Y1.shape
+        corrDirect, lagDirect = cross_corr_multiple_timeseries(Y1, Y2)
+        corrFFT, lag = cross_corr_multiple_timeseries(Y1, Y2, corrMat=corrMat)
+        assert lag == lagDirect == 7
+        np.testing.assert_allclose(corrFFT, corrDirect)
+
+
+class TestReprojectionErrorSweep:
+
+    def test_matches_single_lags(self):
+        CameraParamDict, keypoints2D, confidence, _ = makeTrial(nFrames=60)
+        camNames = list(CameraParamDict)
+        CamParamList = [CameraParamDict[c] for c in camNames]
+        keypointList = [keypoints2D[c] for c in camNames]
+        confidenceList = [np.nan_to_num(confidence[c]) for c in camNames]
+        
+        lags = [-3, 0, 2, 5, 100]
+        reprojErrors, reprojSuccess = calcReprojectionErrorForSyncSweep(
+            CameraRig(CameraParamDict), keypointList, lags, [0, 2],
+            confidenceList, camNames)
+        assert all(reprojSuccess)
+        for lag, reprojError in zip(lags[:-1], reprojErrors):
+            assert reprojError == pytest.approx(calcReprojectionErrorForSync(
+                CamParamList, keypointList, lag, [0, 2], confidenceList,
+                camNames)[0])
+        # The true lag is 0.
+        assert np.argmin(reprojErrors) == 1
+        # Lag outside of the trial.
+        assert reprojErrors[-1] == np.inf
+
+
+class TestPairwiseSync:
+
+    def test_recovers_offsets(self):
+        # Offsets relative to Cam0, same convention as cross_corr lags.
+        offsets = [0, 7, -4, 12, 3]
+        rng = np.random.default_rng(1)
+        x = np.convolve(rng.standard_normal(600), np.hanning(15), mode='same')
+        signals = [x[100-o:400-o] + .05*rng.standard_normal(300) for o in offsets]
+        # Cam0 barely sees the subject.
+        signals[0] = signals[0] * 0.01 + .5*rng.standard_normal(300)
+        
+        lagMat, weightMat = estimatePairwiseLags(signals, multCorrGaussianStd=30)
+        for i in range(1, 5):
+            for j in range(1, 5):
+                assert lagMat[i,j] == offsets[i] - offsets[j]
+        # Pairs with Cam0 have low weights.
+        assert np.all(weightMat[0,1:] < weightMat[1,2])
+        
+        solved = solveSyncOffsets(lagMat, weightMat)
+        np.testing.assert_allclose(np.array(solved[1:]) - solved[1],
+                                   np.array(offsets[1:]) - offsets[1], atol=.5)
+
+    def test_inconsistent_pair(self):
+        offsets = np.array([0, 5, -3, 8])
+        lagMat = offsets[:,None] - offsets[None,:]
+        lagMat[1,2] += 20
+        lagMat[2,1] -= 20
+        solved = solveSyncOffsets(lagMat.astype(float), np.ones((4,4)))
+        np.testing.assert_allclose(solved, offsets, atol=.5)
+
+
+class TestSyncMethods:
+
+    def test_pairwise_matches_reference(self):
+        CameraParamDict, keypointList, confList = makeShiftedTrial()
+        startFrames = []
+        for syncMethod in ['reference', 'pairwise']:
+            _, _, _, startEndFrames = synchronizeVideoKeypoints(
+                [k.copy() for k in keypointList], [c.copy() for c in confList],
+                sampleFreq=30, maxShiftSteps=60,
+                CameraParams=list(CameraParamDict.values()),
+                cameras2Use=list(CameraParamDict),
+                CameraDirectories=dict(zip(CameraParamDict, CameraParamDict)),
+                syncMethod=syncMethod)
+            startFrames.append([s[0] for s in startEndFrames])
+        assert startFrames[0] == startFrames[1]
+        assert [startFrames[1][0] - s for s in startFrames[1]] == [0, 4, 9]
+
+
+class TestSubFrameSync:
+
+    def test_fractional_lag(self):
+        # Delayed copy by 3.4 samples of a smooth signal.
+        t = np.arange(2000)
+        signal = lambda t: np.sin(2*np.pi*t/50) * np.exp(-((t-1000)/150)**2)
+        _, lag = cross_corr(signal(t-3.4), signal(t), subFrame=True)
+        _, lagInt = cross_corr(signal(t-3.4), signal(t))
+        assert lagInt == 3
+        assert lag == pytest.approx(3.4, abs=.1)
+
+    def test_fractional_lag_single_peak(self):
+        # A single correlation peak is returned without reprojection error
+        # sweep, still refined to a fraction of a frame.
+        lags = np.arange(400) - 200
+        corr = np.exp(-((lags - 3.4)/10)**2)
+        _, lag = cross_corr(None, None, corr=corr, subFrame=True,
+                            dataForReproj={})
+        assert lag == pytest.approx(3.4, abs=.1)
+        _, lag = cross_corr_multiple_timeseries(
+            np.zeros((2, 400)), None, corrMat=np.stack((corr, corr))/2,
+            subFrame=True, dataForReproj={})
+        assert lag == pytest.approx(3.4, abs=.1)
+
+    def test_resample_keypoints(self):
+        key = np.stack((np.tile(np.arange(10.), (3,1)), 
+                        np.tile(np.arange(10.), (3,1))*2), axis=-1)
+        conf = np.ones((3,10))
+        conf[1,4] = 0
+        keyResampled, confResampled = resampleKeypoints(
+            key, conf, np.array([0, 2.5, 3.25, 5, 9]))
+        np.testing.assert_allclose(keyResampled[0,:,0], [0, 2.5, 3.25, 5, 9])
+        np.testing.assert_allclose(keyResampled[0,:,1], [0, 5, 6.5, 10, 18])
+        np.testing.assert_array_equal(confResampled[1], [1, 1, 0, 1, 1])
+        assert parabolicPeakOffset(np.array([0, 1, 0]), 1) == 0
+        assert parabolicPeakOffset(np.array([0.5, 1, 0]), 1) == pytest.approx(-1/6)
+
+
+def makeShiftedTrial(nFrames=240, shifts=[0, 4, 9], seed=0):
+    # Keypoints of 3 cameras of a moving subject, camera i starting shifts[i]
+    # frames after Cam0.
+    rng = np.random.default_rng(seed)
+    CameraParamDict = makeCameraParams(len(shifts))
+    t = np.arange(nFrames + 20)
+    walk = np.stack((400*np.sin(2*np.pi*t/90), 200*np.cos(2*np.pi*t/70),
+                     150*np.sin(2*np.pi*t/45)))[:,None]
+    points3D = rng.uniform(-300, 300, (3, 25, 1)) + walk
+    projected = projectPoints(CameraParamDict, points3D, noise=.5)
+    keypointList = [projected[camName][:,shift:shift+nFrames] for 
+                    camName, shift in zip(CameraParamDict, shifts)]
+    confList = [rng.uniform(.5, 1, (25, nFrames)) for _ in keypointList]
+    return CameraParamDict, keypointList, confList
+
+
+class TestSyncKeypointTracks:
+
+    @pytest.mark.parametrize('subFrameSync', [False, True])
+    def test_matches_synchronized_subject(self, subFrameSync):
+        CameraParamDict, keypointList, confList = makeShiftedTrial()
+        
+        keypointsSync, confidenceSync, _, startEndFrames, syncInfo = (
+            synchronizeVideoKeypoints(
+                [k.copy() for k in keypointList], [c.copy() for c in confList],
+                sampleFreq=30, maxShiftSteps=60,
+                CameraParams=list(CameraParamDict.values()),
+                cameras2Use=list(CameraParamDict),
+                CameraDirectories=dict(zip(CameraParamDict, CameraParamDict)),
+                subFrameSync=subFrameSync, returnSyncInfo=True))
+        assert [startEndFrames[0][0] - s[0] for s in startEndFrames] == [0, 4, 9]
+        # A track with the keypoints of the subject is processed the same way.
+        for iCam in range(3):
+            keyTrack, confTrack = syncKeypointTracks(
+                keypointList[iCam][None], confList[iCam][None],
+                syncInfo['frameInds'][iCam], syncInfo, 30)
+            np.testing.assert_array_equal(keyTrack[0], keypointsSync[iCam])
+            np.testing.assert_array_equal(confTrack[0], confidenceSync[iCam])
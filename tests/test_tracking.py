@@ -0,0 +1,157 @@
+import pickle
+
+import numpy as np
+
+from utilsChecker import loadPklVideo, trackBoxCornersViterbi, trackPeople2D
+from utilsChecker import keypointsToBoundingBox, associatePeopleAcrossViews
+from utilsChecker import triangulateMultiviewVideo
+from test_triangulation import makeCameraParams, projectPoints
+
+
+def makePerson(center, nFrames, height, rng):
+    # nFrames x 75 OpenPose keypoints of a person walking around center.
+    base = rng.uniform(-1, 1, (25, 2)) * [height*.3, height/2]
+    traj = center + np.cumsum(rng.normal(0, 2, (nFrames, 2)), axis=0)
+    conf = rng.uniform(.7, 1, (nFrames, 25, 1))
+    return np.concatenate((traj[:,None] + base, conf), axis=2).reshape(
+        nFrames, 75)
+
+
+class TestTracking:
+
+    def test_loadPklVideo_tracks_largest_person(self, tmp_path):
+        rng = np.random.default_rng(0)
+        nFrames = 400
+        subject = makePerson([500, 600], nFrames, 600, rng)
+        other = makePerson([1300, 600], nFrames, 300, rng)
+        frames = []
+        for c_frame in range(nFrames):
+            people = [subject, other] if c_frame % 3 else [other, subject]
+            if c_frame >= 300:
+                # Subject leaves the field of view.
+                people = [other]
+            frames.append([{'pose_keypoints_2d': list(p[c_frame])}
+                           for p in people])
+        pklPath = str(tmp_path / 'trial_rotated_pp.pkl')
+        with open(pklPath, 'wb') as f:
+            pickle.dump(frames, f)
+
+        # imageSize is given, the video is never opened.
+        key2D, confidence = loadPklVideo(
+            pklPath, '/data/Cam0/InputMedia/trial/trial.mov',
+            imageSize=np.array([[1080], [1920]]))
+        expected = np.reshape(subject, (nFrames, 25, 3))
+        np.testing.assert_array_equal(key2D[:,:300],
+                                      np.moveaxis(expected[:300,:,:2], 0, 1))
+        np.testing.assert_array_equal(key2D[:,300:], 0)
+        np.testing.assert_array_equal(confidence[:,300:], 0)
+
+    def test_viterbi_prefers_longer_track(self):
+        # Greedy nearest box would switch to person 1 at frame 1 and be lost
+        # at frame 2, person 0 can be tracked through all frames.
+        box = np.array([0, 0, 100, 100.])
+        corners = np.full((4, 2, 4), np.nan)
+        corners[:,0] = box + [[0], [30], [60], [90]]
+        corners[1,1] = box + 10
+        path = trackBoxCornersViterbi(corners, 0, maxJump=70)
+        np.testing.assert_array_equal(path, [0, 0, 0, 0])
+        path = trackBoxCornersViterbi(corners, 0, maxJump=50)
+        np.testing.assert_array_equal(path, [0, 1, -1, -1])
+
+    def test_viterbi_fills_bridged_bad_frames(self):
+        # Person 0 is missed in frames 2-3, where the closest detection is a
+        # different person (1) that moves too much, and then found again.
+        box = np.array([0, 0, 100, 100.])
+        corners = np.full((7, 2, 4), np.nan)
+        corners[:,0] = box + 5*np.arange(7)[:,None]
+        corners[2:4,0] = np.nan
+        corners[2:4,1] = box + 300
+        path = trackBoxCornersViterbi(corners, 0, maxJump=50)
+        np.testing.assert_array_equal(path, [0, 0, -1, -1, -1, -1, -1])
+        path = trackBoxCornersViterbi(corners, 0, maxJump=50, maxGap=1)
+        np.testing.assert_array_equal(path, [0, 0, -1, -1, -1, -1, -1])
+        # Bridged frames are filled with the closest detection, as the
+        # baseline frame-by-frame tracking did.
+        path = trackBoxCornersViterbi(corners, 0, maxJump=50, maxGap=2)
+        np.testing.assert_array_equal(path, [0, 0, 1, 1, 0, 0, 0])
+        # Nobody to fill an undetected bridged frame with.
+        corners[3,1] = np.nan
+        path = trackBoxCornersViterbi(corners, 0, maxJump=50, maxGap=2)
+        np.testing.assert_array_equal(path, [0, 0, 1, -1, 0, 0, 0])
+
+
+class TestMultiPersonTracking:
+
+    def test_trackPeople2D(self):
+        rng = np.random.default_rng(1)
+        nFrames = 200
+        personA = makePerson([500, 600], nFrames, 600, rng)
+        personB = makePerson([1300, 600], nFrames, 300, rng)
+        people = np.full((nFrames, 3, 75), np.nan)
+        people[:,0] = personA
+        people[:,1] = personB
+        # Detection order changes, B is missed for 3 frames.
+        people[::4] = people[::4,[1,0,2]]
+        people[50:53,1] = np.nan
+        people[50:53,0] = personA[50:53]
+        # Spurious detection of 2 frames.
+        people[100:102,2] = personB[100:102] + 800
+        allBoxes = np.reshape(keypointsToBoundingBox(
+            np.reshape(people, (-1, 75))), (nFrames, 3, 4))
+        tracklets = trackPeople2D(people, allBoxes, (1080, 1920))
+        assert tracklets.shape == (nFrames, 2, 75)
+        np.testing.assert_array_equal(tracklets[:,0], personA)
+        np.testing.assert_array_equal(tracklets[:50,1], personB[:50])
+        assert np.all(np.isnan(tracklets[50:53,1]))
+        np.testing.assert_array_equal(tracklets[53:,1], personB[53:])
+
+    def test_associate_and_triangulate_subjects(self):
+        rng = np.random.default_rng(2)
+        nFrames = 60
+        CameraParamDict = makeCameraParams(3)
+        subjects3D = []
+        for center in ([-600, 0, 0], [600, 200, 0]):
+            body = rng.uniform(-200, 200, (3, 25, 1)) * [[[1]], [[1]], [[4]]]
+            walk = np.cumsum(rng.normal(0, 5, (3, 1, nFrames)), axis=2)
+            subjects3D.append(np.array(center)[:,None,None] + body + walk)
+        projected = [projectPoints(CameraParamDict, points3D, noise=.5)
+                     for points3D in subjects3D]
+        
+        keypointsList = []
+        confidenceList = []
+        for iCam, camName in enumerate(CameraParamDict):
+            key2D = np.stack([p[camName] for p in projected])
+            confidence = np.full((2, 25, nFrames), .9)
+            if iCam == 0:
+                # Second subject detected in two separate tracks, and tracks
+                # in reverse order.
+                key2D = np.stack((key2D[1], key2D[1], key2D[0]))
+                confidence = np.stack((confidence[1], confidence[1], 
+                                       confidence[0]))
+                key2D[0,:,30:] = 0
+                confidence[0,:,30:] = 0
+                key2D[1,:,:30] = 0
+                confidence[1,:,:30] = 0
+            keypointsList.append(key2D)
+            confidenceList.append(confidence)
+        
+        keypointsSubjects, confidenceSubjects = associatePeopleAcrossViews(
+            list(CameraParamDict.values()), keypointsList, confidenceList)
+        assert len(keypointsSubjects) == 2
+        
+        keypointDicts = [dict(zip(CameraParamDict, k)) 
+                         for k in keypointsSubjects]
+        confidenceDicts = [dict(zip(CameraParamDict, c)) 
+                           for c in confidenceSubjects]
+        points3DList, _ = triangulateMultiviewVideo(
+            CameraParamDict, keypointDicts, confidenceDict=confidenceDicts,
+            trimTrial=False, batchTriangulation=True)
+        # Subjects are ordered by how often they are seen, then match each
+        # reconstruction to the closest ground truth.
+        for points3D in points3DList:
+            errors = [np.mean(np.linalg.norm(points3D - gt, axis=0))
+                      for gt in subjects3D]
+            assert np.min(errors) < 5
+        assert len(set(np.argmin(
+            [[np.mean(np.linalg.norm(p - gt, axis=0)) for gt in subjects3D]
+             for p in points3DList], axis=1))) == 2
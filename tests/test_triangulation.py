@@ -0,0 +1,268 @@
+import numpy as np
+import cv2
+
+from utilsChecker import triangulateMultiviewVideo, undistort2Dkeypoints
+from utilsChecker import calcReprojectionError, calcReprojectionErrorBatch
+from utilsCameraPy3 import CameraRig, nview_linear_triangulations_batch
+from utilsCameraPy3 import nview_linear_triangulations_subsets
+from utilsCameraPy3 import nview_linear_triangulations_ransac
+
+
+def makeCameraParams(nCams, seed=0):
+    # Cameras on a circle around the origin, looking at the origin.
+    rng = np.random.default_rng(seed)
+    CameraParamDict = {}
+    for iCam in range(nCams):
+        angle = 2*np.pi*iCam/nCams + rng.uniform(-.1,.1)
+        center = np.array([3000*np.cos(angle), 3000*np.sin(angle), 
+                           1000 + rng.uniform(-100,100)])
+        zAxis = -center / np.linalg.norm(center)
+        xAxis = np.cross(zAxis, np.array([0,0,1]))
+        xAxis /= np.linalg.norm(xAxis)
+        yAxis = np.cross(zAxis, xAxis)
+        R = np.vstack((xAxis, yAxis, zAxis))
+        K = np.array([[1400., 0, 540], [0, 1400., 960], [0, 0, 1]])
+        CameraParamDict['Cam' + str(iCam)] = {
+            'intrinsicMat': K, 'rotation': R, 
+            'translation': -R.dot(center)[:,None],
+            'distortion': np.zeros((1,5)),
+            'imageSize': np.array([[1920],[1080]]),
+            'rotation_EulerAngles': cv2.Rodrigues(R)[0]}
+    return CameraParamDict
+
+def projectPoints(CameraParamDict, points3D, noise=0, seed=0):
+    # points3D: 3 x nMkrs x nFrames. Returns dict of nMkrs x nFrames x 2.
+    rng = np.random.default_rng(seed)
+    keypoints2D = {}
+    for camName, camParams in CameraParamDict.items():
+        P = camParams['intrinsicMat'].dot(np.hstack(
+            (camParams['rotation'], camParams['translation'])))
+        X = np.vstack((points3D.reshape(3,-1), np.ones((1,points3D[0].size))))
+        x = P.dot(X)
+        x = (x[:2] / x[2]).reshape((2,) + points3D.shape[1:])
+        keypoints2D[camName] = (np.moveaxis(x, 0, -1) + 
+                                noise*rng.standard_normal(x.shape[1:]+(2,)))
+    return keypoints2D
+
+def makeTrial(nCams=4, nMkrs=25, nFrames=30, seed=0):
+    rng = np.random.default_rng(seed)
+    CameraParamDict = makeCameraParams(nCams, seed)
+    points3D = rng.uniform(-500, 500, (3, nMkrs, nFrames))
+    keypoints2D = projectPoints(CameraParamDict, points3D, noise=1, seed=seed)
+    confidence = {}
+    for camName in CameraParamDict:
+        conf = rng.uniform(0.3, 1, (nMkrs, nFrames))
+        conf[rng.uniform(size=conf.shape) < 0.1] = 0
+        conf[rng.uniform(size=conf.shape) < 0.05] = np.nan
+        confidence[camName] = conf
+    return CameraParamDict, keypoints2D, confidence, points3D
+
+
+class TestBatchTriangulation:
+
+    def test_matches_frame_by_frame(self):
+        CameraParamDict, keypoints2D, confidence, _ = makeTrial()
+        # Force some markers to be seen by less than 2 cameras.
+        confidence['Cam0'][3, :5] = 0
+        confidence['Cam1'][3, :5] = 0
+        confidence['Cam2'][3, :5] = 0
+        confidence['Cam3'][4, :5] = np.nan
+        confidence['Cam2'][4, :5] = np.nan
+        confidence['Cam1'][4, :5] = 0
+        confidence['Cam0'][4, :5] = 0
+        
+        points3D, confidence3D = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False)
+        points3D_b, confidence3D_b = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False, batchTriangulation=True)
+        
+        np.testing.assert_allclose(points3D_b, points3D, atol=1e-6)
+        np.testing.assert_allclose(confidence3D_b, confidence3D)
+        assert np.all(points3D_b[:,3,:5] == 0)
+        assert np.all(confidence3D_b[0,3,:5] == 0)
+        assert np.all(confidence3D_b[0,4,:5] == 0.5)
+
+    def test_unweighted(self):
+        CameraParamDict, keypoints2D, _, points3D = makeTrial(nCams=3)
+        points3D_b, confidence3D_b = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, trimTrial=False,
+            batchTriangulation=True)
+        np.testing.assert_allclose(points3D_b, points3D, atol=10)
+        assert np.all(confidence3D_b == 1)
+
+
+class TestCameraRig:
+
+    def test_project_and_undistort(self):
+        CameraParamDict, keypoints2D, _, points3D = makeTrial(nFrames=5)
+        for iCam, camName in enumerate(CameraParamDict):
+            CameraParamDict[camName]['distortion'] = np.array(
+                [[0.05*iCam, -0.01, 0.001, 0, 0]])
+        rig = CameraRig(CameraParamDict)
+        assert rig.names == list(CameraParamDict)
+        
+        projected = rig.project(points3D)
+        for iCam, camName in enumerate(rig):
+            np.testing.assert_allclose(projected[iCam], keypoints2D[camName],
+                                       atol=5)
+        
+        pointList = [keypoints2D[camName] for camName in rig]
+        undistorted = undistort2Dkeypoints(pointList, rig)
+        for iCam, camName in enumerate(rig):
+            for iFrame in range(pointList[iCam].shape[1]):
+                ref = undistort2Dkeypoints(
+                    [pointList[iCam][:,iFrame,None,:]], 
+                    [CameraParamDict[camName]])[0]
+                np.testing.assert_allclose(undistorted[iCam][:,iFrame,:], 
+                                           ref[:,0,:])
+        
+        subRig = rig.subset(['Cam2', 'Cam0'])
+        np.testing.assert_array_equal(subRig.P, rig.P[[2,0]])
+        assert subRig.cameras[1] is rig.cameras[0]
+
+
+class TestBatchReprojectionError:
+
+    def test_matches_per_frame(self):
+        CameraParamDict, keypoints2D, confidence, points3D = makeTrial(nFrames=4)
+        rig = CameraRig(CameraParamDict)
+        points2D = np.stack([keypoints2D[camName] for camName in rig])
+        weights = np.nan_to_num(np.stack([confidence[camName] for camName in rig]))
+        
+        reprojErrors = calcReprojectionErrorBatch(
+            rig, points2D, points3D, weights=weights, normalizeError=True)
+        assert reprojErrors.shape == weights.shape
+        for iFrame in range(points3D.shape[2]):
+            pointsInput = [points2D[:,iMkr,iFrame,:].T 
+                           for iMkr in range(points2D.shape[1])]
+            ref = calcReprojectionError(
+                rig.cameras, pointsInput, points3D[:,:,iFrame],
+                weights=[w[None,:,iFrame] for w in weights], normalizeError=True)
+            np.testing.assert_allclose(
+                np.mean(reprojErrors[:,:,iFrame],axis=0), ref)
+
+
+class TestSubsetTriangulation:
+
+    def test_matches_brute_force(self):
+        CameraParamDict, keypoints2D, confidence, points3D = makeTrial(
+            nCams=5, nMkrs=10, nFrames=6)
+        # Outliers in one camera.
+        keypoints2D['Cam3'][:5] += 150
+        rig = CameraRig(CameraParamDict)
+        P = rig.P
+        points2D = np.stack([keypoints2D[camName] for camName in rig]).reshape(5,-1,2)
+        weights = np.stack([confidence[camName] for camName in rig]).reshape(5,-1)
+        
+        world, best, subsets = nview_linear_triangulations_subsets(
+            P, points2D, weights=weights, chunk_size=200)
+        assert subsets[0] == tuple(range(5)) and len(subsets) == 26
+        
+        # Brute force: triangulate with every subset, then compare errors.
+        errors = []
+        worlds = []
+        wErr = np.nan_to_num(weights, nan=0.5)
+        for subset in subsets:
+            subset = list(subset)
+            X, _ = nview_linear_triangulations_batch(
+                P[subset], points2D[subset], weights=weights[subset])
+            e = np.mean(calcReprojectionErrorBatch(
+                rig, points2D, X, weights=wErr), axis=0)
+            e[np.count_nonzero(weights[subset], axis=0) < 2] = np.inf
+            errors.append(e)
+            worlds.append(X)
+        bestRef = np.argmin(np.nan_to_num(errors, nan=np.inf), axis=0)
+        valid = np.count_nonzero(weights, axis=0) >= 2
+        np.testing.assert_array_equal(best[valid], bestRef[valid])
+        np.testing.assert_allclose(
+            world[:,valid], np.stack(worlds,axis=1)[:,bestRef,np.arange(len(bestRef))][:,valid], 
+            atol=1e-6)
+        
+        # The outlier camera is not used for the corrupted markers.
+        corrupted = np.zeros((10,6), bool)
+        corrupted[:5] = True
+        corrupted = corrupted.flatten() & valid & (weights[3] != 0)
+        assert all(3 not in subsets[i] for i in best[corrupted])
+        np.testing.assert_allclose(world[:,corrupted], 
+                                   points3D.reshape(3,-1)[:,corrupted], atol=10)
+
+
+class TestRansacTriangulation:
+
+    def test_rejects_outlier_camera(self):
+        CameraParamDict, keypoints2D, confidence, points3D = makeTrial(
+            nCams=6, nMkrs=10, nFrames=6)
+        for camName in confidence:
+            confidence[camName] = np.ones_like(confidence[camName])
+        keypoints2D['Cam1'][:5] += 200
+        
+        points3D_r, _ = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False, batchTriangulation=True, ransac=True)
+        np.testing.assert_allclose(points3D_r, points3D, atol=10)
+        
+        # Deterministic and same as the frame-by-frame path.
+        points3D_f, _ = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False, ransac=True)
+        np.testing.assert_allclose(points3D_f, points3D_r, atol=1e-6)
+
+    def test_occluded_views(self):
+        CameraParamDict, keypoints2D, _, points3D = makeTrial(
+            nCams=6, nMkrs=10, nFrames=6)
+        rig = CameraRig(CameraParamDict)
+        points2D = np.stack([keypoints2D[camName] for camName in rig])
+        points2D[1] += 200
+        # Markers occluded in Cam0 and Cam2, only the pairs of Cam3-5 are
+        # all-inlier hypotheses.
+        weights = np.ones(points2D.shape[:3])
+        weights[[0,2]] = 0
+        world, inliers = nview_linear_triangulations_ransac(
+            rig.P, points2D.reshape(6,-1,2), weights=weights.reshape(6,-1))
+        np.testing.assert_allclose(world, points3D.reshape(3,-1), atol=10)
+        assert np.all(inliers[3:]) and not np.any(inliers[:3])
+
+
+class TestTriangulationRefinement:
+
+    def test_reduces_reprojection_error(self):
+        CameraParamDict, keypoints2D, confidence, points3D = makeTrial()
+        points3D_lin, _ = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False, batchTriangulation=True)
+        points3D_ref, _ = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False, batchTriangulation=True, refineTriangulation=True)
+        
+        rig = CameraRig(CameraParamDict)
+        points2D = np.stack([keypoints2D[camName] for camName in rig])
+        weights = np.nan_to_num(np.stack([confidence[camName] for camName in rig]), nan=0.5)
+        valid = np.count_nonzero(
+            np.stack([confidence[camName] for camName in rig]), axis=0) >= 2
+        errors = []
+        for points in [points3D_lin, points3D_ref]:
+            e = calcReprojectionErrorBatch(rig, points2D, points, weights=weights)
+            errors.append(np.sum(e[:,valid]**2))
+        assert errors[1] < errors[0]
+        # Points seen by less than 2 cameras are left untouched.
+        np.testing.assert_array_equal(points3D_ref[:,~valid], points3D_lin[:,~valid])
+        np.testing.assert_allclose(points3D_ref, points3D_lin, atol=5)
+
+    def test_keeps_views_rejected_by_ransac(self):
+        CameraParamDict, keypoints2D, confidence, points3D = makeTrial(
+            nCams=6, nMkrs=10, nFrames=6)
+        for camName in confidence:
+            confidence[camName] = np.ones_like(confidence[camName])
+        keypoints2D['Cam1'][:5] += 200
+        
+        points3D_b, _ = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False, batchTriangulation=True, ransac=True,
+            refineTriangulation=True)
+        np.testing.assert_allclose(points3D_b, points3D, atol=10)
+        points3D_f, _ = triangulateMultiviewVideo(
+            CameraParamDict, keypoints2D, confidenceDict=confidence,
+            trimTrial=False, ransac=True, refineTriangulation=True)
+        np.testing.assert_allclose(points3D_f, points3D_b, atol=1e-6)
@@ -0,0 +1,79 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+import utilsChecker
+from utilsChecker import getVideoMetadata, getVideoMetadataIndexPath
+
+
+def writeVideo(videoPath, nFrames=12, size=(64, 48), fps=30):
+    video = cv2.VideoWriter(videoPath, cv2.VideoWriter_fourcc(*'MJPG'), fps,
+                            size)
+    for c_frame in range(nFrames):
+        video.write(np.full((size[1], size[0], 3), 10*c_frame, np.uint8))
+    video.release()
+
+
+class TestVideoMetadata:
+
+    def test_probed_once_and_persisted(self, tmp_path, monkeypatch):
+        videoPath = str(tmp_path / 'trial.avi')
+        writeVideo(videoPath)
+        probes = []
+        probe = utilsChecker.probeVideoMetadataOpenCV
+        monkeypatch.setattr(utilsChecker, 'probeVideoMetadataOpenCV',
+                            lambda path: probes.append(path) or probe(path))
+
+        metadata = getVideoMetadata(videoPath)
+        assert metadata == {'fps': 30, 'frameCount': 12, 'width': 64,
+                            'height': 48}
+        assert getVideoMetadata(videoPath) == metadata
+        assert len(probes) == 1
+
+        # Persisted next to the video, e.g., for the next process.
+        with open(getVideoMetadataIndexPath(videoPath)) as f:
+            assert json.load(f)['trial.avi']['opencv'] == metadata
+        monkeypatch.setattr(utilsChecker, 'videoMetadataCache', {})
+        assert getVideoMetadata(videoPath) == metadata
+        assert len(probes) == 1
+
+        # A rewritten video is probed again.
+        writeVideo(videoPath, nFrames=20)
+        os.utime(videoPath, ns=(1, 1))
+        assert getVideoMetadata(videoPath)['frameCount'] == 20
+        assert len(probes) == 2
+
+    def test_rotation_without_orientation_tag(self, tmp_path, monkeypatch):
+        meta = {'format': {'format_name': 'mov,mp4', 'duration': '2.5'},
+                'streams': [{'codec_type': 'video', 'width': 1920,
+                             'height': 1080}]}
+        monkeypatch.setattr(utilsChecker.ffmpeg, 'probe',
+                            lambda *args, **kwargs: meta)
+        # Untagged landscape mp4: intrinsics are not rotated, the pose
+        # detector resolution is landscape.
+        assert utilsChecker.probeVideoMetadataFFprobe('trial.mp4') == {
+            'duration': 2.5, 'rotation': 90, 'frameOrientation': 0,
+            'displayRotation': 0}
+        videoPath = str(tmp_path / 'trial.mp4')
+        open(videoPath, 'w').close()
+        CamParams = {'intrinsicMat': np.array([[1400., 0, 960], 
+                                               [0, 1400., 540], [0, 0, 1]]),
+                     'imageSize': np.array([[1080], [1920]])}
+        K = CamParams['intrinsicMat'].copy()
+        CamParams = utilsChecker.rotateIntrinsics(CamParams, videoPath)
+        np.testing.assert_array_equal(CamParams['intrinsicMat'], K)
+        # Displayed upright.
+        meta['streams'][0]['side_data_list'] = [{'rotation': -90}]
+        assert utilsChecker.probeVideoMetadataFFprobe('trial.mp4')[
+            'frameOrientation'] == 90
+        # Rewritten AVI copy.
+        meta['format']['format_name'] = 'avi'
+        del meta['streams'][0]['side_data_list']
+        assert utilsChecker.probeVideoMetadataFFprobe('trial_rotated.avi')[
+            'rotation'] == 0
+        meta['format']['tags'] = {
+            'com.apple.quicktime.video-orientation': '180'}
+        assert utilsChecker.probeVideoMetadataFFprobe('trial.mov')[
+            'rotation'] == 180
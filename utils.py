@@ -11,12 +11,15 @@ import glob
 import mimetypes
 import subprocess
 import zipfile
+import struct
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import numpy as np
 import pandas as pd
 from scipy import signal
+from scipy.ndimage import gaussian_filter1d
 from urllib3.util.retry import Retry
 
 from utilsAuth import getToken
@@ -953,6 +956,7 @@ def getPosePickles(trial_id,session_path, poseDetector='OpenPose',
                 os.makedirs(posePickleDir,exist_ok=True)
                 posePicklePath = os.path.join(posePickleDir,trialPrefix)
                 download_file(url,posePicklePath)
+                convertPosePklToArrays(posePicklePath)
 
 def checkAndGetPosePickles(trial_id, session_path, poseDetector, resolutionPoseDetection, bbox_thr):
     # Check if the pose pickles for that set of settings exist.
@@ -1148,17 +1152,105 @@ def numpy2storage(labels, data, storage_file):
     f.close() 
       
     
-def lowpassFilter(inputData, filtFreq, order=4):
+def lowpassFilter(inputData, filtFreq, order=4, chunkSize=None):
     # Input is an array of nSteps x (nMeasures +1) because time is the first column
     time = inputData[:,0]
     fs=1/np.mean(np.diff(time))
     wn = filtFreq/(fs/2)
     sos = signal.butter(order/2,wn,btype='low',output='sos')
-    inputDataFilt = signal.sosfiltfilt(sos,inputData[:,1:],axis=0)    
+    if chunkSize is None:
+        inputDataFilt = signal.sosfiltfilt(sos,inputData[:,1:],axis=0)
+    else:
+        inputDataFilt = sosfiltfiltChunked(sos,inputData[:,1:],axis=0,
+                                           chunkSize=chunkSize)
     data = np.concatenate((np.expand_dims(time,1), inputDataFilt), axis=1)
 
     return data
 
+# %% Chunked zero-phase filtering.
+# Equivalent of scipy.signal.sosfiltfilt (odd padding, steady-state initial
+# conditions) that only reads chunkSize samples of data at a time along axis.
+# The forward pass carries the filter state from one block to the next and
+# writes into out, the backward pass then runs over out in reverse block
+# order, so the result matches whole-array filtering to round-off. data and
+# out can be np.memmap arrays (eg. np.load(..., mmap_mode='r') and
+# np.lib.format.open_memmap) for recordings that do not fit in memory.
+def sosfiltfiltChunked(sos, data, axis=-1, chunkSize=10000, out=None):
+
+    sos = np.atleast_2d(sos)
+    nSamples = data.shape[axis]
+    nSections = sos.shape[0]
+    padLen = 3 * (2 * nSections + 1 - min((sos[:, 2] == 0).sum(),
+                                          (sos[:, 5] == 0).sum()))
+    if nSamples <= padLen:
+        raise ValueError('The length of the input must be greater than ' +
+                         str(padLen) + ' samples.')
+    chunkSize = max(int(chunkSize), 1)
+
+    # Work on views with the filtered axis first.
+    dataT = np.moveaxis(data, axis, 0)
+    if out is None:
+        out = np.empty(data.shape, dtype=np.result_type(data.dtype, float))
+    outT = np.moveaxis(out, axis, 0)
+
+    # Odd extensions at both ends, as in sosfiltfilt(padtype='odd').
+    first = np.asarray(dataT[0], dtype=float)
+    last = np.asarray(dataT[-1], dtype=float)
+    extStart = 2 * first - np.asarray(dataT[padLen:0:-1], dtype=float)
+    extEnd = 2 * last - np.asarray(dataT[-2:-padLen-2:-1], dtype=float)
+
+    zi = signal.sosfilt_zi(sos)
+    zi = np.reshape(zi, zi.shape[:1] + (1,) * (dataT.ndim - 1) + zi.shape[1:])
+    zi = np.moveaxis(zi, -1, 1)  # (nSections, 2, ...)
+
+    # Forward pass.
+    _, state = signal.sosfilt(sos, extStart, axis=0, zi=zi * extStart[0])
+    for start in range(0, nSamples, chunkSize):
+        stop = min(start + chunkSize, nSamples)
+        outT[start:stop], state = signal.sosfilt(
+            sos, np.asarray(dataT[start:stop], dtype=float), axis=0, zi=state)
+    yEnd, _ = signal.sosfilt(sos, extEnd, axis=0, zi=state)
+
+    # Backward pass, starting from the end of the padded signal.
+    _, state = signal.sosfilt(sos, yEnd[::-1], axis=0, zi=zi * yEnd[-1])
+    for stop in range(nSamples, 0, -chunkSize):
+        start = max(stop - chunkSize, 0)
+        y, state = signal.sosfilt(
+            sos, np.asarray(outT[start:stop][::-1], dtype=float), axis=0,
+            zi=state)
+        outT[start:stop] = y[::-1]
+
+    return out
+
+# %% Chunked gaussian smoothing.
+# Same as scipy.ndimage.gaussian_filter1d (reflect mode, truncate=4) processed
+# in blocks of chunkSize samples along axis. Each block is read with an
+# overlap of the kernel radius on both sides, which is discarded after
+# filtering (overlap-save), so blocks match whole-array filtering exactly.
+def gaussianFilterChunked(data, sigma, axis=-1, chunkSize=10000, out=None):
+
+    nSamples = data.shape[axis]
+    radius = int(4.0 * float(sigma) + 0.5)
+    chunkSize = max(int(chunkSize), 1)
+
+    dataT = np.moveaxis(data, axis, 0)
+    if out is None:
+        out = np.empty(data.shape, dtype=np.result_type(data.dtype, float))
+    outT = np.moveaxis(out, axis, 0)
+
+    for start in range(0, nSamples, chunkSize):
+        stop = min(start + chunkSize, nSamples)
+        readStart = max(start - radius, 0)
+        readStop = min(stop + radius, nSamples)
+        # The reflect boundary at interior block edges only affects samples
+        # within the overlap, the true ends of the signal are reflected as
+        # in the whole-array case.
+        block = np.asarray(dataT[readStart:readStop], dtype=float)
+        blockFilt = gaussian_filter1d(block, sigma, axis=0)
+        outT[start:stop] = blockFilt[start-readStart:stop-readStart]
+
+    return out
+
         
 def TRC2numpy(pathFile, markers,rotation=None):
     # rotation is a dict, eg. {'y':90} with axis, angle for rotation
@@ -1208,8 +1300,93 @@ def getMMposeMarkerNames():
     return markerNames
 
 
+# %% Binary pose store.
+# Pose detections of a video as columnar arrays in an uncompressed .npz next
+# to the _pp.pkl file. keypoints (nDetections x 25 x 3, float32) holds the
+# detections of all frames back to back and frameOffsets (nFrames + 1) the
+# index of the first detection of each frame, ie the people detected in frame
+# i are keypoints[frameOffsets[i]:frameOffsets[i+1]], in the order of the
+# pickle. The arrays are memory-mapped when loading.
+def getPoseArraysPath(ppPklPath):
+    
+    return os.path.splitext(ppPklPath)[0] + '.npz'
+
+def poseFramesToArrays(frames, nKeypoints=25):
+    # frames: one list per frame of dicts with 'pose_keypoints_2d', as in the
+    # _pp.pkl files.
+    
+    counts = [len(frame) for frame in frames]
+    frameOffsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    keypoints = np.reshape(np.array(
+        [person['pose_keypoints_2d'] for frame in frames for person in frame],
+        dtype=np.float32), (-1, nKeypoints, 3))
+    
+    return keypoints, frameOffsets
+
+def savePoseArrays(posePath, keypoints, frameOffsets):
+    
+    # Write to a temporary file first, so readers never see a partial file.
+    tmpPath = posePath + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        np.savez(f, keypoints=np.asarray(keypoints, dtype=np.float32),
+                 frameOffsets=np.asarray(frameOffsets, dtype=np.int64))
+    os.replace(tmpPath, posePath)
+    
+    return posePath
+
+def loadPoseArrays(posePath, mmap=True):
+    
+    if not mmap:
+        with np.load(posePath) as data:
+            return data['keypoints'], data['frameOffsets']
+    
+    # Members of an uncompressed .npz are .npy files stored as is, so they
+    # can be memory-mapped from their offset in the archive.
+    arrays = {}
+    with zipfile.ZipFile(posePath) as archive, open(posePath, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Cannot memory-map compressed ' + posePath)
+            # The data follows the local file header of the member.
+            f.seek(info.header_offset)
+            localHeader = f.read(30)
+            nameLength, extraLength = struct.unpack('<HH', localHeader[26:30])
+            f.seek(info.header_offset + 30 + nameLength + extraLength)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortranOrder, dtype = (
+                    np.lib.format.read_array_header_1_0(f))
+            else:
+                shape, fortranOrder, dtype = (
+                    np.lib.format.read_array_header_2_0(f))
+            name = os.path.splitext(info.filename)[0]
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    posePath, dtype=dtype, mode='r', offset=f.tell(),
+                    shape=shape, order='F' if fortranOrder else 'C')
+    
+    return arrays['keypoints'], arrays['frameOffsets']
+
+# Converts an existing _pp.pkl file to the binary pose store.
+def convertPosePklToArrays(ppPklPath):
+    
+    with open(ppPklPath, 'rb') as f:
+        frames = pickle.load(f)
+    # Raw mmpose pickles (see runMMposeVideo) are not converted.
+    if any('pose_keypoints_2d' not in person 
+           for frame in frames for person in frame):
+        return None
+    
+    return savePoseArrays(getPoseArraysPath(ppPklPath), 
+                          *poseFramesToArrays(frames))
+
+
 def rewriteVideos(inputPath,startFrame,nFrames,frameRate,outputDir=None,
-                  imageScaleFactor = .5,outputFileName=None):
+                  imageScaleFactor = .5,outputFileName=None,preset=None):
+    # preset is the x264 preset used when the video is re-encoded (scaled),
+    # e.g. 'veryfast'. The video is stream-copied if imageScaleFactor is None.
         
     inputDir, vidName = os.path.split(inputPath)
     vidName, vidExt = os.path.splitext(vidName)
@@ -1226,6 +1403,8 @@ def rewriteVideos(inputPath,startFrame,nFrames,frameRate,outputDir=None,
     if imageScaleFactor is not None:
         imageScaleArg = '-vf scale=iw/{:.0f}:-1'.format(1/imageScaleFactor)
         maintainQualityArg = ''
+        if preset is not None:
+            maintainQualityArg = '-preset {}'.format(preset)
 
     startTime = startFrame/frameRate
 
@@ -1235,10 +1414,45 @@ def rewriteVideos(inputPath,startFrame,nFrames,frameRate,outputDir=None,
                 startTime, inputPath, maintainQualityArg, 
                 nFrames, imageScaleArg, outputFullPath).rstrip().replace("  ", " ")
 
-    subprocess.run(ffmpegCmd.split(" "))
+    subprocess.run(ffmpegCmd.split(" "), check=True)
     
     return
 
+# %%
+# Videos rewritten in the background (e.g., synchronized visualizer videos),
+# by a bounded pool of ffmpeg processes. This lets cameras be written in
+# parallel and lets the trial continue meanwhile. waitForVideoRewrites
+# blocks until all submitted videos are written, then raises the first
+# rewrite error, unless raiseErrors is False (e.g., an exception is already
+# being handled, in which case the errors are logged).
+videoRewriteExecutor = None
+videoRewriteFutures = []
+
+def rewriteVideosAsync(*args, nWorkers=None, **kwargs):
+    
+    global videoRewriteExecutor
+    if videoRewriteExecutor is None:
+        if nWorkers is None:
+            nWorkers = min(4, os.cpu_count() or 1)
+        videoRewriteExecutor = ThreadPoolExecutor(max_workers=nWorkers)
+    future = videoRewriteExecutor.submit(rewriteVideos, *args, **kwargs)
+    videoRewriteFutures.append(future)
+    
+    return future
+
+def waitForVideoRewrites(raiseErrors=True):
+    
+    futures = list(videoRewriteFutures)
+    wait(futures)
+    del videoRewriteFutures[:len(futures)]
+    
+    errors = [future.exception() for future in futures 
+              if future.exception() is not None]
+    for error in errors:
+        print('Video rewrite failed: {}'.format(error))
+    if errors and raiseErrors:
+        raise errors[0]
+
 # %%  Found here: https://github.com/chrisdembia/perimysium/ => thanks Chris
 def storage2numpy(storage_file, excess_header_entries=0):
     """Returns the data from a storage file in a numpy format. Skips all lines
@@ -8,6 +8,9 @@ from scipy.special import cbrt
 from scipy.interpolate import griddata
 from scipy.optimize import minimize_scalar
 from warnings import warn
+from collections.abc import Mapping
+import itertools
+import time
 
 try:
     import cv2
@@ -795,6 +798,157 @@ class Camera:
         return np.transpose(null_space)
 
 
+class CameraRig(Mapping):
+    """
+    Calibrated multi-camera rig
+        - built once per trial from the OpenCap camera parameter dicts
+          (intrinsicMat, distortion, rotation, translation, imageSize)
+        - stacked K, R, t and P matrices as contiguous arrays
+        - pinhole Camera objects, constructed once and shared by subsets
+        - batched projection and undistortion of image points
+    Behaves like a read-only dict of camera parameters keyed by camera name,
+    so it can be passed where a CamParamDict is expected.
+    """
+
+    def __init__(self, camera_params, names=None, use_rotation_euler=False):
+        """
+        :param camera_params: camera parameters
+        :type camera_params: dict {name: params} or sequence of params dicts
+        :param names: camera names, if camera_params is a sequence
+        :type names: sequence of str
+        :param use_rotation_euler: build rotation matrices from the
+                                   rotation_EulerAngles (Rodrigues) entries
+        :type use_rotation_euler: bool
+        """
+        if isinstance(camera_params, Mapping):
+            names = list(camera_params.keys())
+            camera_params = list(camera_params.values())
+        elif names is None:
+            names = ['Cam' + str(i) for i in range(len(camera_params))]
+        assert(len(names) == len(camera_params))
+        assert(len(camera_params) > 0)
+        self.names = list(names)
+        self.params = list(camera_params)
+
+        self.K = np.ascontiguousarray(
+            np.stack([p['intrinsicMat'] for p in self.params]), dtype=float)
+        if use_rotation_euler:
+            self.R = np.stack([cv2.Rodrigues(p['rotation_EulerAngles'])[0]
+                               for p in self.params])
+        else:
+            self.R = np.stack([p['rotation'] for p in self.params])
+        self.R = np.ascontiguousarray(self.R, dtype=float)
+        self.t = np.ascontiguousarray(
+            np.stack([np.reshape(p['translation'], (3, 1))
+                      for p in self.params]), dtype=float)
+        self.P = np.ascontiguousarray(
+            np.matmul(self.K, np.concatenate((self.R, self.t), axis=2)))
+        if all('distortion' in p for p in self.params):
+            self.distortion = [np.asarray(p['distortion'], dtype=float)
+                               for p in self.params]
+        else:
+            self.distortion = None
+        if all('imageSize' in p for p in self.params):
+            self.image_size = np.stack([np.ravel(p['imageSize'])
+                                        for p in self.params])
+        else:
+            self.image_size = None
+
+        self.cameras = []
+        for K, R, t in zip(self.K, self.R, self.t):
+            c = Camera()
+            c.set_K(K)
+            c.set_R(R)
+            c.set_t(t)
+            self.cameras.append(c)
+
+    def __getitem__(self, key):
+        """
+        Camera parameters dict by camera name or camera index.
+        """
+        if isinstance(key, (int, np.integer)):
+            return self.params[key]
+        return self.params[self.names.index(key)]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, key):
+        """
+        Index of a camera given its name or index.
+        """
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        return self.names.index(key)
+
+    def subset(self, keys):
+        """
+        Rig with a subset of the cameras. Arrays and Camera objects are
+        sliced, not rebuilt.
+        :param keys: camera names or indices
+        :type keys: sequence of str or int
+        :return: rig with selected cameras, in the order of keys
+        :rtype: CameraRig
+        """
+        idx = [self.index(k) for k in keys]
+        rig = CameraRig.__new__(CameraRig)
+        rig.names = [self.names[i] for i in idx]
+        rig.params = [self.params[i] for i in idx]
+        rig.K = self.K[idx]
+        rig.R = self.R[idx]
+        rig.t = self.t[idx]
+        rig.P = self.P[idx]
+        if self.distortion is not None:
+            rig.distortion = [self.distortion[i] for i in idx]
+        else:
+            rig.distortion = None
+        if self.image_size is not None:
+            rig.image_size = self.image_size[idx]
+        else:
+            rig.image_size = None
+        rig.cameras = [self.cameras[i] for i in idx]
+        return rig
+
+    def project(self, world):
+        """
+        Project world points to the (undistorted) image of every camera.
+        :param world: world points
+        :type world: numpy.ndarray, shape=(3, ...)
+        :return: image coordinates
+        :rtype: numpy.ndarray, shape=(n, ..., 2)
+        """
+        shape = world.shape[1:]
+        X = np.reshape(world, (3, -1))
+        x = np.matmul(self.P[:, :, 0:3], X) + self.P[:, :, 3:4]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xy = x[:, 0:2, :] / x[:, 2:3, :]
+        return np.reshape(np.moveaxis(xy, 1, -1), (len(self),) + shape + (2,))
+
+    def undistort_points(self, image_points, use_K_as_P=True):
+        """
+        Undistort image points of every camera, one OpenCV call per camera.
+        :param image_points: distorted image coordinates
+        :type image_points: sequence of n numpy.ndarray, shape=(..., 2)
+        :param use_K_as_P: return pixel coordinates (P=K) instead of
+                           normalized coordinates
+        :type use_K_as_P: bool
+        :return: undistorted image coordinates
+        :rtype: list of n numpy.ndarray, shape=(..., 2)
+        """
+        assert(self.distortion is not None)
+        undistorted = []
+        for K, dist, points in zip(self.K, self.distortion, image_points):
+            points = np.asarray(points, dtype=float)
+            P = K if use_K_as_P else None
+            res = cv2.undistortPoints(np.reshape(points, (-1, 1, 2)), K, dist,
+                                      P=P)
+            undistorted.append(np.reshape(res, points.shape))
+        return undistorted
+
+
 def nview_linear_triangulation(cameras, correspondences,weights = None):
     """
     Computes ONE world coordinate from image correspondences in n views.
@@ -882,6 +1036,453 @@ def nview_linear_triangulations(cameras, image_points,weights=None):
     return world,confidence
 
 
+def construct_D_blocks(P, image_points, weights=None):
+    """
+    Constructs the weighted 2 rows blocks of matrix D for all views and all
+    correspondences at once. Same blocks as in nview_linear_triangulation,
+    nan weights are turned into 0.5.
+    :param P: camera matrices of n views
+    :type P: numpy.ndarray, shape=(n, 3, 4)
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param weights: weights of the correspondences in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :return: blocks of matrix D
+    :rtype: numpy.ndarray, shape=(n, m, 2, 4)
+    """
+    assert(P.shape[1:] == (3, 4))
+    assert(image_points.shape[0] == P.shape[0])
+    assert(image_points.shape[2] == 2)
+
+    # (n, m, 2, 1) * (n, 1, 1, 4) - (n, 1, 2, 4)
+    D = (image_points[:, :, :, np.newaxis] * P[:, np.newaxis, np.newaxis, 2, :] -
+         P[:, np.newaxis, 0:2, :])
+    if weights is not None:
+        w = np.nan_to_num(weights, nan=0.5)  # turns nan confidences into 0.5
+        D = D * w[:, :, np.newaxis, np.newaxis]
+    return D
+
+
+def construct_normal_matrices(P, image_points, weights=None):
+    """
+    Computes the per-view contributions D_i^T D_i to the normal matrix
+    Q = D^T D of the linear triangulation problem. The normal matrix of any
+    subset of views is the sum of the contributions of the views in the subset.
+    :param P: camera matrices of n views
+    :type P: numpy.ndarray, shape=(n, 3, 4)
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param weights: weights of the correspondences in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :return: per-view normal matrices
+    :rtype: numpy.ndarray, shape=(n, m, 4, 4)
+    """
+    D = construct_D_blocks(P, image_points, weights)
+    return np.einsum('nmki,nmkj->nmij', D, D)
+
+
+def solve_normal_matrices(Q):
+    """
+    Solves a stack of linear triangulation problems given their normal
+    matrices, ie finds the right singular vector of D corresponding to the
+    smallest singular value (eigenvector of Q with smallest eigenvalue).
+    :param Q: normal matrices
+    :type Q: numpy.ndarray, shape=(..., 4, 4)
+    :return: world coordinates
+    :rtype: numpy.ndarray, shape=(3, ...)
+    """
+    _, v = np.linalg.eigh(Q)
+    X = np.moveaxis(v[..., :, 0], -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return X[0:3] / X[3]
+
+
+def linear_triangulation_confidence(weights):
+    """
+    Confidence of linearly triangulated points, same as in
+    nview_linear_triangulation: mean of the non-zero weights, 0.5 if all
+    non-zero weights are nan, and 0 if less than 2 views have non-zero weights.
+    :param weights: weights of the correspondences in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :return: confidence of the m triangulated points
+    :rtype: numpy.ndarray, shape=(m,)
+    """
+    nonZero = weights != 0  # nans count as non-zero, as in np.count_nonzero
+    nNonZero = np.count_nonzero(nonZero, axis=0)
+    nonNan = nonZero & ~np.isnan(weights)
+    nNonNan = np.count_nonzero(nonNan, axis=0)
+    sumNonNan = np.sum(np.where(nonNan, weights, 0), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidence = np.where(nNonNan > 0, sumNonNan / nNonNan, 0.5)
+    confidence[nNonZero < 2] = 0
+    return confidence
+
+
+def fundamental_matrix(P1, P2):
+    """
+    Fundamental matrix F between two views, such that x2.T F x1 = 0 for
+    corresponding image points x1 and x2 in homogeneous coordinates.
+    :param P1: camera matrix of the first view
+    :type P1: numpy.ndarray, shape=(3, 4)
+    :param P2: camera matrix of the second view
+    :type P2: numpy.ndarray, shape=(3, 4)
+    :return: fundamental matrix
+    :rtype: numpy.ndarray, shape=(3, 3)
+    """
+    # Center of the first camera (null space of P1) seen in the second view.
+    _, _, Vt = np.linalg.svd(P1)
+    epipole = P2.dot(Vt[-1])
+    epipole_cross = np.array([[0, -epipole[2], epipole[1]],
+                              [epipole[2], 0, -epipole[0]],
+                              [-epipole[1], epipole[0], 0]])
+    return epipole_cross.dot(P2).dot(np.linalg.pinv(P1))
+
+
+def symmetric_epipolar_distances(F, points1, points2):
+    """
+    Mean of the distances of points2 to the epipolar lines of points1 and of
+    points1 to the epipolar lines of points2. Points are broadcast against
+    each other.
+    :param F: fundamental matrix from view 1 to view 2
+    :type F: numpy.ndarray, shape=(3, 3)
+    :param points1: image points in view 1
+    :type points1: numpy.ndarray, shape=(..., 2)
+    :param points2: image points in view 2
+    :type points2: numpy.ndarray, shape=(..., 2)
+    :return: symmetric epipolar distances in pixels
+    :rtype: numpy.ndarray, shape=broadcast shape of points1 and points2 without the last axis
+    """
+    x1 = np.concatenate((points1, np.ones(points1.shape[:-1] + (1,))), axis=-1)
+    x2 = np.concatenate((points2, np.ones(points2.shape[:-1] + (1,))), axis=-1)
+    lines2 = x1.dot(F.T)  # epipolar lines in view 2
+    lines1 = x2.dot(F)  # epipolar lines in view 1
+    algebraic = np.abs(np.sum(x2 * lines2, axis=-1))
+    return 0.5 * (algebraic / np.linalg.norm(lines2[..., :2], axis=-1) +
+                  algebraic / np.linalg.norm(lines1[..., :2], axis=-1))
+
+
+def nview_linear_triangulations_batch(P, image_points, weights=None,
+                                      chunk_size=100000):
+    """
+    Computes world coordinates from image correspondences in n views, for
+    all correspondences at once. Gives the same results as
+    nview_linear_triangulations, but without per-point Python loops.
+    :param P: camera matrices of n views
+    :type P: numpy.ndarray, shape=(n, 3, 4)
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param weights: weights of the correspondences in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :param chunk_size: number of correspondences processed at once, bounds
+                       memory use for long trials
+    :type chunk_size: int
+    :return: m world coordinates and their confidence
+    :rtype: tuple(numpy.ndarray, shape=(3, m), numpy.ndarray, shape=(m,))
+    """
+    P = np.asarray(P, dtype=float)
+    image_points = np.asarray(image_points, dtype=float)
+    assert(P.shape[0] >= 2)
+    nPoints = image_points.shape[1]
+    if weights is None:
+        w = np.ones(image_points.shape[:2])
+    else:
+        w = np.asarray(weights, dtype=float)
+
+    world = np.zeros((3, nPoints))
+    for start in range(0, nPoints, chunk_size):
+        idx = slice(start, min(start + chunk_size, nPoints))
+        Q = construct_normal_matrices(P, image_points[:, idx], w[:, idx])
+        world[:, idx] = solve_normal_matrices(Q.sum(axis=0))
+
+    confidence = linear_triangulation_confidence(w)
+    # return 0s if there aren't at least 2 cameras with confidence
+    world[:, np.count_nonzero(w, axis=0) < 2] = 0
+    return world, confidence
+
+
+def view_subsets(n, min_views=2):
+    """
+    Lists all subsets of n views with at least min_views views, from the full
+    set down to the smallest subsets.
+    :param n: number of views
+    :type n: int
+    :param min_views: minimum number of views in a subset
+    :type min_views: int
+    :return: subsets of view indices
+    :rtype: list of tuple
+    """
+    subsets = []
+    for k in range(n, min_views - 1, -1):
+        subsets += list(itertools.combinations(range(n), k))
+    return subsets
+
+
+def nview_linear_triangulations_subsets(P, image_points, weights=None,
+                                        min_views=2, chunk_size=500000):
+    """
+    Triangulates each correspondence with every subset of views and keeps,
+    per correspondence, the subset whose point has the smallest mean
+    weighted reprojection error in all n views. The per-view normal matrices
+    are computed once and the normal matrix of a subset is their sum, so all
+    subsets of all correspondences are solved without re-triangulating.
+    :param P: camera matrices of n views
+    :type P: numpy.ndarray, shape=(n, 3, 4)
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param weights: weights of the correspondences in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :param min_views: minimum number of views in a subset
+    :type min_views: int
+    :param chunk_size: number of (subset, correspondence) pairs processed at
+                       once, bounds memory use for large rigs and long trials
+    :type chunk_size: int
+    :return: m world coordinates, index of the selected subset of each
+             correspondence, and the list of subsets
+    :rtype: tuple(numpy.ndarray, shape=(3, m), numpy.ndarray, shape=(m,), list)
+    """
+    P = np.asarray(P, dtype=float)
+    image_points = np.asarray(image_points, dtype=float)
+    nViews, nPoints = image_points.shape[:2]
+    assert(nViews >= min_views >= 2)
+    if weights is None:
+        w = np.ones((nViews, nPoints))
+    else:
+        w = np.asarray(weights, dtype=float)
+    wErr = np.abs(np.nan_to_num(w, nan=0.5))
+
+    subsets = view_subsets(nViews, min_views)
+    S = np.zeros((len(subsets), nViews))
+    for i, subset in enumerate(subsets):
+        S[i, list(subset)] = 1
+    nonZero = (w != 0).astype(float)
+
+    world = np.zeros((3, nPoints))
+    best = np.zeros(nPoints, dtype=int)
+    step = max(1, chunk_size // len(subsets))
+    for start in range(0, nPoints, step):
+        idx = slice(start, min(start + step, nPoints))
+        Q = construct_normal_matrices(P, image_points[:, idx], w[:, idx])
+        Xs = solve_normal_matrices(np.einsum('sn,nmij->smij', S, Q))
+
+        # reprojection errors of the points of every subset in all views
+        x = (np.einsum('nij,jsm->nism', P[:, :, 0:3], Xs) +
+             P[:, :, 3, np.newaxis, np.newaxis])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xy = x[:, 0:2] / x[:, 2:3]
+        uv = np.moveaxis(image_points[:, idx], -1, 1)[:, :, np.newaxis, :]
+        error = np.linalg.norm(xy - uv, axis=1) * wErr[:, np.newaxis, idx]
+        error = np.mean(error, axis=0)
+        # subsets with less than 2 views with non-zero weights are degenerate
+        error[np.matmul(S, nonZero[:, idx]) < 2] = np.inf
+        error[np.isnan(error)] = np.inf
+
+        best[idx] = np.argmin(error, axis=0)
+        world[:, idx] = Xs[:, best[idx], np.arange(Xs.shape[2])]
+
+    # return 0s if there aren't at least 2 cameras with confidence
+    world[:, np.count_nonzero(w, axis=0) < 2] = 0
+    return world, best, subsets
+
+
+def nview_linear_triangulations_ransac(P, image_points, weights=None,
+                                      n_iterations=None, error_threshold=20,
+                                      min_inliers=3, seed=0, chunk_size=100000):
+    """
+    RANSAC linear triangulation of all correspondences at once. Hypotheses
+    are triangulated from pairs of views, views whose reprojection error is
+    below error_threshold are inliers, and each correspondence is refit with
+    the views of its largest consensus set. Correspondences whose best
+    consensus set has less than min_inliers views are triangulated with all
+    views. Pairs with a zero-weight view (eg occluded marker) are degenerate
+    and are never used as hypotheses.
+    :param P: camera matrices of n views
+    :type P: numpy.ndarray, shape=(n, 3, 4)
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param weights: weights of the correspondences in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :param n_iterations: number of view pair hypotheses, drawn independently
+                         for each correspondence; None (default) evaluates
+                         all pairs, which is exhaustive and cheap for rigs
+                         of up to ~10 views since hypotheses are batched
+    :type n_iterations: int
+    :param error_threshold: reprojection error (pixels) below which a view is
+                            an inlier
+    :type error_threshold: float
+    :param min_inliers: minimum size of a consensus set
+    :type min_inliers: int
+    :param seed: seed of the random generator drawing the hypotheses (only
+                 used when n_iterations is less than the number of pairs)
+    :type seed: int
+    :param chunk_size: number of correspondences processed at once
+    :type chunk_size: int
+    :return: m world coordinates and inlier mask of the views used for each
+             correspondence
+    :rtype: tuple(numpy.ndarray, shape=(3, m), numpy.ndarray, shape=(n, m))
+    """
+    P = np.asarray(P, dtype=float)
+    image_points = np.asarray(image_points, dtype=float)
+    nViews, nPoints = image_points.shape[:2]
+    assert(nViews >= 2)
+    if weights is None:
+        w = np.ones((nViews, nPoints))
+    else:
+        w = np.asarray(weights, dtype=float)
+    nonZero = w != 0
+
+    pairs = list(itertools.combinations(range(nViews), 2))
+    if n_iterations is None:
+        n_iterations = len(pairs)
+    rng = np.random.default_rng(seed)
+    S = np.zeros((len(pairs), nViews))
+    for i, pair in enumerate(pairs):
+        S[i, list(pair)] = 1
+    pairViews = np.array(pairs)
+
+    world = np.zeros((3, nPoints))
+    inliers = np.zeros((nViews, nPoints), dtype=bool)
+    for start in range(0, nPoints, chunk_size):
+        idx = slice(start, min(start + chunk_size, nPoints))
+        Q = construct_normal_matrices(P, image_points[:, idx], w[:, idx])
+        Xs = solve_normal_matrices(np.einsum('sn,nmij->smij', S, Q))
+
+        # inliers of every hypothesis in all views
+        x = (np.einsum('nij,jsm->nism', P[:, :, 0:3], Xs) +
+             P[:, :, 3, np.newaxis, np.newaxis])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xy = x[:, 0:2] / x[:, 2:3]
+        uv = np.moveaxis(image_points[:, idx], -1, 1)[:, :, np.newaxis, :]
+        error = np.linalg.norm(xy - uv, axis=1)
+        isInlier = (error < error_threshold) & nonZero[:, np.newaxis, idx]
+        nInliers = np.count_nonzero(isInlier, axis=0)
+
+        # hypotheses of each correspondence: pairs of views with non-zero
+        # weights, n_iterations of them drawn at random if there are more
+        valid = (nonZero[pairViews[:, 0], idx] & 
+                 nonZero[pairViews[:, 1], idx])
+        if n_iterations < len(pairs):
+            scores = rng.random(valid.shape)
+            scores[~valid] = np.inf
+            rank = np.argsort(np.argsort(scores, axis=0), axis=0)
+            valid &= rank < n_iterations
+        nInliers[~valid] = -1
+
+        # refit with the largest consensus set
+        best = np.argmax(nInliers, axis=0)
+        consensus = isInlier[:, best, np.arange(len(best))]
+        consensus[:, np.max(nInliers, axis=0) < min_inliers] = True
+        world[:, idx] = solve_normal_matrices(
+            np.einsum('nm,nmij->mij', consensus.astype(float), Q))
+        inliers[:, idx] = consensus & nonZero[:, idx]
+
+    # return 0s if there aren't at least 2 cameras with confidence
+    world[:, np.count_nonzero(w, axis=0) < 2] = 0
+    return world, inliers
+
+
+def refine_triangulations(P, image_points, world, weights=None,
+                          max_iterations=20, time_budget=None,
+                          tolerance=1e-6):
+    """
+    Refines triangulated points by minimizing their weighted reprojection
+    error with Levenberg-Marquardt, for all points at once. The Jacobian is
+    block-diagonal (each point only depends on its own 3 coordinates), so
+    every iteration solves one 3x3 system per point.
+    Points at the origin (less than 2 views) or not finite are not refined.
+    :param P: camera matrices of n views
+    :type P: numpy.ndarray, shape=(n, 3, 4)
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param world: initial world coordinates, eg from linear triangulation
+    :type world: numpy.ndarray, shape=(3, m)
+    :param weights: weights of the correspondences in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :param max_iterations: maximum number of iterations
+    :type max_iterations: int
+    :param time_budget: maximum duration (seconds), None for no limit
+    :type time_budget: float
+    :param tolerance: relative decrease of the cost below which a point
+                      has converged
+    :type tolerance: float
+    :return: refined world coordinates and convergence statistics
+    :rtype: tuple(numpy.ndarray, shape=(3, m), dict)
+    """
+    start = time.time()
+    P = np.asarray(P, dtype=float)
+    image_points = np.asarray(image_points, dtype=float)
+    world = np.array(world, dtype=float)
+    nViews, nPoints = image_points.shape[:2]
+    if weights is None:
+        w = np.ones((nViews, nPoints))
+    else:
+        w = np.abs(np.nan_to_num(np.asarray(weights, dtype=float), nan=0.5))
+
+    def _residuals(X, idx):
+        # weighted residuals (n, k, 2) and projective depths (n, k)
+        x = np.einsum('nij,jk->nki', P[:, :, 0:3], X) + P[:, np.newaxis, :, 3]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = x[:, :, 0:2] / x[:, :, 2:3] - image_points[:, idx]
+        return r * w[:, idx, np.newaxis], x
+
+    def _cost(r):
+        c = np.sum(r**2, axis=(0, 2))
+        return np.where(np.isfinite(c), c, np.inf)
+
+    active = (np.all(np.isfinite(world), axis=0) & np.any(world != 0, axis=0) &
+              (np.count_nonzero(w, axis=0) >= 2))
+    idx = np.flatnonzero(active)
+    r, x = _residuals(world[:, idx], idx)
+    cost = _cost(r)
+    initial_cost = cost.copy()
+    damping = np.full(len(idx), 1e-3)
+    converged = np.zeros(len(idx), dtype=bool)
+    iterations = 0
+    while iterations < max_iterations and not np.all(converged):
+        if time_budget is not None and time.time() - start > time_budget:
+            break
+        iterations += 1
+        sel = np.flatnonzero(~converged)
+        X = world[:, idx[sel]]
+        # Jacobian of the projection: (P_row - uv * P_2) / depth
+        depth = x[:, sel, 2]
+        uv = x[:, sel, 0:2] / depth[:, :, np.newaxis]
+        J = ((P[:, np.newaxis, 0:2, 0:3] -
+              uv[:, :, :, np.newaxis] * P[:, np.newaxis, np.newaxis, 2, 0:3]) /
+             depth[:, :, np.newaxis, np.newaxis])
+        J = J * w[:, idx[sel], np.newaxis, np.newaxis]
+        JtJ = np.einsum('nkai,nkaj->kij', J, J)
+        g = np.einsum('nkai,nka->ki', J, r[:, sel])
+        A = JtJ + damping[sel, np.newaxis, np.newaxis] * (
+            np.eye(3) * np.diagonal(JtJ, axis1=1, axis2=2)[:, np.newaxis, :] +
+            1e-12 * np.eye(3))
+        delta = -np.linalg.solve(A, g[:, :, np.newaxis])[:, :, 0]
+
+        X_new = X + delta.T
+        r_new, x_new = _residuals(X_new, idx[sel])
+        cost_new = _cost(r_new)
+        better = cost_new < cost[sel]
+        accept = sel[better]
+        world[:, idx[accept]] = X_new[:, better]
+        r[:, accept] = r_new[:, better]
+        x[:, accept] = x_new[:, better]
+        converged[accept] = ((cost[accept] - cost_new[better]) <=
+                             tolerance * cost[accept])
+        cost[accept] = cost_new[better]
+        damping[accept] /= 10
+        damping[sel[~better]] *= 10
+        # no decrease possible anymore
+        converged[sel[~better & (damping[sel] > 1e10)]] = True
+
+    n_obs = np.maximum(np.count_nonzero(w[:, idx], axis=0), 1)
+    stats = {'n_points': len(idx),
+             'n_converged': int(np.count_nonzero(converged)),
+             'iterations': iterations,
+             'initial_rms_error': float(np.sqrt(np.mean(initial_cost / n_obs))),
+             'final_rms_error': float(np.sqrt(np.mean(cost / n_obs))),
+             'duration': time.time() - start}
+    return world, stats
+
+
 def calibrate_division_model(line_coordinates, y0, z_n, focal_length=1):
     """
     Calibrate division model by making lines straight.
@@ -18,13 +18,24 @@ from scipy.ndimage import gaussian_filter1d
 from scipy.signal import gaussian, sosfiltfilt, butter, find_peaks
 from scipy.interpolate import pchip_interpolate
 from scipy.spatial.transform import Rotation 
+from scipy.optimize import linear_sum_assignment
 import scipy.linalg
+import scipy.fft
 from itertools import combinations
 import copy
+import time
+import threading
 from utilsCameraPy3 import Camera, nview_linear_triangulations
+from utilsCameraPy3 import nview_linear_triangulations_batch, CameraRig
+from utilsCameraPy3 import nview_linear_triangulations_subsets
+from utilsCameraPy3 import nview_linear_triangulations_ransac, refine_triangulations
+from utilsCameraPy3 import fundamental_matrix, symmetric_epipolar_distances
 from utils import getOpenPoseMarkerNames, getOpenPoseFaceMarkers
-from utils import numpy2TRC, rewriteVideos, delete_multiple_element,loadCameraParameters
-from utils import makeRequestWithRetry
+from utils import numpy2TRC, delete_multiple_element,loadCameraParameters
+from utils import rewriteVideosAsync, waitForVideoRewrites
+from utils import makeRequestWithRetry, getVideoExtension
+from utils import sosfiltfiltChunked, gaussianFilterChunked
+from utils import getPoseArraysPath, loadPoseArrays
 from utilsAPI import getAPIURL
 
 from utilsAuth import getToken
@@ -46,11 +57,7 @@ def download_file(url, file_name):
 
 # %% 
 def getVideoLength(filename):
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1", filename],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        return float(result.stdout)
+        return getVideoMetadata(filename, source='ffprobe')['duration']
 
 # %%
 def video2Images(videoPath, nImages=12, tSingleImage=None, filePrefix='output', skipIfRun=True, outputFolder='default'):
@@ -291,29 +298,191 @@ def saveCameraParameters(filename,CameraParams):
     
     return True
 
+# %%
+# Path of the unrotated copy of a video written before pose detection (see
+# utilsDetector.runOpenPoseVideo).
+def getRotatedVideoPath(videoPath):
+    
+    videoRoot, _ = os.path.splitext(videoPath)
+    
+    return videoRoot + '_rotated.avi'
+
+# %%
+# Rotation (degrees) applied to the frames when the video is displayed, from
+# the display matrix or rotate tag of the video stream. This is not the
+# capture orientation returned by getVideoRotation.
+def getVideoDisplayRotation(videoPath):
+    
+    return getVideoMetadata(videoPath, source='ffprobe')['displayRotation']
+
+# %%
+# Path of the video the pose detector and the functions below decode: the
+# rotated copy if it was written, the original video otherwise.
+def getDecodedVideoPath(videoPath):
+    
+    rotatedPath = getRotatedVideoPath(videoPath)
+    if os.path.exists(rotatedPath):
+        return rotatedPath
+    
+    return videoPath
+
+# %%
+# Opens the video with the frames in their display orientation. The rotated
+# copy is read if it exists, such that frame indices match the pose detection,
+# otherwise the original video is decoded with its rotation applied.
+def openVideo(videoPath):
+    
+    video = cv2.VideoCapture(getDecodedVideoPath(videoPath))
+    if hasattr(cv2, 'CAP_PROP_ORIENTATION_AUTO'):
+        video.set(cv2.CAP_PROP_ORIENTATION_AUTO, 1)
+    
+    return video
+
 #%% 
 def getVideoRotation(videoPath):
     
+    return getVideoMetadata(videoPath, source='ffprobe')['rotation']
+
+# %%
+# Orientation (90: portrait, 0: landscape) of the frames as decoded by the
+# pose detectors, from the size of the displayed frames. Used to orient the pose detection resolution, not the intrinsics
+# (see getVideoRotation).
+def getVideoFrameOrientation(videoPath):
+    
+    return getVideoMetadata(videoPath, source='ffprobe')['frameOrientation']
+
+# %%
+# Metadata of a video from ffprobe: duration (s), capture orientation
+# (getVideoRotation), orientation of the displayed frames
+# (getVideoFrameOrientation) and display rotation (getVideoDisplayRotation).
+def probeVideoMetadataFFprobe(videoPath):
     
     meta = ffmpeg.probe(videoPath)
+    
+    displayRotation = 0
+    videoStreams = [stream for stream in meta['streams'] 
+                    if stream.get('codec_type', 'video') == 'video']
+    if videoStreams:
+        displayRotation = videoStreams[0].get('tags', {}).get('rotate', 0)
+        for sideData in videoStreams[0].get('side_data_list', []):
+            if 'rotation' in sideData:
+                displayRotation = sideData['rotation']
+    displayRotation = int(round(float(displayRotation))) % 360
+    
+    # Orientation of the displayed frames: h and w, with the display
+    # rotation applied.
+    try:
+        height = videoStreams[0]['height']
+        width = videoStreams[0]['width']
+        if displayRotation in [90, 270]:
+            height, width = width, height
+        if height>width:
+            frameOrientation = 90
+        else:
+            frameOrientation = 0
+    except:
+        frameOrientation = None
+    
     try:
         rotation = meta['format']['tags']['com.apple.quicktime.video-orientation']
     except:
         # For AVI (after we rewrite video), no rotation paramter, so just using h and w. 
         # For now this is ok, we don't need leaning right/left for this, just need to know
         # how to orient the pose estimation resolution parameters.
-        try: 
-            if meta['format']['format_name'] == 'avi':
-                if meta['streams'][0]['height']>meta['streams'][0]['width']:
-                    rotation = 90
-                else:
-                    rotation = 0
-            else:
-                raise Exception('no rotation info')
-        except:
+        if meta['format'].get('format_name') == 'avi' and frameOrientation is not None:
+            rotation = frameOrientation
+        else:
             rotation = 90 # upright is 90, and intrinsics were captured in that orientation
-        
-    return int(rotation)
+    rotation = int(rotation)
+    
+    # Pose detectors may decode the original video rather than the AVI copy
+    # (see utilsDetector.prepareVideoForDetection), whose frames are the
+    # displayed frames, so it is oriented from h and w whatever the container.
+    if frameOrientation is None:
+        frameOrientation = rotation
+    
+    return {'duration': float(meta['format'].get('duration', 'nan')),
+            'rotation': rotation,
+            'frameOrientation': frameOrientation,
+            'displayRotation': displayRotation}
+
+# %%
+# Metadata of a video from OpenCV: frame rate, number of frames, and size of
+# the frames in their display orientation.
+def probeVideoMetadataOpenCV(videoPath):
+    
+    video = cv2.VideoCapture(videoPath)
+    if hasattr(cv2, 'CAP_PROP_ORIENTATION_AUTO'):
+        video.set(cv2.CAP_PROP_ORIENTATION_AUTO, 1)
+    metadata = {'fps': video.get(cv2.CAP_PROP_FPS),
+                'frameCount': int(video.get(cv2.CAP_PROP_FRAME_COUNT)),
+                'width': int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                'height': int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))}
+    video.release()
+    
+    return metadata
+
+# %%
+# Video metadata cache. Each video is probed at most once per source
+# ('opencv': probeVideoMetadataOpenCV, 'ffprobe': probeVideoMetadataFFprobe).
+# The metadata is kept in memory and persisted in videoMetadata.json next to
+# the video, keyed by file name, and invalidated when the modification time
+# or size of the video change.
+# videoMetadataVersion is bumped when the probed metadata changes, to
+# invalidate persisted entries.
+videoMetadataCache = {}
+videoMetadataLock = threading.Lock()
+videoMetadataVersion = 2
+
+def getVideoMetadataIndexPath(videoPath):
+    
+    return os.path.join(os.path.dirname(os.path.abspath(videoPath)), 
+                        'videoMetadata.json')
+
+def readVideoMetadataIndex(indexPath):
+    
+    try:
+        with open(indexPath, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def getVideoMetadata(videoPath, source='opencv'):
+    
+    probes = {'opencv': probeVideoMetadataOpenCV,
+              'ffprobe': probeVideoMetadataFFprobe}
+    videoPath = os.path.abspath(videoPath)
+    videoName = os.path.basename(videoPath)
+    indexPath = getVideoMetadataIndexPath(videoPath)
+    stat = os.stat(videoPath)
+    stamp = [stat.st_mtime_ns, stat.st_size, videoMetadataVersion]
+    
+    with videoMetadataLock:
+        entry = videoMetadataCache.get(videoPath)
+        if entry is None or entry['stamp'] != stamp:
+            entry = readVideoMetadataIndex(indexPath).get(videoName)
+            if entry is None or entry['stamp'] != stamp:
+                entry = {'stamp': stamp}
+            videoMetadataCache[videoPath] = entry
+        if source in entry:
+            return dict(entry[source])
+    
+    # Probed outside of the lock, videos can be probed concurrently.
+    metadata = probes[source](videoPath)
+    
+    with videoMetadataLock:
+        entry[source] = metadata
+        index = readVideoMetadataIndex(indexPath)
+        index[videoName] = entry
+        try:
+            with open(indexPath + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(indexPath + '.tmp', indexPath)
+        except OSError:
+            # Read-only directory, the metadata is only cached in memory.
+            pass
+    
+    return dict(metadata)
 
 #%% 
 def rotateIntrinsics(CamParams,videoPath):
@@ -728,31 +897,17 @@ def computeOptimalCalibrationCombination(keypoints2D,confidence,extrinsicsOption
         for iCam1 in range(len(extrinsicsOptions[CamNames[1]])):
             combinations.append([iCam0,iCam1])
             
-            CameraParamList = [extrinsicsOptions[CamNames[0]][iCam0],
-                               extrinsicsOptions[CamNames[1]][iCam1]]
+            cameraRig = CameraRig([extrinsicsOptions[CamNames[0]][iCam0],
+                                   extrinsicsOptions[CamNames[1]][iCam1]],
+                                  names=CamNames[:2])
                                            
             # triangulate           
-            points3D,_ = triangulateMultiview(CameraParamList,keypointList)
+            points3D,_ = triangulateMultiview(cameraRig,keypointList)
             
-            # reproject
-            # Make list of camera objects
-            cameraObjList = []       
-            for camParams in CameraParamList:
-                c = Camera()
-                c.set_K(camParams['intrinsicMat'])
-                c.set_R(camParams['rotation'])
-                c.set_t(np.reshape(camParams['translation'],(3,1)))
-                cameraObjList.append(c)
-               
-            # Organize points for reprojectionError function
-            stackedPoints = np.stack([k[:,None,0,:] for k in keypointList])
-            pointsInput = []
-            for i in range(stackedPoints.shape[1]):
-                pointsInput.append(stackedPoints[:,i,0,:].T)
-           
             # Calculate combined reprojection error
-            reprojError = calcReprojectionError(cameraObjList,pointsInput,points3D,
-                                                normalizeError=True)
+            reprojError = calcReprojectionErrorBatch(
+                cameraRig, np.stack([k[:,None,0,:] for k in keypointList]),
+                points3D[:,:,None], normalizeError=True)
             meanReprojectionErrors.append(np.mean(reprojError))
       
     # Select solution with minimum error
@@ -789,7 +944,17 @@ def synchronizeVideos(CameraDirectories, trialRelativePath, pathPoseDetector,
                       imageBasedTracker=False, cams2Use=['all'],
                       poseDetector='OpenPose', trialName=None, bbox_thr=0.8,
                       resolutionPoseDetection='default', 
-                      visualizeKeypointAnimation=False):
+                      visualizeKeypointAnimation=False, subFrameSync=False,
+                      trackAllPeople=False, syncMethod='reference',
+                      correlationMethod='direct'):
+    # syncMethod, correlationMethod and subFrameSync are passed to
+    # synchronizeVideoKeypoints.
+    # If trackAllPeople is True, the videos are synchronized with the main
+    # subject as usual, then all people are tracked in each video, cleaned,
+    # filtered and synchronized like the main subject (see syncKeypointTracks)
+    # and associated across cameras (see associatePeopleAcrossViews). The
+    # returned keypoint and confidence dicts are then lists with one dict per
+    # subject, for triangulateMultiviewVideo.
     
     markerNames = getOpenPoseMarkerNames()
     
@@ -803,6 +968,8 @@ def synchronizeVideos(CameraDirectories, trialRelativePath, pathPoseDetector,
     # Initialize output lists
     pointList = []
     confList = []
+    trackletPointList = []
+    trackletConfList = []
     
     CameraDirectories_selectedCams = {}
     CamParamList_selectedCams = []
@@ -827,14 +994,23 @@ def synchronizeVideos(CameraDirectories, trialRelativePath, pathPoseDetector,
         ppPklPath = os.path.join(pathOutputPkl, trialPrefix+'_rotated_pp.pkl')
         key2D, confidence = loadPklVideo(
             ppPklPath, videoFullPath, imageBasedTracker=imageBasedTracker,
-            poseDetector=poseDetector,confidenceThresholdForBB=0.3)
-        thisVideo = cv2.VideoCapture(videoFullPath.replace('.mov', '_rotated.avi'))
-        frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))        
+            poseDetector=poseDetector,confidenceThresholdForBB=0.3,
+            imageSize=CamParamDict[camName].get('imageSize'))
+        frameRate = np.round(getVideoMetadata(
+            getDecodedVideoPath(videoFullPath))['fps'])
         if key2D.shape[1] == 0 and confidence.shape[1] == 0:
             camsToExclude.append(camName)
         else:
             pointList.append(key2D)
             confList.append(confidence)
+            if trackAllPeople:
+                trackletKey2D, trackletConfidence = loadPklVideo(
+                    ppPklPath, videoFullPath, poseDetector=poseDetector,
+                    confidenceThresholdForBB=0.3,
+                    imageSize=CamParamDict[camName].get('imageSize'),
+                    trackAllPeople=True)
+                trackletPointList.append(trackletKey2D)
+                trackletConfList.append(trackletConfidence)
         
     # If video is not existing, the corresponding camera should be removed.
     idx_camToExclude = []
@@ -880,23 +1056,22 @@ def synchronizeVideos(CameraDirectories, trialRelativePath, pathPoseDetector,
             fig.show()
 
     # Synchronize keypoints.
-    pointList, confList, nansInOutList,startEndFrameList = synchronizeVideoKeypoints(
+    pointList, confList, nansInOutList,startEndFrameList,syncInfo = synchronizeVideoKeypoints(
         pointList, confList, confidenceThreshold=confidenceThreshold,
         filtFreqs=filtFreqs, sampleFreq=frameRate, visualize=False,
         maxShiftSteps=2*frameRate, CameraParams=CamParamList_selectedCams,
         cameras2Use=cameras2Use, 
-        CameraDirectories=CameraDirectories_selectedCams, trialName=trialName)
+        CameraDirectories=CameraDirectories_selectedCams, trialName=trialName,
+        subFrameSync=subFrameSync, syncMethod=syncMethod,
+        correlationMethod=correlationMethod, returnSyncInfo=True)
     
     if undistortPoints:
         if CamParamList_selectedCams is None:
             raise Exception('Need to have CamParamList to undistort Images')
-        # nFrames = pointList[0].shape[1]
-        unpackedPoints = unpackKeypointList(pointList) ;
-        undistortedPoints = []
-        for points in unpackedPoints:
-            undistortedPoints.append(undistort2Dkeypoints(
-                points, CamParamList_selectedCams, useIntrinsicMatAsP=True))
-        pointList = repackKeypointList(undistortedPoints)
+        # Undistort all frames of a camera at once.
+        pointList = undistort2Dkeypoints(
+            pointList, CameraRig(CamParamList_selectedCams),
+            useIntrinsicMatAsP=True)
         
     pointDir = {}
     confDir = {}
@@ -908,6 +1083,35 @@ def synchronizeVideos(CameraDirectories, trialRelativePath, pathPoseDetector,
         nansInOutDir[camName] = nansInOutList[iCam] 
         startEndFrames[camName] = startEndFrameList[iCam]
         
+    if trackAllPeople:
+        # Apply the sync of the main subject to all tracks. Cameras kicked out
+        # of the synchronization have no tracks.
+        nFramesSync = pointList[0].shape[1]
+        for iCam in range(len(trackletPointList)):
+            if syncInfo is None or syncInfo['frameInds'][iCam] is None:
+                trackletPointList[iCam] = np.zeros((0,25,nFramesSync,2))
+                trackletConfList[iCam] = np.zeros((0,25,nFramesSync))
+            else:
+                trackletPointList[iCam], trackletConfList[iCam] = (
+                    syncKeypointTracks(
+                        trackletPointList[iCam], trackletConfList[iCam],
+                        syncInfo['frameInds'][iCam], syncInfo, frameRate,
+                        confidenceThreshold=confidenceThreshold))
+        if undistortPoints:
+            trackletPointList = undistort2Dkeypoints(
+                trackletPointList, CameraRig(CamParamList_selectedCams),
+                useIntrinsicMatAsP=True)
+        subjectPointList, subjectConfList = associatePeopleAcrossViews(
+            CamParamList_selectedCams, trackletPointList, trackletConfList,
+            confidenceThreshold=confidenceThreshold)
+        print('{} subjects tracked across cameras.'.format(
+            len(subjectPointList)))
+        
+        pointDir = [dict(zip(CameraDirectories_selectedCams, points)) 
+                    for points in subjectPointList]
+        confDir = [dict(zip(CameraDirectories_selectedCams, conf)) 
+                   for conf in subjectConfList]
+        
     return pointDir, confDir, markerNames, frameRate, nansInOutDir, startEndFrames, cameras2Use
 
 # %%
@@ -917,10 +1121,29 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
                               sampleFreq=30, visualize=False, maxShiftSteps=30,
                               isGait=False, CameraParams = None,
                               cameras2Use=['none'],CameraDirectories = None,
-                              trialName=None, trialID=''):
+                              trialName=None, trialID='', correlationMethod='direct',
+                              syncMethod='reference', subFrameSync=False,
+                              returnSyncInfo=False):
     visualize2Dkeypoint = False # this is a visualization just for testing what filtered input data looks like
     
     # keypointList is a mCamera length list of (nmkrs,nTimesteps,2) arrays of camera 2D keypoints
+    # correlationMethod is 'direct' (np.correlate per camera, default) or
+    # 'fft' (all cameras correlated with Cam0 in one batched FFT, see
+    # cross_corr_fft; same correlations up to floating-point noise).
+    # syncMethod is 'reference' (every camera is synced against Cam0) or
+    # 'pairwise' (lags of all camera pairs, combined into a global offset per
+    # camera, see solveSyncOffsets). In both cases, lags are refined by
+    # reprojection error minimization (see refineSyncLagReprojection); the
+    # selection between correlation peaks by reprojection error only applies
+    # to 'reference', pairwise offsets being unique. The hand punch sync
+    # always uses Cam0.
+    # If subFrameSync is True, lags are estimated to a fraction of a frame and
+    # the keypoints and confidence of each camera are resampled on the frames
+    # of Cam0 (see resampleKeypoints).
+    # If returnSyncInfo is True, also returns a dict with the (fractional)
+    # frame indices sampled in each camera ('frameInds', None for cameras
+    # kicked out), the filter frequency and the number of cameras used, to
+    # apply the same sync to other keypoints (see syncKeypointTracks).
     print('Synchronizing Keypoints')
     
     # Deep copies such that the inputs do not get modified.
@@ -1041,6 +1264,8 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
             confidenceSync.insert(i, np.zeros((keypointList[0].shape[0], 10)))
             nansInOutSync.insert(i, np.array([np.nan, np.nan]))
             startEndFrames.insert(i, None)  # 添加对应的值     
+        if returnSyncInfo:
+            return keypointsSync, confidenceSync, nansInOutSync, startEndFrames, None
         return keypointsSync, confidenceSync, nansInOutSync, startEndFrames  # 返回4个值保持一致
                 
     [idxStart, idxEnd] = [np.min(overlapInds_clean), np.max(overlapInds_clean)]
@@ -1131,6 +1356,34 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
     confidenceListFilt = copy.deepcopy(confFiltList)
     confidenceSyncListFilt = copy.deepcopy(confSyncFiltList)
 
+    # Build the camera rig once, it is reused for every lag candidate when
+    # minimizing the reprojection error.
+    if c_CameraParams is not None:
+        cameraRig = CameraRig(c_CameraParams, names=c_cameras2Use)
+    else:
+        cameraRig = c_CameraParams
+
+    # Lags of all camera pairs, combined into global offsets.
+    pairwiseShifts = None
+    if syncMethod == 'pairwise' and syncActivity in ['general', 'gait']:
+        if syncActivity == 'general':
+            syncSignals = vertVelList
+        else:
+            syncSignals = mkrSpeedList
+        lagMat, weightMat = estimatePairwiseLags(
+            syncSignals, multCorrGaussianStd=maxShiftSteps/2)
+        pairwiseShifts = solveSyncOffsets(lagMat, weightMat)
+        print('Pairwise sync offsets: {}'.format(
+            dict(zip(c_cameras2Use, np.round(pairwiseShifts, 2).tolist()))))
+
+    # Correlate the sync signals of all cameras with the ones of Cam0 at once.
+    corrList = [None for _ in vertVelList]
+    if correlationMethod == 'fft' and pairwiseShifts is None:
+        if syncActivity == 'general':
+            corrList = cross_corr_fft(vertVelList, vertVelList[0])
+        elif syncActivity == 'gait':
+            corrList = cross_corr_fft(mkrSpeedList, mkrSpeedList[0])
+
     # find nSample shift relative to the first camera
     # nSamps = keypointList[0].shape[1]
     shiftVals = []
@@ -1140,11 +1393,29 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
     for iCam,vertVel in enumerate(vertVelList):
         timeVecs.append(np.arange(keypointList[iCam].shape[1]))
         if iCam>0:
+            # Cameras without keypoints have no correlation weight and a 0 offset.
+            if pairwiseShifts is not None:
+                # Refined by reprojection error minimization around the
+                # solved offset, like the correlation lags in cross_corr.
+                dataForReproj = {'CamParamList':cameraRig,
+                                 'keypointList':keypointListFilt,
+                                 'cams2UseReproj': [0, iCam],
+                                 'confidence': confidenceSyncListFilt,
+                                 'cameras2Use': c_cameras2Use
+                                 }
+                if cameraRig is not None:
+                    lag, _, _ = refineSyncLagReprojection(
+                        int(np.round(pairwiseShifts[iCam])), dataForReproj,
+                        sampleFreq, subFrame=subFrameSync)
+                elif subFrameSync:
+                    lag = pairwiseShifts[iCam]
+                else:
+                    lag = int(np.round(pairwiseShifts[iCam]))
             # if no keypoints in Cam0 or the camera of interest, do not use cross_corr to sync.
-            if np.max(np.abs(vertVelList[iCam])) == 0 or np.max(np.abs(vertVelList[0])) == 0:
+            elif np.max(np.abs(vertVelList[iCam])) == 0 or np.max(np.abs(vertVelList[0])) == 0:
                 lag = 0
             elif syncActivity == 'general':
-                dataForReproj = {'CamParamList':c_CameraParams,
+                dataForReproj = {'CamParamList':cameraRig,
                                  'keypointList':keypointListFilt,
                                  'cams2UseReproj': [0, c_cameras2Use.index(c_cameras2Use[iCam])],
                                  'confidence': confidenceSyncListFilt,
@@ -1152,10 +1423,11 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
                                  }
                 corVal,lag = cross_corr(vertVel,vertVelList[0],multCorrGaussianStd=maxShiftSteps/2,
                                         visualize=False,dataForReproj=dataForReproj,
-                                        frameRate=sampleFreq) # gaussian curve gets multipled by correlation plot - helping choose the smallest shift value for periodic motions
+                                        frameRate=sampleFreq, corr=corrList[iCam],
+                                        subFrame=subFrameSync) # gaussian curve gets multipled by correlation plot - helping choose the smallest shift value for periodic motions
             elif syncActivity == 'gait':
                 
-                dataForReproj = {'CamParamList':c_CameraParams,
+                dataForReproj = {'CamParamList':cameraRig,
                                  'keypointList':keypointListFilt,
                                  'cams2UseReproj': [0, c_cameras2Use.index(c_cameras2Use[iCam])],
                                  'confidence': confidenceSyncListFilt,
@@ -1166,7 +1438,9 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
                                             multCorrGaussianStd=maxShiftSteps/2,
                                             dataForReproj=dataForReproj,
                                             visualize=False,
-                                            frameRate=sampleFreq)    
+                                            frameRate=sampleFreq,
+                                            corrMat=corrList[iCam],
+                                            subFrame=subFrameSync)    
             elif syncActivity == 'handPunch':
                 corVal,lag = syncHandPunch([handPunchVertPositionList[i] for i in [0,iCam]],
                                            handForPunch,maxShiftSteps=maxShiftSteps)
@@ -1182,17 +1456,33 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
     tStart = np.max(tStartEndVec[:,0])
     tEnd = np.min(tStartEndVec[:,1])
     
+    if subFrameSync:
+        # Common timebase: frames of Cam0 seen by all cameras.
+        timeSync = np.arange(np.ceil(tStart), np.floor(tEnd)+1)
+    
     keypointsSync = []
     confidenceSync = []
     startEndFrames = []
     nansInOutSync = []
+    frameIndsSync = []
     for iCam,key in enumerate(keyFiltList):
         # Trim the keypoints and confidence lists
         confidence = confFiltList[iCam]
-        iStart = int(np.argwhere(timeVecs[iCam]==tStart))
-        iEnd = int(np.argwhere(timeVecs[iCam]==tEnd))
-        keypointsSync.append(key[:,iStart:iEnd+1,:])
-        confidenceSync.append(confidence[:,iStart:iEnd+1])
+        if subFrameSync:
+            # Fractional frame indices of this camera on the common timebase.
+            frameInds = timeSync + shiftVals[iCam]
+            keySync, confSync = resampleKeypoints(key, confidence, frameInds)
+            keypointsSync.append(keySync)
+            confidenceSync.append(confSync)
+            iStart = int(np.round(frameInds[0]))
+            iEnd = int(np.round(frameInds[-1]))
+        else:
+            iStart = int(np.argwhere(timeVecs[iCam]==tStart))
+            iEnd = int(np.argwhere(timeVecs[iCam]==tEnd))
+            keypointsSync.append(key[:,iStart:iEnd+1,:])
+            confidenceSync.append(confidence[:,iStart:iEnd+1])
+            frameInds = np.arange(iStart, iEnd+1)
+        frameIndsSync.append(frameInds)
         if shiftVals[iCam] > 0:
             shiftednNansInOut = nansInOutList[iCam] - shiftVals[iCam]
         else:
@@ -1257,9 +1547,47 @@ def synchronizeVideoKeypoints(keypointList, confidenceList,
         confidenceSync.insert(idxCamera2NotUse, np.zeros(confidenceSync[0].shape))
         nansInOutSync.insert(idxCamera2NotUse, np.array([np.nan, np.nan]))
         startEndFrames.insert(idxCamera2NotUse, None)
+        frameIndsSync.insert(idxCamera2NotUse, None)
  
+    if returnSyncInfo:
+        syncInfo = {'frameInds': frameIndsSync, 'filtFreq': filtFreq,
+                    'nCams': nCams}
+        return keypointsSync, confidenceSync, nansInOutSync, startEndFrames, syncInfo
+    
     return keypointsSync, confidenceSync, nansInOutSync, startEndFrames
 
+# %% Apply the sync of synchronizeVideoKeypoints to other keypoints.
+# Each track of key2D (nTracks x nMkrs x nFrames x 2) and confidence
+# (nTracks x nMkrs x nFrames) of a camera goes through the same occlusion
+# removal, cleaning, filtering and (sub-frame) resampling as the synchronized
+# subject, frameInds being the frame indices of the camera in syncInfo.
+def syncKeypointTracks(key2D, confidence, frameInds, syncInfo, sampleFreq,
+                       confidenceThreshold=0.3):
+    
+    nFramesSync = len(frameInds)
+    nTracks, nMkrs = confidence.shape[:2]
+    keySync = np.zeros((nTracks, nMkrs, nFramesSync, 2))
+    confSync = np.zeros((nTracks, nMkrs, nFramesSync))
+    
+    mkrDict = {mkr:iMkr for iMkr,mkr in enumerate(getOpenPoseMarkerNames())}
+    footMkrs = {'right':[mkrDict['RBigToe'], mkrDict['RSmallToe'], mkrDict['RHeel'],mkrDict['RAnkle']],
+                'left':[mkrDict['LBigToe'], mkrDict['LSmallToe'], mkrDict['LHeel'],mkrDict['LAnkle']]}
+    armMkrs = {'right':[mkrDict['RElbow'], mkrDict['RWrist']],
+                'left':[mkrDict['LElbow'], mkrDict['LWrist']]}
+    for iTrack in range(nTracks):
+        key, conf = removeOccludedSide(key2D[iTrack], confidence[iTrack],
+                                       footMkrs, confidenceThreshold)
+        key, conf = removeOccludedSide(key, conf, armMkrs, 
+                                       confidenceThreshold)
+        key, conf, _, _ = clean2Dkeypoints(key, conf, confidenceThreshold,
+                                           nCams=syncInfo['nCams'])
+        key = filterKeypointsButterworth(key, syncInfo['filtFreq'], 
+                                         sampleFreq, order=4)
+        keySync[iTrack], confSync[iTrack] = resampleKeypoints(
+            key, conf, frameInds)
+    
+    return keySync, confSync
+
 # %%
 def detectHandPunchAllVideos(handPunchPositionList,sampleFreq,punchDuration=3):
     
@@ -1530,79 +1858,189 @@ def findClosestBox(bbox,keyBoxes,imageSize,iPerson=None):
     return iPerson,bbox,samePerson
 
 #%%
+# Pads the per-frame person lists of a pose pickle into a
+# nFrames x nPeople x 75 array, nan where a person is not detected. nPeople is
+# at least 1.
+def posePklToArray(frames, nKeypoints=25):
+    
+    nPeople = max([len(frame) for frame in frames] + [1])
+    people = np.full((len(frames), nPeople, nKeypoints*3), np.nan)
+    for c_frame, frame in enumerate(frames):
+        if len(frame) > 0:
+            people[c_frame,:len(frame)] = [
+                person['pose_keypoints_2d'] for person in frame]
+            
+    return people
+
+#%%
+# Same as posePklToArray for the binary pose store (see utils.loadPoseArrays).
+def poseArraysToPeople(keypoints, frameOffsets):
+    
+    nFrames = len(frameOffsets) - 1
+    counts = np.diff(frameOffsets)
+    nPeople = max(int(np.max(counts, initial=0)), 1)
+    people = np.full((nFrames, nPeople, keypoints.shape[1]*3), np.nan)
+    iFrames = np.repeat(np.arange(nFrames), counts)
+    iPeople = np.arange(len(iFrames)) - np.repeat(frameOffsets[:-1], counts)
+    people[iFrames,iPeople] = np.reshape(
+        keypoints[:frameOffsets[-1]], (len(iFrames), people.shape[2]))
+            
+    return people
+
+#%%
+# Converts nFrames x nPeople x 4 (xTopLeft, yTopLeft, width, height) bounding
+# boxes to corners (xTopLeft, yTopLeft, xBottomRight, yBottomRight), nan for
+# people that are not detected in allPeople (nFrames x nPeople x 75).
+def boundingBoxCorners(allBoxes, allPeople):
+    
+    corners = np.concatenate((allBoxes[...,:2], 
+                              allBoxes[...,:2] + allBoxes[...,2:]), axis=-1)
+    corners[np.all(np.isnan(allPeople), axis=-1)] = np.nan
+    
+    return corners
+
+#%%
+# Min-cost path (Viterbi) through the bounding boxes of all detected people,
+# starting from startPerson in the first frame of corners. Steps between boxes
+# of consecutive frames cost the distance between their corners and are not
+# allowed above maxJump, at which point tracking stops: the absorbing lost
+# state costs more per frame than any tracked path, so the longest trackable
+# path is selected, then the one with the smallest box changes. Up to maxGap
+# frames can be bridged. As when tracking frame by frame, bridged frames are
+# filled with the person closest to the last tracked box, if anyone is
+# detected.
+# corners: nFrames x nPeople x 4, nan for people not detected.
+# returns: nFrames person indices, -1 for frames that are not tracked.
+def trackBoxCornersViterbi(corners, startPerson, maxJump, maxGap=0):
+    
+    nFrames, nPeople = corners.shape[:2]
+    nGaps = min(maxGap, max(nFrames-2, 0)) + 1
+    lostCost = maxJump * (nFrames + 1) + 1
+    
+    # Cost of steps from person i at frame t-1-k to person j at frame t:
+    # stepCost[t,k,i,j], inf before the first frame and above maxJump.
+    stepCost = np.full((nFrames, nGaps, nPeople, nPeople), np.inf)
+    for k in range(nGaps):
+        dists = np.linalg.norm(corners[:-1-k,:,None] - corners[1+k:,None], 
+                               axis=-1)
+        dists[~(dists <= maxJump)] = np.inf
+        stepCost[1+k:,k] = dists + k*lostCost
+    
+    # cost is padded with nGaps-1 leading frames such that the previous
+    # frames of frame t are the rows t-1 to t+nGaps-2, most recent last.
+    cost = np.full((nFrames + nGaps - 1, nPeople), np.inf)
+    cost[nGaps-1,startPerson] = 0
+    prevFrame = np.zeros((nFrames, nPeople), dtype=int)
+    prevPerson = np.zeros((nFrames, nPeople), dtype=int)
+    lost = np.full(nFrames, np.inf)
+    lostFrom = np.full(nFrames, -1)
+    for t in range(1, nFrames):
+        # nGaps*nPeople previous states x nPeople current states.
+        candidates = (cost[t-1:t+nGaps-1][::-1,:,None] + stepCost[t]).reshape(
+            nGaps*nPeople, nPeople)
+        iPrev = np.argmin(candidates, axis=0)
+        cost[t+nGaps-1] = candidates[iPrev, np.arange(nPeople)]
+        prevFrame[t] = t - 1 - iPrev // nPeople
+        prevPerson[t] = iPrev % nPeople
+        costPrev = cost[t+nGaps-2]
+        iLost = np.argmin(costPrev)
+        if costPrev[iLost] < lost[t-1]:
+            lost[t] = costPrev[iLost] + lostCost
+            lostFrom[t] = iLost
+        else:
+            lost[t] = lost[t-1] + lostCost
+    cost = cost[nGaps-1:]
+    
+    # Backtrack.
+    path = np.full(nFrames, -1)
+    t = nFrames - 1
+    if lost[t] < np.min(cost[t]):
+        while lostFrom[t] == -1:
+            t -= 1
+        person = lostFrom[t]
+        t -= 1
+    else:
+        person = np.argmin(cost[t])
+    while True:
+        path[t] = person
+        if t == 0:
+            break
+        s = prevFrame[t,person]
+        for b in range(s+1, t):
+            boxErrors = np.linalg.norm(corners[b] - corners[s,person], axis=-1)
+            if not np.all(np.isnan(boxErrors)):
+                path[b] = np.nanargmin(boxErrors)
+        t, person = s, prevPerson[t,person]
+        
+    return path
+
+#%%
+# Tracks the keypoint bounding box closest to bbStart from frameStart in the
+# direction of frameIncrement, until the box changes too much between frames.
+# allPeople (nFrames x 75) and allBoxes (nFrames x 4) are lists with one
+# entry per person, or stacked nFrames x nPeople x 75|4 arrays. The video is
+# only read to visualize the tracking or if imageSize is not provided.
 def trackKeypointBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0 ,
                      frameIncrement = 1, visualize = False, poseDetector='OpenPose',
-                     badFramesBeforeStop = 0):
+                     badFramesBeforeStop = 0, imageSize = None):
     
     # Extract camera name
     if videoPath.split('InputMedia')[0][-5:-2] == 'Cam': # <= 10 cams
         camName = videoPath.split('InputMedia')[0][-5:-1]
     else:
         camName = videoPath.split('InputMedia')[0][-6:-1]
-
-    # Tracks closest keypoint bounding boxes until the box changes too much.
-    bboxKey = bbStart # starting bounding box
-    frameNum = frameStart
-
-    # initiate video capture
-    # Read video
-    video = cv2.VideoCapture(videoPath.replace('.mov', '_rotated.avi'))
-    nFrames = allBoxes[0].shape[0]
-    
-    # Read desiredFrames.
-    video.set(1, frameNum)
-    ok, frame = video.read()
-    if not ok:
-        print('Cannot read video file')
-        raise Exception('Cannot read video file')
         
-    imageSize = (frame.shape[0],frame.shape[1])
-    justStarted = True
-    count = 0   
-    badFrames = []
-    while frameNum > -1 and frameNum < nFrames:
-        # Read a new frame
-        
-        if visualize:
+    # Parameters.
+    # Proportion of mean image dimensions that corners must change to be
+    # considered different person
+    cornerChangeThreshold = 0.2 
+    
+    if isinstance(allPeople, (list, tuple)):
+        allPeople = np.stack(allPeople, axis=1)
+    if isinstance(allBoxes, (list, tuple)):
+        allBoxes = np.stack(allBoxes, axis=1)
+    nFrames = allBoxes.shape[0]
+    
+    if imageSize is None:
+        metadata = getVideoMetadata(getDecodedVideoPath(videoPath))
+        imageSize = (metadata['height'], metadata['width'])
+    if visualize:
+        video = openVideo(videoPath)
+        video.set(1, frameStart)
+        ok, frame = video.read()
+        if not ok:
+            print('Cannot read video file')
+            raise Exception('Cannot read video file')
+    
+    # Start from the person closest to the starting bounding box.
+    corners = boundingBoxCorners(allBoxes, allPeople)
+    bbStartCorners = np.array([bbStart[0], bbStart[1], 
+                               bbStart[0] + bbStart[2], 
+                               bbStart[1] + bbStart[3]])
+    startPerson = np.nanargmin(
+        np.linalg.norm(corners[frameStart] - bbStartCorners, axis=1))
+    
+    if frameIncrement > 0:
+        frameInds = np.arange(frameStart, nFrames, frameIncrement)
+    else:
+        frameInds = np.arange(frameStart, -1, frameIncrement)
+    path = trackBoxCornersViterbi(
+        corners[frameInds], startPerson, 
+        cornerChangeThreshold*np.mean(imageSize), maxGap=badFramesBeforeStop)
+    
+    nTracked = np.max(np.flatnonzero(path >= 0)) + 1
+    if nTracked < len(frameInds):
+        print('{}: not same person at {}'.format(camName, frameInds[nTracked]))
+    tracked = path >= 0
+    dataOut[frameInds[tracked],:] = allPeople[frameInds[tracked],path[tracked]]
+    
+    if visualize:
+        for frameNum, iPerson in zip(frameInds[tracked], path[tracked]):
             video.set(1, frameNum)
             ok, frame = video.read()
             if not ok:
                 break
-        
-        # Find person closest to tracked bounding box, and fill their keypoint data
-        keyBoxes = [box[frameNum] for box in allBoxes]        
-        
-        iPerson, bboxKey_new, samePerson = findClosestBox(bboxKey, keyBoxes, 
-                                                imageSize)
-        
-        # We allow badFramesBeforeStop of samePerson = False to account for an
-        # errant frame(s) in the pose detector. Once we reach badFramesBeforeStop,
-        # we break and output to the last good frame.
-        if len(badFrames) > 0 and samePerson:
-            badFrames = []
-            
-        if not samePerson and not justStarted:
-            if len(badFrames) >= badFramesBeforeStop:
-                print('{}: not same person at {}'.format(camName, frameNum - frameIncrement*badFramesBeforeStop))
-                # Replace the data from the badFrames with zeros
-                if len(badFrames) > 1:
-                    dataOut[badFrames,:] = np.zeros(len(badFrames),dataOut.shape[0])
-                break     
-            else:
-                badFrames.append(frameNum)
-                
-       # Don't update the bboxKey for the badFrames
-        if len(badFrames) == 0:
-            bboxKey = bboxKey_new
-
-        
-        dataOut[frameNum,:] = allPeople[iPerson][frameNum,:]
-        
-        # Next frame 
-        frameNum += frameIncrement
-        justStarted = False
-        
-        if visualize: 
+            bboxKey = allBoxes[frameNum,iPerson]
             p3 = (int(bboxKey[0]), int(bboxKey[1]))
             p4 = (int(bboxKey[0] + bboxKey[2]), int(bboxKey[1] + bboxKey[3]))
             cv2.rectangle(frame, p3, p4, (0,255,0), 2, 1)
@@ -1613,11 +2051,153 @@ def trackKeypointBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0
             # Exit if ESC pressed
             k = cv2.waitKey(1) & 0xff
             if k == 27 : break
-        
-        count += 1
   
     return dataOut
  
+#%%
+# Tracks all detected people: in each frame, detections are assigned to the
+# active tracks with the Hungarian algorithm on the distance between bounding
+# box corners. Detections that are not assigned, or whose box changes more
+# than for trackKeypointBox, start a new track. Tracks not detected for more
+# than maxGap frames are closed and tracks shorter than minLength frames are
+# dropped.
+# people: nFrames x nPeople x 75, allBoxes: nFrames x nPeople x 4.
+# returns: nFrames x nTracks x 75, nan where a track is not detected, with
+# tracks sorted from longest to shortest.
+def trackPeople2D(people, allBoxes, imageSize, maxGap=5, minLength=10):
+    
+    # Proportion of mean image dimensions that corners must change to be
+    # considered different person
+    cornerChangeThreshold = 0.2 
+    maxJump = cornerChangeThreshold*np.mean(imageSize)
+    
+    nFrames, nPeople = people.shape[:2]
+    corners = boundingBoxCorners(allBoxes, people)
+    trackIds = np.full((nFrames, nPeople), -1)
+    trackCorners = np.zeros((0, 4))
+    trackLastFrame = np.zeros(0, dtype=int)
+    for t in range(nFrames):
+        detected = np.flatnonzero(~np.isnan(corners[t,:,0]))
+        active = np.flatnonzero(t - trackLastFrame <= maxGap + 1)
+        if len(detected) > 0 and len(active) > 0:
+            boxErrors = np.linalg.norm(
+                trackCorners[active][:,None] - corners[t][None,detected],
+                axis=-1)
+            # Large finite cost such that the assignment is always feasible.
+            rows, cols = linear_sum_assignment(
+                np.where(boxErrors <= maxJump, boxErrors, 1e3*maxJump + 1))
+            matched = boxErrors[rows,cols] <= maxJump
+            trackIds[t,detected[cols[matched]]] = active[rows[matched]]
+        newDetections = detected[trackIds[t,detected] == -1]
+        trackIds[t,newDetections] = np.arange(
+            len(trackLastFrame), len(trackLastFrame) + len(newDetections))
+        trackCorners = np.concatenate(
+            (trackCorners, np.zeros((len(newDetections), 4))))
+        trackLastFrame = np.concatenate(
+            (trackLastFrame, np.zeros(len(newDetections), dtype=int)))
+        trackCorners[trackIds[t,detected]] = corners[t,detected]
+        trackLastFrame[trackIds[t,detected]] = t
+    
+    # Keep long enough tracks, longest first.
+    trackLengths = np.bincount(trackIds[trackIds >= 0], 
+                               minlength=len(trackLastFrame))
+    keptTracks = np.flatnonzero(trackLengths >= minLength)
+    keptTracks = keptTracks[np.argsort(-trackLengths[keptTracks], 
+                                       kind='stable')]
+    newIds = np.full(len(trackLastFrame) + 1, -1)
+    newIds[keptTracks] = np.arange(len(keptTracks))
+    trackIds = newIds[trackIds]
+    
+    tracklets = np.full((nFrames, len(keptTracks), people.shape[2]), np.nan)
+    iFrames, iPeople = np.nonzero(trackIds >= 0)
+    tracklets[iFrames,trackIds[iFrames,iPeople]] = people[iFrames,iPeople]
+    
+    return tracklets
+
+#%%
+# Associates the 2D tracks of synchronized cameras into subjects. Track pairs
+# of two cameras are compared with the median symmetric epipolar distance of
+# their keypoints (confidence above confidenceThreshold) over the frames both
+# tracks see, if they share at least minOverlap frames. Pairs are merged from
+# the smallest distance up to maxEpipolarError (pixels), as long as a subject
+# does not get two tracks of the same camera at the same time.
+# keypointsList: per camera, nTracks x nMkrs x nFrames x 2 (undistorted, see
+# undistort2Dkeypoints) and confidenceList: nTracks x nMkrs x nFrames, 0 where
+# a track is not detected.
+# returns: per subject, lists of nMkrs x nFrames x 2 keypoints and 
+# nMkrs x nFrames confidence for each camera (zeros for cameras that do not
+# see the subject), subjects sorted by how often they are seen.
+def associatePeopleAcrossViews(CameraParams, keypointsList, confidenceList,
+                               confidenceThreshold=0.4, maxEpipolarError=20,
+                               minOverlap=10, nSubjects=None):
+    
+    cameraRig = getCameraRig(CameraParams)
+    nCams = len(keypointsList)
+    nMkrs, nFrames = confidenceList[0].shape[1:]
+    
+    # Nodes are (camera, track) pairs.
+    nodes = [(iCam, iTrack) for iCam in range(nCams) 
+             for iTrack in range(keypointsList[iCam].shape[0])]
+    # nan confidences (frames to spline, see clean2Dkeypoints) are present.
+    presence = {node: np.any(confidenceList[node[0]][node[1]] != 0, axis=0)
+                for node in nodes}
+    
+    pairCosts = []
+    for iCam in range(nCams):
+        for jCam in range(iCam+1, nCams):
+            F = fundamental_matrix(cameraRig.P[iCam], cameraRig.P[jCam])
+            validJ = confidenceList[jCam] > confidenceThreshold
+            for iTrack in range(keypointsList[iCam].shape[0]):
+                distances = symmetric_epipolar_distances(
+                    F, keypointsList[iCam][iTrack], keypointsList[jCam])
+                valid = ((confidenceList[iCam][iTrack] > confidenceThreshold) &
+                         validJ)
+                for jTrack in range(keypointsList[jCam].shape[0]):
+                    if (np.count_nonzero(np.any(valid[jTrack], axis=0)) < 
+                            minOverlap):
+                        continue
+                    cost = np.median(distances[jTrack][valid[jTrack]])
+                    if cost <= maxEpipolarError:
+                        pairCosts.append((cost, (iCam, iTrack), 
+                                          (jCam, jTrack)))
+    
+    # Greedy merging, smallest distances first.
+    subjectOf = {node: i for i, node in enumerate(nodes)}
+    subjects = {i: [node] for i, node in enumerate(nodes)}
+    for _, nodeA, nodeB in sorted(pairCosts, key=lambda pair: pair[0]):
+        subjectA, subjectB = subjectOf[nodeA], subjectOf[nodeB]
+        if subjectA == subjectB:
+            continue
+        compatible = not any(
+            a[0] == b[0] and np.any(presence[a] & presence[b]) 
+            for a in subjects[subjectA] for b in subjects[subjectB])
+        if compatible:
+            for node in subjects[subjectB]:
+                subjectOf[node] = subjectA
+            subjects[subjectA] += subjects.pop(subjectB)
+    
+    # Subjects seen by at least two cameras, most seen first.
+    subjects = [s for s in subjects.values() if len(set(n[0] for n in s)) > 1]
+    subjects.sort(key=lambda s: -sum(np.count_nonzero(presence[n]) for n in s))
+    if nSubjects is not None:
+        subjects = subjects[:nSubjects]
+    
+    keypointsSubjects = []
+    confidenceSubjects = []
+    for subject in subjects:
+        keypointsSubject = [np.zeros((nMkrs, nFrames, 2)) for _ in range(nCams)]
+        confidenceSubject = [np.zeros((nMkrs, nFrames)) for _ in range(nCams)]
+        for iCam, iTrack in subject:
+            present = presence[(iCam, iTrack)]
+            keypointsSubject[iCam][:,present] = (
+                keypointsList[iCam][iTrack][:,present])
+            confidenceSubject[iCam][:,present] = (
+                confidenceList[iCam][iTrack][:,present])
+        keypointsSubjects.append(keypointsSubject)
+        confidenceSubjects.append(confidenceSubject)
+        
+    return keypointsSubjects, confidenceSubjects
+
 #%%
 def trackBoundingBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0 ,frameIncrement = 1, visualize = False):
     # Uses image-based tracking to track person thru video
@@ -1632,7 +2212,7 @@ def trackBoundingBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0
     frameNum = frameStart
     
     # Read video
-    video = cv2.VideoCapture(videoPath.replace('.mov', '_rotated.avi'))
+    video = openVideo(videoPath)
     nFrames = allBoxes[0].shape[0]
 
     # Read desiredFrames.
@@ -1875,6 +2455,12 @@ def repackKeypointList(unpackedKeypointList):
 # %%
 def undistort2Dkeypoints(pointList2D, CameraParamList, useIntrinsicMatAsP=True):
     # list of 2D points per image
+    # CameraParamList can also be a CameraRig, in which case points of any
+    # shape (..., 2), e.g. nMkrs x nFrames x 2, are undistorted in one call per camera.
+    if isinstance(CameraParamList, CameraRig):
+        return CameraParamList.undistort_points(pointList2D,
+                                                use_K_as_P=useIntrinsicMatAsP)
+    
     pointList2Dundistorted = []
     
     for i,points2D in enumerate(pointList2D):
@@ -1923,178 +2509,222 @@ def getMarkerSpeed(key2D,idxMkrs = [0],confidence = None, confThresh = 0.2, aver
     return vertVelTotal
 
 # %%
-def smoothKeypoints(key2D,sdKernel=1):
-    key2D_out = np.copy(key2D)
-    for i in range(25):
-        for j in range(2):
-            key2D_out[i,:,j] = np.apply_along_axis(
-                lambda x: gaussian_filter1d(x, sdKernel),
-                arr = key2D_out[i,:,j],
-                axis = 0)
+# chunkSize processes the frames in blocks (see utils.gaussianFilterChunked),
+# eg. for keypoints memory-mapped from long recordings; out can then be a
+# np.memmap as well.
+def smoothKeypoints(key2D,sdKernel=1,chunkSize=None,out=None):
+    key2D_out = np.array(key2D) if out is None else out
+    if out is not None:
+        key2D_out[25:] = key2D[25:]
+    if chunkSize is None:
+        key2D_out[:25] = gaussian_filter1d(
+            np.asarray(key2D[:25]), sdKernel, axis=1)
+    else:
+        gaussianFilterChunked(key2D[:25], sdKernel, axis=1,
+                              chunkSize=chunkSize, out=key2D_out[:25])
     return key2D_out
 
 # %% 
-def filterKeypointsButterworth(key2D,filtFreq,sampleFreq,order=4):
-    key2D_out = np.copy(key2D)
+def getButterworthSOS(filtFreq,sampleFreq,order=4,message=None):
     wn = filtFreq/(sampleFreq/2)
     if wn>1:
-        print('You tried to filter ' + str(int(sampleFreq)) + ' Hz signal with cutoff freq of ' + str(int(filtFreq)) + '. Will filter at ' + str(int(sampleFreq/2)) + ' instead.')
+        print(message)
         wn=0.99
     elif wn==1:
         wn=0.99
         
-    sos = butter(order/2,wn,btype='low',output='sos')
-    
-    for i in range(2):
-        key2D_out[:,:,i] = sosfiltfilt(sos,key2D_out[:,:,i],axis=1)             
-        
-    return key2D_out
+    return butter(order/2,wn,btype='low',output='sos')
 
 # %% 
-def filter3DPointsButterworth(points3D,filtFreq,sampleFreq,order=4):
-    points3D_out = np.copy(points3D)
-    wn = filtFreq/(sampleFreq/2)
-    if wn>1:
-        print('You tried to filter ' + str(sampleFreq) + ' signal with cutoff freq of ' + str(filtFreq) + ', which is above the Nyquist Frequency. Will filter at ' + str(sampleFreq/2) + 'instead.')
-        wn=0.99
-    elif wn==1:
-        wn=0.99
+# chunkSize filters the frames in blocks (see utils.sosfiltfiltChunked) with
+# the same result as whole-array filtering, eg. for keypoints memory-mapped
+# from long recordings; out can then be a np.memmap as well.
+def filterKeypointsButterworth(key2D,filtFreq,sampleFreq,order=4,
+                               chunkSize=None,out=None):
+    sos = getButterworthSOS(filtFreq,sampleFreq,order=order,message=(
+        'You tried to filter ' + str(int(sampleFreq)) + ' Hz signal with cutoff freq of ' + str(int(filtFreq)) + '. Will filter at ' + str(int(sampleFreq/2)) + ' instead.'))
+    
+    if out is None:
+        out = np.empty_like(key2D)
+    if chunkSize is None:
+        out[:] = sosfiltfilt(sos,key2D,axis=1)
+    else:
+        sosfiltfiltChunked(sos,key2D,axis=1,chunkSize=chunkSize,out=out)
         
-    sos = butter(order/2,wn,btype='low',output='sos')
-    
-    for i in range(2):
-        points3D_out = sosfiltfilt(sos,points3D_out,axis=0)             
+    return out
+
+# %% 
+def filter3DPointsButterworth(points3D,filtFreq,sampleFreq,order=4,
+                              chunkSize=None,out=None):
+    sos = getButterworthSOS(filtFreq,sampleFreq,order=order,message=(
+        'You tried to filter ' + str(sampleFreq) + ' signal with cutoff freq of ' + str(filtFreq) + ', which is above the Nyquist Frequency. Will filter at ' + str(sampleFreq/2) + 'instead.'))
+    
+    if out is None:
+        out = np.empty_like(points3D)
+    if chunkSize is None:
+        points3D_out = points3D
+        for i in range(2):
+            points3D_out = sosfiltfilt(sos,points3D_out,axis=0)
+        out[:] = points3D_out
+    else:
+        # The second pass runs in place on out.
+        sosfiltfiltChunked(sos,points3D,axis=0,chunkSize=chunkSize,out=out)
+        sosfiltfiltChunked(sos,out,axis=0,chunkSize=chunkSize,out=out)
         
-    return points3D_out
+    return out
 
 # %%
 def clean2Dkeypoints(key2D, confidence, confidenceThreshold=0.5, nCams=2, 
                      linearInterp=False):
     
-    key2D_out = np.copy(key2D)
+    # Keypoints are processed as (nMkrs*2) x nFrames columns, ie one column
+    # per marker coordinate.
+    nMkrs = key2D.shape[0]    
+    columns = np.reshape(np.array(np.moveaxis(key2D, 2, 1), dtype=float, 
+                                  order='C'), (nMkrs*2, -1))
     confidence_out = np.copy(confidence)
     confidence_sync_out = np.copy(confidence)
     
-    nMkrs = key2D_out.shape[0]    
     markerNames = getOpenPoseMarkerNames()
     
     # Turn all 0s into nans.
-    key2D_out[key2D_out==0] = np.nan    
-    
-    # Turn low confidence values to 0s if >2 cameras and nans otherwise.
-    for i in range(nMkrs):        
-        # If a marker has at least two frames with positive confidence,
-        # then identify frames where confidence is lower than threshold.
-        if len(np.argwhere(confidence_out[i,:]>0))>2:
-            nanInds = np.where(confidence_out[i,:] < confidenceThreshold)
-        # If a marker doesn't have two frames with positive confidence,
-        # then return empty list.    
-        else:
-            nanInds = []
-            faceMarkers = getOpenPoseFaceMarkers()[0]
-            # no warning if face marker
-            if not markerNames[i] in faceMarkers:
-                print('There were <2 frames with >0 confidence for {}'.format(
-                    markerNames[i]))
-        # Turn low confidence values to 0s if >2 cameras.
-        # Frames with confidence values of 0s are ignored during triangulation.
-        if nCams>2:
-            confidence_out[i,nanInds] = 0
-        # Turn low confidence values to nans if 2 cameras.
-        # Frames with nan confidence values are splined, and nan confidences
-        # are replaced by 0.5 during triangulation.
-        else:
-            confidence_out[i,nanInds] = np.nan            
-        # Turn inleading and exiting nans into 0s
-        idx_nonnans = ~np.isnan(confidence_out[i,:])
-        idx_nonzeros  = confidence_out[i,:] != 0            
-        idx_nonnanszeros = idx_nonnans & idx_nonzeros
-        if True in idx_nonnanszeros:
-            idx_nonnanszeros_first = np.where(idx_nonnanszeros)[0][0]
-            idx_nonnanszeros_last = np.where(idx_nonnanszeros)[0][-1]
-            confidence_out[i,:idx_nonnanszeros_first] = 0
-            confidence_out[i,idx_nonnanszeros_last:] = 0 
-        else:
-            confidence_out[i,:] = 0                    
+    columns[columns==0] = np.nan    
+    
+    # If a marker has at least two frames with positive confidence,
+    # then identify frames where confidence is lower than threshold.
+    # If a marker doesn't have two frames with positive confidence,
+    # then no frames are identified.
+    hasConfidence = np.count_nonzero(confidence_out>0, axis=1) > 2
+    nanInds = hasConfidence[:,None] & (confidence_out < confidenceThreshold)
+    faceMarkers = getOpenPoseFaceMarkers()[0]
+    for i in np.flatnonzero(~hasConfidence):
+        # no warning if face marker
+        if not markerNames[i] in faceMarkers:
+            print('There were <2 frames with >0 confidence for {}'.format(
+                markerNames[i]))
+    
+    # Helper function: turn inleading and exiting nans into 0s. The first
+    # and last valid frames of all markers are found at once.
+    def zero_in_out(conf):
+        idx_nonnanszeros = ~np.isnan(conf) & (conf != 0)
+        idx_first = np.argmax(idx_nonnanszeros, axis=1)
+        idx_last = conf.shape[1] - 1 - np.argmax(idx_nonnanszeros[:,::-1], axis=1)
+        idx_last[~np.any(idx_nonnanszeros, axis=1)] = 0
+        for i in range(conf.shape[0]):
+            conf[i,:idx_first[i]] = 0
+            conf[i,idx_last[i]:] = 0
+    
+    # Turn low confidence values to 0s if >2 cameras.
+    # Frames with confidence values of 0s are ignored during triangulation.
+    if nCams>2:
+        confidence_out[nanInds] = 0
+    # Turn low confidence values to nans if 2 cameras.
+    # Frames with nan confidence values are splined, and nan confidences
+    # are replaced by 0.5 during triangulation.
+    else:
+        confidence_out[nanInds] = np.nan            
+    zero_in_out(confidence_out)
             
-        # Turn low confidence values to 0s for confidence_sync_out whatever
-        # the number of cameras; confidence_sync_out is used for 
-        # calculating the reprojection error, and using nans rather than 
-        # 0s might affect the outcome.
-        confidence_sync_out[i,nanInds] = 0
-        # Turn inleading and exiting nans into 0s
-        idx_nonnans = ~np.isnan(confidence_sync_out[i,:])
-        idx_nonzeros  = confidence_sync_out[i,:] != 0            
-        idx_nonnanszeros = idx_nonnans & idx_nonzeros
-        if True in idx_nonnanszeros:
-            idx_nonnanszeros_first = np.where(idx_nonnanszeros)[0][0]
-            idx_nonnanszeros_last = np.where(idx_nonnanszeros)[0][-1]
-            confidence_sync_out[i,:idx_nonnanszeros_first] = 0
-            confidence_sync_out[i,idx_nonnanszeros_last:] = 0 
-        else:
-            confidence_sync_out[i,:] = 0
-        
-        # Turn keypoint values to nan if confidence is low. Keypoints with nan
-        # will be interpolated. In cases with more than 2 cameras, this will
-        # have no impact on triangulation, since corresponding confidence is 0.
-        # But with 2 cameras, we need the keypoint 2D coordinates to
-        # be interpolated. In both cases, not relying on garbage keypoints for
-        # interpolation matters when computing keypoint speeds, which are used
-        # for synchronization.            
-        key2D_out[i,nanInds,:] = np.nan
-    
-    # Helper function.
-    def nan_helper(y):
-        return np.isnan(y), lambda z: z.nonzero()[0]
-    
-    # Interpolate keypoints with nans.
-    for i in range(nMkrs):
-        for j in range(2):
-            if np.isnan(key2D_out[i,:,j]).all(): # only nans
-                key2D_out[i,:,j] = 0
-            elif np.isnan(key2D_out[i,:,j]).any():  # partially nans
-                nans, x = nan_helper(key2D_out[i,:,j])
-                if linearInterp:
-                    # Note: with linear interpolation, values are carried over
-                    # backward and forward for inleading and exiting nans.
-                    key2D_out[i,nans,j] = np.interp(x(nans), x(~nans), 
-                                                    key2D_out[i,~nans,j]) 
-                else:
-                    # Note: with cubic interpolate, values are garbage for
-                    # inleading and exiting nans.
-                    try:
-                        key2D_out[i,:,j] = pchip_interpolate(
-                            x(~nans), key2D_out[i,~nans,j], 
-                            np.arange(key2D_out.shape[1]))    
-                    except:
-                        key2D_out[i,nans,j] = np.interp(x(nans), x(~nans), 
-                                                        key2D_out[i,~nans,j])
+    # Turn low confidence values to 0s for confidence_sync_out whatever
+    # the number of cameras; confidence_sync_out is used for 
+    # calculating the reprojection error, and using nans rather than 
+    # 0s might affect the outcome.
+    confidence_sync_out[nanInds] = 0
+    zero_in_out(confidence_sync_out)
+    
+    # Turn keypoint values to nan if confidence is low. Keypoints with nan
+    # will be interpolated. In cases with more than 2 cameras, this will
+    # have no impact on triangulation, since corresponding confidence is 0.
+    # But with 2 cameras, we need the keypoint 2D coordinates to
+    # be interpolated. In both cases, not relying on garbage keypoints for
+    # interpolation matters when computing keypoint speeds, which are used
+    # for synchronization.            
+    for j in range(2):
+        columns[j::2][nanInds] = np.nan
+    
+    # Interpolate keypoints with nans, all marker-coordinate columns at once.
+    nans = np.isnan(columns)
+    allNans = np.all(nans, axis=1)
+    columns[allNans,:] = 0 # only nans
+    partialNans = np.flatnonzero(np.any(nans, axis=1) & ~allNans)
+    frames = np.arange(columns.shape[1])
+    if linearInterp:
+        # Note: with linear interpolation, values are carried over
+        # backward and forward for inleading and exiting nans.
+        # All columns are interpolated with a single np.interp call, on the
+        # flattened columns (frame index + column index * nFrames), clamping
+        # the inleading and exiting frames to the first and last valid frames 
+        # of their column.
+        nFrames = columns.shape[1]
+        nans[allNans,:] = False
+        idx_first = np.argmax(~nans, axis=1)
+        idx_last = nFrames - 1 - np.argmax(~nans[:,::-1], axis=1)
+        idx_nans = np.flatnonzero(nans)
+        idx_columns = idx_nans // nFrames
+        x = np.clip(idx_nans - idx_columns*nFrames, idx_first[idx_columns], 
+                    idx_last[idx_columns]) + idx_columns*nFrames
+        xp = np.flatnonzero(~nans)
+        columns_flat = np.reshape(columns, -1)
+        columns_flat[idx_nans] = np.interp(x, xp, columns_flat[xp])
+    else:
+        # Note: with cubic interpolate, values are garbage for
+        # inleading and exiting nans.
+        # pchip needs the valid frames of each column, so it is called per 
+        # column with nans.
+        for idx_column in partialNans:
+            pattern = nans[idx_column]
+            try:
+                columns[idx_column] = pchip_interpolate(
+                    frames[~pattern], columns[idx_column,~pattern], frames)    
+            except:
+                columns[idx_column,pattern] = np.interp(
+                    frames[pattern], frames[~pattern], 
+                    columns[idx_column,~pattern])
+    key2D_out = np.ascontiguousarray(
+        np.moveaxis(np.reshape(columns, (nMkrs, 2, -1)), 1, 2))
                         
     # Keep track of inleading and exiting nans when less than 3 cameras.
     if nCams>2:
         nans_in_out = np.array([np.nan, np.nan])        
     else:
         _, idxFaceMarkers = getOpenPoseFaceMarkers()       
-        nans_in = []
-        nans_out = []
-        for i in range(nMkrs):
-            if i not in idxFaceMarkers:
-                idx_nans = np.isnan(confidence_out[i,:])
-                if False in idx_nans:
-                    nans_in.append(np.where(idx_nans==False)[0][0])
-                    nans_out.append(np.where(idx_nans==False)[0][-1])
-                else:
-                    nans_in.append(np.nan)
-                    nans_out.append(np.nan)                    
-        in_max = np.max(np.asarray(nans_in))
-        out_min = np.min(np.asarray(nans_out))        
+        idxMarkers = [i for i in range(nMkrs) if i not in idxFaceMarkers]
+        idx_nonnans = ~np.isnan(confidence_out[idxMarkers,:])
+        hasNonNans = np.any(idx_nonnans, axis=1)
+        nans_in = np.where(hasNonNans, np.argmax(idx_nonnans, axis=1), np.nan)
+        nans_out = np.where(hasNonNans, idx_nonnans.shape[1] - 1 - 
+                            np.argmax(idx_nonnans[:,::-1], axis=1), np.nan)
+        in_max = np.max(nans_in)
+        out_min = np.min(nans_out)        
         nans_in_out = np.array([in_max, out_min])
     
 
     return key2D_out, confidence_out, nans_in_out, confidence_sync_out
 
+# %% Refine a sync lag by reprojection error minimization.
+# Lags +/- .2 seconds around lag (integer) are evaluated, the one with the
+# lowest reprojection error is returned (refined to a fraction of a frame if
+# subFrame), with the evaluated lags and their reprojection errors.
+def refineSyncLagReprojection(lag, dataForReproj, frameRate, subFrame=False):
+    
+    numFrames = int(.2*frameRate)
+    lags = np.arange(lag-numFrames,lag+numFrames+1)
+    reprojErrors, _ = calcReprojectionErrorForSyncSweep(
+        dataForReproj['CamParamList'], dataForReproj['keypointList'],
+        lags, dataForReproj['cams2UseReproj'], 
+        dataForReproj['confidence'], dataForReproj['cameras2Use'])
+    reprojErrors = reprojErrors[:,None]
+        
+    # Select the lag with the lowest reprojection error
+    refinedLag = lags[np.argmin(reprojErrors)]
+    if subFrame:
+        refinedLag = refinedLag + parabolicPeakOffset(-reprojErrors[:,0], np.argmin(reprojErrors))
+    
+    return refinedLag, lags, reprojErrors
+
 # %%
-def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=None, frameRate=60):
+def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=None, frameRate=60,
+               corr=None, subFrame=False):
     """Calculates the cross correlation and lags without normalization.
     
     The definition of the discrete cross-correlation is in:
@@ -2102,28 +2732,33 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
     
     Args:
     y1, y2: Should have the same length.
+    corr: Precomputed correlation of y1 and y2, eg from 
+        cross_corr_fft. If None, it is computed with np.correlate.
+    subFrame: If True, the lag is refined to a fraction of a frame by 
+        parabolic interpolation of the correlation (or reprojection error) peak.
     
     Returns:
     max_corr: Maximum correlation without normalization.
     lag: The lag in terms of the index.
     """
-    # Pad shorter signal with 0s
-    if len(y1) > len(y2):
-        temp = np.zeros(len(y1))
-        temp[0:len(y2)] = y2
-        y2 = np.copy(temp)
-    elif len(y2)>len(y1):
-        temp = np.zeros(len(y2))
-        temp[0:len(y1)] = y1
-        y1 = np.copy(temp)
-        
-    y1_auto_corr = np.dot(y1, y1) / len(y1)
-    y2_auto_corr = np.dot(y2, y2) / len(y1)
-    corr = np.correlate(y1, y2, mode='same')
-    # The unbiased sample size is N - lag.
-    unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
-    corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
-    shift = len(y1) // 2
+    if corr is None:
+        # Pad shorter signal with 0s
+        if len(y1) > len(y2):
+            temp = np.zeros(len(y1))
+            temp[0:len(y2)] = y2
+            y2 = np.copy(temp)
+        elif len(y2)>len(y1):
+            temp = np.zeros(len(y2))
+            temp[0:len(y1)] = y1
+            y1 = np.copy(temp)
+            
+        y1_auto_corr = np.dot(y1, y1) / len(y1)
+        y2_auto_corr = np.dot(y2, y2) / len(y1)
+        corr = np.correlate(y1, y2, mode='same')
+        # The unbiased sample size is N - lag.
+        unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
+        corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
+    shift = len(corr) // 2
     max_corr = np.max(corr)
     argmax_corr = np.argmax(corr)    
 
@@ -2141,19 +2776,18 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
         # look at 3 lags closest to 0
         if np.isscalar(lags):
             max_corr = corr[lags+shift]
+            if subFrame:
+                lags = lags + parabolicPeakOffset(corr, lags+shift)
             return max_corr, lags
         if len(lags)>3:
             lags = lags[np.argsort(np.abs(lags))[:3]]
         
-        reprojError = np.empty((len(lags),1))
-        reprojSuccess = []
-        for iPeak,lag in enumerate(lags):
-            # calculate reprojection error for each potential lag
-            reprojError[iPeak,0], reprojSuccessi = calcReprojectionErrorForSync(
-                dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                lag, dataForReproj['cams2UseReproj'], 
-                dataForReproj['confidence'], dataForReproj['cameras2Use'])
-            reprojSuccess.append(reprojSuccessi)
+        # calculate reprojection error for each potential lag
+        reprojError, reprojSuccess = calcReprojectionErrorForSyncSweep(
+            dataForReproj['CamParamList'], dataForReproj['keypointList'],
+            lags, dataForReproj['cams2UseReproj'], 
+            dataForReproj['confidence'], dataForReproj['cameras2Use'])
+        reprojError = reprojError[:,None]
         
         # find if min reproj error is clearly smaller than other peaks. If it is not,
         # don't use reproj error min for sync. E.g. with treadmill walking, reproj error may not work as
@@ -2163,7 +2797,7 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
         if reprojErrorRatio < 0.6 and not False in reprojSuccess: # tunable parameter. Usually around 0.25 for overground walking
             # find idx with minimum reprojection error 
             lag_corr = lags[np.argmin(reprojError)]
-            max_corr = corr[lag+shift]
+            max_corr = corr[lag_corr+shift]
             
             if multCorrGaussianStd is not None:
                 print('For {}, used reprojection error minimization to sync.'.format(dataForReproj['cameras2Use'][dataForReproj['cams2UseReproj'][1]]))
@@ -2173,25 +2807,15 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
             # This helps the fact that correlation peak is not always the best lag, esp for front-facing cameras
 
             # Create a list of lags to test that is +/- .2 seconds around the selected lag based on frameRate
-            numFrames = int(.2*frameRate)
-            lags = np.arange(lag_corr-numFrames,lag_corr+numFrames+1)
-            reprojErrors = np.empty((len(lags),1))
-
-            for iLag,lag in enumerate(lags):            
-                reprojErrors[iLag,0], _ = calcReprojectionErrorForSync(
-                    dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                    lag, dataForReproj['cams2UseReproj'], 
-                    dataForReproj['confidence'], dataForReproj['cameras2Use'])
-                
-            # Select the lag with the lowest reprojection error
-            lag = lags[np.argmin(reprojErrors)]
+            lag, lags, reprojErrors = refineSyncLagReprojection(
+                lag_corr, dataForReproj, frameRate, subFrame=subFrame)
 
             # plot the reproj errors against lag and identify which was lag_corr
             if visualize:
                 plt.figure()
                 plt.plot(lags,reprojErrors)
                 plt.plot(lag_corr,reprojErrors[list(lags).index(lag_corr)],marker='o',color='r')
-                plt.plot(lag,reprojErrors[list(lags).index(lag)],marker='o',color='k')
+                plt.plot(lag,reprojErrors[np.argmin(reprojErrors)],marker='o',color='k')
                 plt.xlabel('lag')
                 plt.ylabel('reprojection error')
                 plt.title('Reprojection error vs lag')
@@ -2217,12 +2841,82 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
     max_corr = np.nanmax(corr)
     
     lag = argmax_corr-shift
+    if subFrame:
+        lag = lag + parabolicPeakOffset(corr, argmax_corr)
     
     return max_corr, lag
 
 
+# %% Sub-frame peak location.
+# Offset (in samples, between -0.5 and 0.5) of the maximum of the parabola 
+# through the peak of y at index idx and its two neighbors.
+def parabolicPeakOffset(y, idx):
+    if idx <= 0 or idx >= len(y)-1:
+        return 0.
+    y0, y1, y2 = y[idx-1], y[idx], y[idx+1]
+    denom = y0 - 2*y1 + y2
+    if not np.all(np.isfinite([y0, y1, y2])) or denom >= 0:
+        return 0.
+    return float(np.clip(.5 * (y0 - y2) / denom, -.5, .5))
+
+# %% Resample keypoints at fractional frame indices.
+# key: nMkrs x nFrames x 2 keypoints, conf: nMkrs x nFrames confidence,
+# frameInds: fractional frame indices (within [0, nFrames-1]) to sample at.
+# Keypoints are linearly interpolated, confidence is the minimum of the
+# confidence of the 2 neighboring frames.
+def resampleKeypoints(key, conf, frameInds):
+    frameInds = np.clip(np.asarray(frameInds, dtype=float), 0, key.shape[1]-1)
+    i0 = np.floor(frameInds).astype(int)
+    i1 = np.minimum(i0+1, key.shape[1]-1)
+    alpha = (frameInds - i0)[None,:]
+    keyResampled = (1-alpha[:,:,None])*key[:,i0,:] + alpha[:,:,None]*key[:,i1,:]
+    confResampled = np.minimum(conf[:,i0], conf[:,i1])
+    # No interpolation at integer indices.
+    atFrame = alpha[0] == 0
+    confResampled[:,atFrame] = conf[:,i0[atFrame]]
+    
+    return keyResampled, confResampled
+
+# %% FFT-based cross correlation.
+# Computes the same normalized correlations as cross_corr and 
+# cross_corr_multiple_timeseries (np.correlate(y1, y2, mode='same') divided by
+# the unbiased sample size N-|lag| and by the auto correlations), for a list of
+# signals against the same reference signal, with a single batched rFFT. The
+# unbiased sample size is computed analytically.
+# Y1List: list of (..., nSamples_i) arrays, eg the vertical velocity of each
+# camera or the nMkrs x nSamples marker speeds of each camera.
+# y2: (..., nSamples_0) reference signal, eg from the first camera.
+# Returns a list of (..., max(nSamples_i, nSamples_0)) correlations.
+def cross_corr_fft(Y1List, y2):
+    y2 = np.asarray(y2, dtype=float)
+    lengths = [max(np.shape(Y1)[-1], y2.shape[-1]) for Y1 in Y1List]
+    nFFT = scipy.fft.next_fast_len(2*max(lengths)-1, real=True)
+    
+    Y1 = np.zeros((len(Y1List),) + y2.shape[:-1] + (max(lengths),))
+    for i, y1 in enumerate(Y1List):
+        Y1[i,...,:np.shape(y1)[-1]] = y1
+    # Circular correlation, corrFull[..., k] = sum_n y1[n+k] * y2[n]
+    corrFull = scipy.fft.irfft(scipy.fft.rfft(Y1, nFFT) * 
+                               np.conj(scipy.fft.rfft(y2, nFFT)), nFFT)
+    
+    y1_auto_corr_all = np.sum(Y1**2, axis=-1)
+    y2_auto_corr_all = np.sum(y2**2, axis=-1)
+    corrList = []
+    for i, N in enumerate(lengths):
+        # np.correlate(mode='same') returns lags -N//2 to N-N//2-1.
+        lags = np.arange(N) - N//2
+        corr = corrFull[i][...,lags % nFFT]
+        unbiased_sample_size = N - np.abs(lags)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = corr / unbiased_sample_size / np.sqrt(
+                y1_auto_corr_all[i] / N * y2_auto_corr_all / N)[...,None]
+        corrList.append(corr)
+        
+    return corrList
+
 # %%
-def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj=None,visualize=False,frameRate=60):
+def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj=None,visualize=False,frameRate=60,
+                                   corrMat=None, subFrame=False):
     
     # SHAPE OF Y1,Y2 is nMkrs by nSamples
     """Calculates the cross correlation and lags without normalization.
@@ -2232,34 +2926,39 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
     
     Args:
     y1, y2: Should have the same length.
+    corrMat: Precomputed nMkrs x nSamples correlations of Y1 and Y2, eg from
+        cross_corr_fft. If None, they are computed with np.correlate.
+    subFrame: If True, the lag is refined to a fraction of a frame by 
+        parabolic interpolation of the correlation (or reprojection error) peak.
     
     Returns:
     max_corr: Maximum correlation without normalization.
     lag: The lag in terms of the index.
     """
     nMkrs = Y1.shape[0]
-    corrMat = np.empty(Y1.shape)
-    for iMkr in range(nMkrs):
-        y1=Y1[iMkr,:]
-        y2=Y2[iMkr,:]
-        # Pad shorter signal with 0s
-        if len(y1) > len(y2):
-            temp = np.zeros(len(y1))
-            temp[0:len(y2)] = y2
-            y2 = np.copy(temp)
-        elif len(y2)>len(y1):
-            temp = np.zeros(len(y2))
-            temp[0:len(y1)] = y1
-            y1 = np.copy(temp)
-            
-        y1_auto_corr = np.dot(y1, y1) / len(y1)
-        y2_auto_corr = np.dot(y2, y2) / len(y1)
-        corr = np.correlate(y1, y2, mode='same')
-        # The unbiased sample size is N - lag
-        unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
-        corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
-        shift = len(y1) // 2
-        corrMat[iMkr,:] = corr  
+    if corrMat is None:
+        corrMat = np.empty((nMkrs, max(Y1.shape[1], Y2.shape[1])))
+        for iMkr in range(nMkrs):
+            y1=Y1[iMkr,:]
+            y2=Y2[iMkr,:]
+            # Pad shorter signal with 0s
+            if len(y1) > len(y2):
+                temp = np.zeros(len(y1))
+                temp[0:len(y2)] = y2
+                y2 = np.copy(temp)
+            elif len(y2)>len(y1):
+                temp = np.zeros(len(y2))
+                temp[0:len(y1)] = y1
+                y1 = np.copy(temp)
+                
+            y1_auto_corr = np.dot(y1, y1) / len(y1)
+            y2_auto_corr = np.dot(y2, y2) / len(y1)
+            corr = np.correlate(y1, y2, mode='same')
+            # The unbiased sample size is N - lag
+            unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
+            corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
+            corrMat[iMkr,:] = corr  
+    shift = corrMat.shape[1] // 2
     
     if visualize:
         plt.figure()
@@ -2284,19 +2983,18 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
         # look at 3 lags closest to 0
         if np.isscalar(lags):
             max_corr = summedCorr[lags+shift]
+            if subFrame:
+                lags = lags + parabolicPeakOffset(summedCorr, lags+shift)
             return max_corr, lags
         if len(lags)>3:
             lags = lags[np.argsort(np.abs(lags))[:3]]
         
-        reprojError = np.empty((len(lags),1))
-        reprojSuccess = []
-        for iPeak,lag in enumerate(lags):
-            # calculate reprojection error for each potential lag
-            reprojError[iPeak,0], reprojSuccessi = calcReprojectionErrorForSync(
-                dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                lag, dataForReproj['cams2UseReproj'], 
-                dataForReproj['confidence'], dataForReproj['cameras2Use'])
-            reprojSuccess.append(reprojSuccessi)
+        # calculate reprojection error for each potential lag
+        reprojError, reprojSuccess = calcReprojectionErrorForSyncSweep(
+            dataForReproj['CamParamList'], dataForReproj['keypointList'],
+            lags, dataForReproj['cams2UseReproj'], 
+            dataForReproj['confidence'], dataForReproj['cameras2Use'])
+        reprojError = reprojError[:,None]
         
         # find if min reproj error is clearly smaller than other peaks. If it is not,
         # don't use reproj error min for sync. E.g. with treadmill walking, reproj error may not work as
@@ -2306,7 +3004,7 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
         if reprojErrorRatio < 0.6 and not False in reprojSuccess: # tunable parameter. Usually around 0.25 for overground walking
             # find idx with minimum reprojection error 
             lag_corr = lags[np.argmin(reprojError)]
-            max_corr = summedCorr[lag+shift]
+            max_corr = summedCorr[lag_corr+shift]
             
             if multCorrGaussianStd is not None:
                 print('For {}, used reprojection error minimization to sync.'.format(dataForReproj['cameras2Use'][dataForReproj['cams2UseReproj'][1]]))
@@ -2316,25 +3014,15 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
             # This helps the fact that correlation peak is not always the best lag, esp for front-facing cameras
 
             # Create a list of lags to test that is +/- .2 seconds around the selected lag based on frameRate
-            numFrames = int(.2*frameRate)
-            lags = np.arange(lag_corr-numFrames,lag_corr+numFrames+1)
-            reprojErrors = np.empty((len(lags),1))
-
-            for iLag,lag in enumerate(lags):            
-                reprojErrors[iLag,0], _ = calcReprojectionErrorForSync(
-                    dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                    lag, dataForReproj['cams2UseReproj'], 
-                    dataForReproj['confidence'], dataForReproj['cameras2Use'])
-                
-            # Select the lag with the lowest reprojection error
-            lag = lags[np.argmin(reprojErrors)]
+            lag, lags, reprojErrors = refineSyncLagReprojection(
+                lag_corr, dataForReproj, frameRate, subFrame=subFrame)
 
             # plot the reproj errors against lag and identify which was lag_corr
             if visualize:
                 plt.figure()
                 plt.plot(lags,reprojErrors)
                 plt.plot(lag_corr,reprojErrors[list(lags).index(lag_corr)],marker='o',color='r')
-                plt.plot(lag,reprojErrors[list(lags).index(lag)],marker='o',color='k')
+                plt.plot(lag,reprojErrors[np.argmin(reprojErrors)],marker='o',color='k')
                 plt.xlabel('lag')
                 plt.ylabel('reprojection error')
                 plt.title('Reprojection error vs lag')
@@ -2353,8 +3041,79 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
     max_corr = np.nanmax(summedCorr)/corrMat.shape[0] 
     
     lag = argmax_corr-shift
+    if subFrame:
+        lag = lag + parabolicPeakOffset(summedCorr, argmax_corr)
     return max_corr, lag
 
+# %% Pairwise synchronization.
+# Estimates the lag of every camera pair from the correlation of their sync
+# signals (vertical velocities: nSamples arrays, or marker speeds: nMkrs x 
+# nSamples arrays, in which case the correlations of the markers are summed).
+# All pairs with the same reference camera are correlated in one batched FFT.
+# lagMat[i,j] is the lag of camera i relative to camera j, as returned by
+# cross_corr(signals[i], signals[j]). weightMat[i,j] is the (mean)
+# correlation at that lag, 0 for negative or nan correlations.
+def estimatePairwiseLags(signals, multCorrGaussianStd=None):
+    nCams = len(signals)
+    lagMat = np.zeros((nCams,nCams))
+    weightMat = np.zeros((nCams,nCams))
+    for j in range(nCams-1):
+        corrList = cross_corr_fft(signals[j+1:], signals[j])
+        for i, corr in zip(range(j+1,nCams), corrList):
+            if corr.ndim > 1:
+                corr = np.nansum(corr,axis=0) / corr.shape[0]
+            shift = len(corr) // 2
+            # Multiply correlation curve by gaussian (prioritizing lag solution closest to 0)
+            corrWeighted = np.nan_to_num(corr, nan=-np.inf)
+            if multCorrGaussianStd is not None:
+                corrWeighted = np.multiply(corrWeighted,gaussian(len(corr),multCorrGaussianStd))
+            argmax_corr = np.argmax(corrWeighted)
+            lagMat[i,j] = argmax_corr - shift
+            lagMat[j,i] = -lagMat[i,j]
+            weightMat[i,j] = weightMat[j,i] = np.nan_to_num(
+                np.clip(corr[argmax_corr], 0, None))
+            
+    return lagMat, weightMat
+
+# %% Global synchronization offsets from pairwise lags.
+# Solves the weighted least-squares problem 
+#   min sum_ij w_ij * (o_i - o_j - lag_ij)^2, with o_0 = 0,
+# for the offset o_i of every camera (same convention as the lags returned by
+# cross_corr against Cam0). Pairs that are inconsistent with the other pairs 
+# are down-weighted with iteratively reweighted least squares (Cauchy weights,
+# robustThreshold in frames). Cameras that are not connected to the others get
+# a 0 offset.
+def solveSyncOffsets(lagMat, weightMat, robustThreshold=2, nIterations=10):
+    nCams = lagMat.shape[0]
+    iPairs, jPairs = np.triu_indices(nCams, k=1)
+    lags = lagMat[iPairs,jPairs]
+    weights = weightMat[iPairs,jPairs]
+    # Incidence matrix of the pairs, without the column of Cam0 (o_0 = 0).
+    A = np.zeros((len(iPairs),nCams))
+    A[np.arange(len(iPairs)),iPairs] = 1
+    A[np.arange(len(iPairs)),jPairs] = -1
+    A = A[:,1:]
+    
+    robustWeights = np.ones(len(lags))
+    for _ in range(nIterations):
+        W = weights * robustWeights
+        # Small regularization towards 0 for unconnected cameras.
+        AtWA = A.T.dot(W[:,None]*A) + 1e-9*np.eye(nCams-1)
+        offsets = np.linalg.solve(AtWA, A.T.dot(W*lags))
+        residuals = np.abs(A.dot(offsets) - lags)
+        robustWeights = 1 / (1 + (residuals/robustThreshold)**2)
+        
+    return np.concatenate(([0], offsets))
+
+# %% Camera rig.
+# Builds the camera objects and projection matrices once, so they can be
+# reused for every frame, lag candidate, or camera combination.
+def getCameraRig(CameraParams, names=None, useRotationEuler=False):
+    if isinstance(CameraParams, CameraRig):
+        return CameraParams
+    return CameraRig(CameraParams, names=names,
+                     use_rotation_euler=useRotationEuler)
+
 # %% Triangulation
 # If you set ignoreMissingMarkers to True, and pass the DISTORTED keypoints
 # as keypoints2D, the triangulation will ignore data from cameras that
@@ -2362,24 +3121,19 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
 def triangulateMultiview(CameraParamList, points2dUndistorted, 
                           imageScaleFactor=1, useRotationEuler=False,
                           ignoreMissingMarkers=False,selectCamerasMinReprojError = False,
-                          ransac = False, keypoints2D=[],confidence=None):
-    # create a list of cameras (says sequence in documentation) from CameraParamList
-    cameraList = []    
-    nCams = len(CameraParamList) 
+                          ransac = False, keypoints2D=[],confidence=None,
+                          returnViewMask=False):
+    # If both selectCamerasMinReprojError and ransac are True, RANSAC is used.
+    # If returnViewMask, also returns the nCams x nMkrs mask of the cameras
+    # used to triangulate each marker (e.g., to refine the points with the
+    # same cameras, see refineTriangulationBatch).
+    # create a list of cameras (says sequence in documentation) from CameraParamList.
+    # CameraParamList can also be a CameraRig, in which case the cameras are
+    # not rebuilt.
+    cameraRig = getCameraRig(CameraParamList, useRotationEuler=useRotationEuler)
+    cameraList = cameraRig.cameras
+    nCams = len(cameraRig) 
     nMkrs = np.shape(points2dUndistorted[0])[0]
-    
-    for camParams in CameraParamList:
-        # get rotation matrix
-        if useRotationEuler:
-            rotMat = cv2.Rodrigues(camParams['rotation_EulerAngles'])[0]
-        else:
-            rotMat = camParams['rotation']
-        
-        c = Camera()
-        c.set_K(camParams['intrinsicMat'])
-        c.set_R(rotMat)
-        c.set_t(np.reshape(camParams['translation'],(3,1)))
-        cameraList.append(c)
            
    
     # triangulate
@@ -2390,112 +3144,37 @@ def triangulateMultiview(CameraParamList, points2dUndistorted,
     
    
     points3d,confidence3d = nview_linear_triangulations(cameraList,pointsInput,weights=confidence)
+    if confidence is not None:
+        viewMask = np.stack(confidence) != 0
+    else:
+        viewMask = np.ones((nCams, nMkrs), dtype=bool)
 
     
     # Below are some outlier rejection methods
     
-    # A slow, hacky way of rejecting outliers, like RANSAC. 
-    # Select the combination of cameras that minimize mean reprojection error for all cameras
-    if selectCamerasMinReprojError and nCams>2:
-        
-        # Function definitions
-        def generateCameraCombos(nCams):
-            comb = [] ;
-            k=nCams-1 ;           
-            comb.append(tuple(range(nCams)))
-            while k>=2:
-                comb = comb + list(combinations(np.arange(nCams),k))
-                k=k-1
-            return comb
-        
-
-        # generate a list of all possible camera combinations down to 2
-        camCombos = generateCameraCombos(len(cameraList))
-        
-        # triangulate for all camera combiations
-        points3DList = []
-        nMkrs = confidence[0].shape[0]
-        reprojError = np.empty((nMkrs,len(camCombos)))
-                
-        for iCombo,camCombo in enumerate(camCombos):
-            camList = [cameraList[i] for i in camCombo]
-            points2DList = [pts[:,camCombo] for pts in pointsInput]
-            conf = [confidence[i] for i in camCombo]
-            
-            points3DList.append(nview_linear_triangulations(camList,points2DList,weights=conf))
-        
-            # compute per-marker, confidence-weighted reprojection errors for all camera combinations
-            # reprojError[:,iCombo] = calcReprojectionError(camList,points2DList,points3DList[-1],weights=conf)
-            reprojError[:,iCombo] = calcReprojectionError(cameraList,pointsInput,points3DList[-1],weights=confidence)
-
-        # select the triangulated point from camera set that minimized reprojection error
-        new3Dpoints = np.empty((3,nMkrs))
-        for iMkr in range(nMkrs):
-            new3Dpoints[:,iMkr] = points3DList[np.argmin(reprojError[iMkr,:])][:,iMkr]
-        
-        points3d = new3Dpoints
+    # A way of rejecting outliers, like RANSAC. 
+    # Select the combination of cameras that minimize mean reprojection error for all cameras.
+    # All combinations down to 2 cameras are evaluated at once from the
+    # per-camera normal matrices (see nview_linear_triangulations_subsets).
+    if selectCamerasMinReprojError and not ransac and nCams>2:
+        if confidence is not None:
+            weights = np.stack(confidence)
+        else:
+            weights = None
+        points3d, best, subsets = nview_linear_triangulations_subsets(
+            cameraRig.P, stackedPoints[:,:,0,:], weights=weights)
+        viewMask &= getSubsetsViewMask(subsets, best, nCams)
         
-    #RANSAC for outlier rejection - on a per-marker basis, not a per-camera basis. Could be part of the problem
-    #Not clear that this is helpful 4/23/21
+    #RANSAC for outlier rejection - on a per-marker basis, not a per-camera basis.
+    # Camera-pair hypotheses are evaluated for all markers at once (see
+    # nview_linear_triangulations_ransac).
     if ransac and nCams>2:
-        nIter = np.round(np.log(.01)/np.log(1-np.power(.75,2))) # log(1 - prob of getting optimal set) / log(1-(n_inliers/n_points)^minPtsForModel)
-        #TODO make this a function of image resolution
-        errorUB = 20 # pixels, below this reprojection error, another camera gets added. 
-        nGoodModel =3  # model must have this many cameras to be considered good
-        
-        #functions
-        def triangulateLimitedCameras(cameraList,pointsInput,confidence,cameraNumList):
-            camList = [cameraList[i] for i in cameraNumList]
-            points2DList = [pts[:,cameraNumList] for pts in pointsInput]
-            conf = [confidence[i] for i in cameraNumList]
-            points3D = nview_linear_triangulations(camList,points2DList,weights=conf)
-            return points3D
-        
-        def reprojErrorLimitedCameras(cameraList,pointsInput,points3D,confidence,cameraNumList):
-            if type(cameraNumList) is not list: cameraNumList = [cameraNumList]
-            camList = [cameraList[i] for i in cameraNumList]
-            points2DList = [pts[:,cameraNumList] for pts in pointsInput]
-            conf = [confidence[i] for i in cameraNumList]
-            reprojError = calcReprojectionError(camList,points2DList,points3D,weights=conf)
-            return reprojError
-
-        
-        #initialize
-        bestReprojError = 1000 * np.ones(nMkrs) # initial, large value
-        best3Dpoint = np.empty((points3d.shape))
-        camComboList = [[] for _ in range(nMkrs)]
-        
-        for iIter in range(int(nIter)):
-            np.random.seed(iIter)
-            camCombo = np.arange(nCams)
-            np.random.shuffle(camCombo) # Seed setting should give same combos every run
-            maybeInliers = list(camCombo[:2])
-            alsoInliers = [[] for _ in range(nMkrs)]
-            
-            
-            # triangulate maybe inliers
-            points3D = triangulateLimitedCameras(cameraList,pointsInput,confidence,maybeInliers)
-            
-            #error on next camera
-            for iMkr in range(nMkrs):
-                for j in range(nCams-2):
-                    er = reprojErrorLimitedCameras(cameraList,pointsInput,points3D,confidence,camCombo[2+j])
-                    # print(er[iMkr])
-                    if er[iMkr] < errorUB:
-                        alsoInliers[iMkr].append(camCombo[2+j])
-                # see if error is bigger than previous, if not, use this combo to triangulate
-                # just 1 marker
-                if (len(maybeInliers) + len(alsoInliers[iMkr])) >= nGoodModel:
-                    thisConf = [np.atleast_1d(c[iMkr]) for c in confidence]
-                    point3D = triangulateLimitedCameras(cameraList,[pointsInput[iMkr]],thisConf,maybeInliers + alsoInliers[iMkr])
-                    er3D = reprojErrorLimitedCameras(cameraList,[pointsInput[iMkr]],point3D,thisConf,maybeInliers + alsoInliers[iMkr])    
-                    # if er3D<bestReprojError[iMkr]:
-                    if (len(maybeInliers) + len(alsoInliers[iMkr])) > len(camComboList[iMkr]):
-                        best3Dpoint[:,iMkr] = point3D.T
-                        bestReprojError[iMkr] = er3D
-                        camComboList[iMkr] = maybeInliers.copy() + alsoInliers[iMkr].copy()
-
-        points3d = best3Dpoint
+        if confidence is not None:
+            weights = np.stack(confidence)
+        else:
+            weights = None
+        points3d, viewMask = nview_linear_triangulations_ransac(
+            cameraRig.P, stackedPoints[:,:,0,:], weights=weights)
                                     
     
     if ignoreMissingMarkers and nCams>2:        
@@ -2522,9 +3201,111 @@ def triangulateMultiview(CameraParamList, points2dUndistorted,
             
             # overwritte marker
             points3d[:, missingMarker] = points3d_missingMarker[:, missingMarker]
+            viewMask[:, missingMarker] = True
+            viewMask[idx_missingCam, missingMarker] = False
+            if confidence is not None:
+                viewMask[:, missingMarker] &= (
+                    np.stack(confidence)[:, missingMarker] != 0)
+    
+    if returnViewMask:
+        return points3d, confidence3d, viewMask
     
     return points3d, confidence3d
 
+# %% Cameras used for each point by nview_linear_triangulations_subsets.
+def getSubsetsViewMask(subsets, best, nCams):
+    
+    subsetMask = np.zeros((len(subsets), nCams), dtype=bool)
+    for i, subset in enumerate(subsets):
+        subsetMask[i, list(subset)] = True
+    
+    return subsetMask[best].T
+
+
+# %% Batched triangulation.
+# Triangulates all markers of all frames at once: the weighted D matrices of
+# the linear triangulation are built for all (marker, frame) pairs as one
+# stack and solved with a single batched eigendecomposition. Gives the same
+# results as calling triangulateMultiview frame by frame, including the
+# confidence semantics (nan -> 0.5, <2 cameras -> zero point with zero
+# confidence).
+# If selectCamerasMinReprojError, each point is triangulated with the
+# combination of cameras that minimizes the mean reprojection error, all
+# combinations of all markers and frames being evaluated at once.
+# If ransac, each point is triangulated with RANSAC over camera pairs, with
+# deterministic hypotheses (ransacSeed). If both are True, RANSAC is used.
+# If returnViewMask, also returns the nCams x nMkrs x nFrames mask of the
+# cameras used to triangulate each point (non-zero confidence, selected subset
+# or RANSAC inliers).
+def triangulateMultiviewBatch(CameraParamList, keypoints2D, confidence=None,
+                              useRotationEuler=False,
+                              selectCamerasMinReprojError=False,
+                              ransac=False, ransacSeed=0,
+                              returnViewMask=False):
+    # keypoints2D: nCams x nMkrs x nFrames x 2 array of undistorted keypoints.
+    # confidence: nCams x nMkrs x nFrames array, or None for no weighting.
+    # Returns 3 x nMkrs x nFrames points and 1 x nMkrs x nFrames confidence.
+    nCams, nMkrs, nFrames, _ = keypoints2D.shape
+    cameraRig = getCameraRig(CameraParamList, useRotationEuler=useRotationEuler)
+    
+    if confidence is not None:
+        confidence = np.reshape(confidence, (nCams, nMkrs*nFrames))
+    keypoints2D = np.reshape(keypoints2D, (nCams, nMkrs*nFrames, 2))
+    points3D, confidence3D = nview_linear_triangulations_batch(
+        cameraRig.P, keypoints2D, weights=confidence)
+    if confidence is not None:
+        viewMask = confidence != 0
+    else:
+        viewMask = np.ones((nCams, nMkrs*nFrames), dtype=bool)
+    if selectCamerasMinReprojError and not ransac and nCams>2:
+        points3D, best, subsets = nview_linear_triangulations_subsets(
+            cameraRig.P, keypoints2D, weights=confidence)
+        viewMask &= getSubsetsViewMask(subsets, best, nCams)
+    if ransac and nCams>2:
+        start = time.time()
+        points3D, inliers = nview_linear_triangulations_ransac(
+            cameraRig.P, keypoints2D, weights=confidence, seed=ransacSeed)
+        viewMask = inliers
+        if confidence is not None:
+            nObservations = np.count_nonzero(confidence)
+        else:
+            nObservations = inliers.size
+        nRejected = nObservations - np.count_nonzero(inliers)
+        print('RANSAC triangulation of {} points took {:.2f} s, rejected {} of {} observations.'.format(
+            nMkrs*nFrames, time.time()-start, nRejected, nObservations))
+    
+    points3D = np.reshape(points3D, (3, nMkrs, nFrames))
+    confidence3D = np.reshape(confidence3D, (1, nMkrs, nFrames))
+    
+    if returnViewMask:
+        return (points3D, confidence3D, 
+                np.reshape(viewMask, (nCams, nMkrs, nFrames)))
+    
+    return points3D, confidence3D
+
+# %% Nonlinear refinement of triangulated points.
+# Minimizes the confidence-weighted reprojection error of each point with
+# Levenberg-Marquardt, for all markers and frames at once, starting from the
+# (linear) triangulation. Stops after timeBudget seconds.
+def refineTriangulationBatch(CameraParamList, keypoints2D, points3D, 
+                             confidence=None, timeBudget=10, maxIterations=20):
+    # keypoints2D: nCams x nMkrs x nFrames x 2 array of undistorted keypoints.
+    # points3D: 3 x nMkrs x nFrames array of triangulated points.
+    # confidence: nCams x nMkrs x nFrames array, or None for no weighting.
+    nCams, nMkrs, nFrames, _ = keypoints2D.shape
+    cameraRig = getCameraRig(CameraParamList)
+    
+    if confidence is not None:
+        confidence = np.reshape(confidence, (nCams, nMkrs*nFrames))
+    points3D_refined, stats = refine_triangulations(
+        cameraRig.P, np.reshape(keypoints2D, (nCams, nMkrs*nFrames, 2)),
+        np.reshape(points3D, (3, nMkrs*nFrames)), weights=confidence,
+        max_iterations=maxIterations, time_budget=timeBudget)
+    print('Triangulation refinement: {} iterations in {:.2f} s, {}/{} points converged, weighted RMS reprojection error {:.3f} -> {:.3f} px.'.format(
+        stats['iterations'], stats['duration'], stats['n_converged'],
+        stats['n_points'], stats['initial_rms_error'], stats['final_rms_error']))
+    
+    return np.reshape(points3D_refined, (3, nMkrs, nFrames))
 
 # %% Get 3D keypoints by triangulation.
 # If you set ignoreMissingMarkers to True, and pass the DISTORTED keypoints
@@ -2537,10 +3318,62 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
                               spline3dZeros = False, splineMaxFrames=5, nansInOut=[],
                               CameraDirectories = None, trialName = None,
                               startEndFrames=None, trialID='',
-                              outputMediaFolder=None):
+                              outputMediaFolder=None, batchTriangulation=False,
+                              selectCamerasMinReprojError=False, ransac=False,
+                              refineTriangulation=False, refinementTimeBudget=10,
+                              writeVideosAsync=False, videoPreset=None):
     # cams2Use is a list of cameras that you want to use in triangulation. 
     # if first entry of list is ['all'], will use all
     # otherwise, ['Cam0','Cam2']
+    # If batchTriangulation is True, all markers of all frames are
+    # triangulated at once (see triangulateMultiviewBatch). This is not
+    # compatible with ignoreMissingMarkers, for which we fall back to the
+    # frame-by-frame triangulation.
+    # If selectCamerasMinReprojError is True, each point is triangulated with
+    # the combination of cameras that minimizes the reprojection error. If
+    # ransac is True, each point is triangulated with RANSAC over camera pairs
+    # (if both are True, RANSAC is used).
+    # If refineTriangulation is True, the triangulated points are refined by
+    # minimizing the confidence-weighted reprojection error, within
+    # refinementTimeBudget seconds (see refineTriangulationBatch). Only the
+    # cameras used by the triangulation are used by the refinement, such that
+    # views rejected by selectCamerasMinReprojError or ransac stay rejected.
+    # keypointDict and confidenceDict can also be lists with one dict per
+    # subject (see synchronizeVideos with trackAllPeople), in which case lists
+    # with points3D and confidence3D of each subject are returned. The
+    # synchronized videos are then written for the first subject.
+    # The synchronized videos of all cameras are written in parallel, with the
+    # x264 preset videoPreset (e.g., 'veryfast', None: ffmpeg default). If
+    # writeVideosAsync is True, this function returns before they are written
+    # (see utils.waitForVideoRewrites).
+    if isinstance(keypointDict, list):
+        if not confidenceDict:
+            confidenceDict = [{} for _ in keypointDict]
+        points3DList = []
+        confidence3DList = []
+        for iSubject, (c_keypointDict, c_confidenceDict) in enumerate(
+                zip(keypointDict, confidenceDict)):
+            points3D, confidence3D = triangulateMultiviewVideo(
+                CameraParamDict, c_keypointDict, 
+                imageScaleFactor=imageScaleFactor,
+                ignoreMissingMarkers=ignoreMissingMarkers, 
+                keypoints2D=keypoints2D, cams2Use=cams2Use,
+                confidenceDict=c_confidenceDict, trimTrial=trimTrial,
+                spline3dZeros=spline3dZeros, splineMaxFrames=splineMaxFrames,
+                nansInOut=nansInOut, 
+                CameraDirectories=CameraDirectories if iSubject == 0 else None,
+                trialName=trialName, startEndFrames=startEndFrames, 
+                trialID=trialID, outputMediaFolder=outputMediaFolder,
+                batchTriangulation=batchTriangulation,
+                selectCamerasMinReprojError=selectCamerasMinReprojError,
+                ransac=ransac, refineTriangulation=refineTriangulation,
+                refinementTimeBudget=refinementTimeBudget,
+                writeVideosAsync=writeVideosAsync, videoPreset=videoPreset)
+            points3DList.append(points3D)
+            confidence3DList.append(confidence3D)
+            
+        return points3DList, confidence3DList
+    
     CameraParamList = [CameraParamDict[i] for i in CameraParamDict]
     if cams2Use[0] == 'all' and not None in CameraParamList:
         keypointDict_selectedCams = keypointDict
@@ -2566,22 +3399,55 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
     
     keypointList_selectedCams = [keypointDict_selectedCams[i] for i in keypointDict_selectedCams]
     confidenceList_selectedCams = [confidenceDict_selectedCams[i] for i in confidenceDict_selectedCams]
-    CameraParamList_selectedCams = [CameraParamDict_selectedCams[i] for i in CameraParamDict_selectedCams]
-    unpackedKeypoints = unpackKeypointList(keypointList_selectedCams)
-    points3D = np.zeros((3,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
-    confidence3D = np.zeros((1,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
-    
+    # Build the camera rig once for the whole trial. If a CameraRig was
+    # passed in, only select the cameras.
+    if isinstance(CameraParamDict, CameraRig):
+        cameraRig_selectedCams = CameraParamDict.subset(
+            list(CameraParamDict_selectedCams.keys()))
+    else:
+        cameraRig_selectedCams = CameraRig(CameraParamDict_selectedCams)
     
-    for iFrame,points2d in enumerate(unpackedKeypoints):
-        # If confidence weighting
+    if batchTriangulation and not ignoreMissingMarkers:
         if confidenceDict:
-            thisConfidence = [c[:,iFrame] for c in confidenceList_selectedCams]
+            confidenceArray = np.stack(confidenceList_selectedCams)
         else:
-            thisConfidence = None
+            confidenceArray = None
+        points3D, confidence3D, viewMask = triangulateMultiviewBatch(
+            cameraRig_selectedCams, np.stack(keypointList_selectedCams),
+            confidence=confidenceArray,
+            selectCamerasMinReprojError=selectCamerasMinReprojError,
+            ransac=ransac, returnViewMask=True)
+    else:
+        unpackedKeypoints = unpackKeypointList(keypointList_selectedCams)
+        points3D = np.zeros((3,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
+        confidence3D = np.zeros((1,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
+        viewMask = np.zeros((len(keypointList_selectedCams),) + 
+                            keypointList_selectedCams[0].shape[:2], dtype=bool)
         
-        points3D[:,:,iFrame], confidence3D[:,:,iFrame] = triangulateMultiview(CameraParamList_selectedCams, points2d, 
-                          imageScaleFactor=1, useRotationEuler=False,
-                          ignoreMissingMarkers=ignoreMissingMarkers, keypoints2D=keypoints2D,confidence=thisConfidence)
+        for iFrame,points2d in enumerate(unpackedKeypoints):
+            # If confidence weighting
+            if confidenceDict:
+                thisConfidence = [c[:,iFrame] for c in confidenceList_selectedCams]
+            else:
+                thisConfidence = None
+            
+            points3D[:,:,iFrame], confidence3D[:,:,iFrame], viewMask[:,:,iFrame] = triangulateMultiview(cameraRig_selectedCams, points2d, 
+                              imageScaleFactor=1, useRotationEuler=False,
+                              ignoreMissingMarkers=ignoreMissingMarkers, keypoints2D=keypoints2D,confidence=thisConfidence,
+                              selectCamerasMinReprojError=selectCamerasMinReprojError,
+                              ransac=ransac, returnViewMask=True)
+    
+    if refineTriangulation:
+        # Views that were not used by the triangulation get zero weight.
+        if confidenceDict:
+            confidenceArray = np.where(
+                viewMask, np.stack(confidenceList_selectedCams), 0)
+        else:
+            confidenceArray = viewMask.astype(float)
+        points3D = refineTriangulationBatch(
+            cameraRig_selectedCams, np.stack(keypointList_selectedCams),
+            points3D, confidence=confidenceArray, 
+            timeBudget=refinementTimeBudget)
         
     if trimTrial:
         # Delete confidence and 3D keypoints if markers, except for face 
@@ -2631,9 +3497,12 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
                         list(CameraDirectories.values())[0],'../../','VisualizerVideos',trialName))
         # Check if the directory already exists
         if os.path.exists(outputVideoDir):
-            # If it exists, delete it and its contents
+            # If it exists, delete it and its contents, once videos still
+            # being written in the background are done.
+            waitForVideoRewrites()
             shutil.rmtree(outputVideoDir)
         os.makedirs(outputVideoDir,exist_ok=True)
+        videoFutures = []
         for iCam,camName in enumerate(keypointDict):
                         
             nFramesToWrite = endInd-startInd
@@ -2650,9 +3519,8 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
             
             # get frame rate and assume all the same for sync'd videos
             if iCam==0: 
-                thisVideo = cv2.VideoCapture(inputPath.replace('.mov', '_rotated.avi'))
-                frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
-                thisVideo.release()
+                frameRate = np.round(getVideoMetadata(
+                    getDecodedVideoPath(inputPath))['fps'])
             
             # Only rewrite if camera in cams2use and wasn't kicked out earlier
             if (camName in cams2Use or cams2Use[0] == 'all') and startEndFrames[camName] != None:
@@ -2664,9 +3532,14 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
                 
                 thisStartFrame = startInd + startEndFrames[camName][0]
                 
-                rewriteVideos(inputPath, thisStartFrame, nFramesToWrite, frameRate,
-                              outputDir=outputVideoDir, imageScaleFactor = .5,
-                              outputFileName = outputFileName)
+                videoFutures.append(rewriteVideosAsync(
+                    inputPath, thisStartFrame, nFramesToWrite, frameRate,
+                    outputDir=outputVideoDir, imageScaleFactor = .5,
+                    outputFileName = outputFileName, preset=videoPreset))
+        
+        if not writeVideosAsync:
+            for future in videoFutures:
+                future.result()
         
     if spline3dZeros:
     # Spline across positions with 0 3D confidence (i.e., there weren't 2 cameras
@@ -2748,17 +3621,33 @@ def findInternalZeroInds(x,maxLength):
 def calcReprojectionErrorForSync(CamParamList, keypointList, lagVal,
                                  cams2UseReproj, confidence, cameras2Use):
     
+    reprojErrors, reprojSuccess = calcReprojectionErrorForSyncSweep(
+        CamParamList, keypointList, [lagVal], cams2UseReproj, confidence, 
+        cameras2Use)
+    
+    return reprojErrors[0], reprojSuccess[0]
+
+# %% Reprojection error for a set of candidate lags.
+# The overlapping confidence ranges are computed once, and the keypoints at 
+# the sampled timesteps of all lags are gathered (no copies of the full 
+# trial) and triangulated in one batch. Returns the reprojection error and
+# success of each lag. Lags for which the sampled timesteps fall outside of
+# the trial get an infinite error.
+def calcReprojectionErrorForSyncSweep(CamParamList, keypointList, lags,
+                                      cams2UseReproj, confidence, cameras2Use):
+    
     # Number of timesteps to triangulate. Will average reprojection error over all nTimesteps.
     nTimesteps = 5 
+    lags = np.atleast_1d(np.asarray(lags, dtype=int))
     
-    keypoints2D = copy.deepcopy(keypointList)
-    conf = copy.deepcopy(confidence)
-    CamParamListCopy = copy.deepcopy(CamParamList)
+    # CamParamList can be a CameraRig (built once per trial), which we do
+    # not need to copy since it is not modified.
+    cameraRig = getCameraRig(CamParamList, names=cameras2Use)
     
     # Find the range of overlapping confidence for this lag value
     confSel = []
     for cam in cams2UseReproj:
-        confSel.append(conf[cam])
+        confSel.append(confidence[cam])
         
     # find confidence ranges in original indices
     confThresh = [.5*np.nanmax(c) for c in confSel] # Threshold for saying this camera confidently sees the person
@@ -2769,90 +3658,71 @@ def calcReprojectionErrorForSync(CamParamList, keypointList, lagVal,
     for i,c in enumerate(avgConf):
         temp = c > confThresh[i]
         if True in temp:
-            confRanges.append(np.array([np.argwhere(temp)[0], np.argwhere(temp)[-1]+1]))
+            confRanges.append(np.array([np.argwhere(temp)[0,0], np.argwhere(temp)[-1,0]+1]))
         else:
-            reprojErrorAcrossFrames = 0.1
-            reprojSuccess = False
+            reprojErrorAcrossFrames = 0.1 * np.ones(len(lags))
+            reprojSuccess = [False] * len(lags)
             return reprojErrorAcrossFrames, reprojSuccess
         
     # shift second camera based on lag, so indices are "aligned," then find overlapping range
-    shiftedConfRanges = copy.deepcopy(confRanges)
-    shiftedConfRanges[1] = shiftedConfRanges[1] - lagVal # shift the indices for second camera
     # Ignore the first and last few timesteps here as confidence drops
-    shiftedOverlapInds = [np.max((shiftedConfRanges[0][0],shiftedConfRanges[1][0]))+3,
-                          np.min((shiftedConfRanges[0][1],shiftedConfRanges[1][1]))-3]
+    shiftedOverlapInds = np.stack(
+        [np.maximum(confRanges[0][0], confRanges[1][0] - lags) + 3,
+         np.minimum(confRanges[0][1], confRanges[1][1] - lags) - 3], axis=1)
     
     # Sample nTimesteps between the shifted Overlap Inds
-    shiftedSampleInds = np.linspace(shiftedOverlapInds[0],shiftedOverlapInds[1],nTimesteps).astype(int)
+    shiftedSampleInds = np.linspace(shiftedOverlapInds[:,0],shiftedOverlapInds[:,1],
+                                    nTimesteps,axis=1).astype(int)
     
     sampleInds = []
     sampleInds.append(shiftedSampleInds) # no shift for first camera
-    sampleInds.append(shiftedSampleInds + lagVal) # unshifts the indices for second camera
+    sampleInds.append(shiftedSampleInds + lags[:,None]) # unshifts the indices for second camera
     
-    # Select keypoints and confidence at appropriate timesteps
+    # Lags with timesteps outside of the trial
+    validLags = np.ones(len(lags), dtype=bool)
+    for iCam, cam in enumerate(cams2UseReproj):
+        validLags &= np.all((sampleInds[iCam] >= 0) & 
+                            (sampleInds[iCam] < keypointList[cam].shape[1]), axis=1)
+    reprojErrorAcrossFrames = np.inf * np.ones(len(lags))
+    reprojSuccess = [True] * len(lags)
+    if not np.any(validLags):
+        return reprojErrorAcrossFrames, reprojSuccess
+    
+    # Select keypoints and confidence at appropriate timesteps of all lags
     keypoints2DSelected = []
-    cameraListSelected = []
     confListSelected = []
     for iCam, cam in enumerate(cams2UseReproj):
-        keypoints2D[cam] = keypoints2D[cam][:,sampleInds[iCam],:]
-        conf[cam] = conf[cam][:,sampleInds[iCam]]
-        keypoints2DSelected.append(keypoints2D[cam])
-        cameraListSelected.append(CamParamListCopy[cam])
-        confListSelected.append(conf[cam])
-        
-    # Triangulate at each of the nTimesteps
-    # We here need to turn the lists back into dicts.
-    CamParamListCopy_dict = {}
-    keypoints2D_dict = {}
-    conf_dict = {}
-    for iCam, cam in enumerate(cameras2Use):
-        CamParamListCopy_dict[cam] = CamParamListCopy[iCam]
-        keypoints2D_dict[cam] = keypoints2D[iCam]
-        conf_dict[cam] = conf[iCam]
-    cameras2UseReproj = [cameras2Use[i] for i in cams2UseReproj]
-    keypoints3D, _ = triangulateMultiviewVideo(
-        CamParamListCopy_dict, keypoints2D_dict, ignoreMissingMarkers=False, 
-        cams2Use=cameras2UseReproj, confidenceDict=conf_dict,trimTrial=False)
-    
-    # Make list of camera objects
-    cameraObjList = []       
-    for camParams in cameraListSelected:
-        c = Camera()
-        c.set_K(camParams['intrinsicMat'])
-        c.set_R(camParams['rotation'])
-        c.set_t(np.reshape(camParams['translation'],(3,1)))
-        cameraObjList.append(c)
-        
-    # Compute confidence-weighted reprojection error for each of nTimesteps
-    reprojErrorVec = []
-    for tStep in range(nTimesteps):
-       
-        # Organize points for reprojectionError function
-        stackedPoints = np.stack([k[:,None,tStep,:] for k in keypoints2DSelected])
-        pointsInput = []
-        for i in range(stackedPoints.shape[1]):
-            pointsInput.append(stackedPoints[:,i,0,:].T)
-        
-        confForWeights = [c[:,None,tStep].T for c in confListSelected] # needs transpose for reprojection error function
-        confForWeights = [np.nan_to_num(c,nan=0) for c in confForWeights] # sometimes confidence has nans, don't want to use as weights in this case
-        
-        # Calculate combined reprojection error
-        key3D = np.squeeze(keypoints3D[:,:,tStep])
-        reprojErrors = calcReprojectionError(cameraObjList,pointsInput,key3D,
-                                             weights=confForWeights,normalizeError=True)
-        
-        # multiply minimum confidence between cameras times marker-wise reproj errors
-        # so we don't include errors for markers that had low confidence in one of the cameras
-        minConfVec = np.min(np.asarray(confForWeights), axis=0)
-        minConfVec[np.where(minConfVec<0.5)] = 0 # Set low conf markers to 0
-        weightedReprojErrors = np.multiply(reprojErrors,minConfVec)
-        if np.any(weightedReprojErrors):
-            reprojErrorVec.append(np.mean(weightedReprojErrors[minConfVec>0]))
-        else:
-            reprojErrorVec.append(1000) # in cases where no position is confident set to large reproj error. typical values are on the order of  0.1
+        inds = sampleInds[iCam][validLags].flatten()
+        keypoints2DSelected.append(keypointList[cam][:,inds,:])
+        confListSelected.append(confidence[cam][:,inds])
+    keypoints2DSelected = np.stack(keypoints2DSelected)
+    confForWeights = np.nan_to_num(np.stack(confListSelected),nan=0) # sometimes confidence has nans, don't want to use as weights in this case
+    
+    # Triangulate at each of the nTimesteps of each lag
+    cameraRigReproj = cameraRig.subset(cams2UseReproj)
+    keypoints3D, _ = triangulateMultiviewBatch(
+        cameraRigReproj, keypoints2DSelected, confidence=np.stack(confListSelected))
         
-    reprojErrorAcrossFrames = np.mean(reprojErrorVec)
-    reprojSuccess = True    
+    # Compute confidence-weighted reprojection error for all nTimesteps at once
+    reprojErrors = calcReprojectionErrorBatch(
+        cameraRigReproj, keypoints2DSelected, keypoints3D, 
+        weights=confForWeights, normalizeError=True)
+    reprojErrors = np.mean(reprojErrors,axis=0) # nMkrs x (nLags*nTimesteps)
+    
+    # multiply minimum confidence between cameras times marker-wise reproj errors
+    # so we don't include errors for markers that had low confidence in one of the cameras
+    minConfVec = np.min(confForWeights, axis=0)
+    minConfVec[np.where(minConfVec<0.5)] = 0 # Set low conf markers to 0
+    weightedReprojErrors = np.multiply(reprojErrors,minConfVec)
+    confidentMkrs = minConfVec>0
+    with np.errstate(invalid='ignore'):
+        reprojErrorVec = (np.sum(np.where(confidentMkrs,weightedReprojErrors,0),axis=0) / 
+                          np.sum(confidentMkrs,axis=0))
+    # in cases where no position is confident set to large reproj error. typical values are on the order of  0.1
+    reprojErrorVec[~np.any(weightedReprojErrors,axis=0)] = 1000
+        
+    reprojErrorAcrossFrames[validLags] = np.mean(
+        np.reshape(reprojErrorVec, (-1, nTimesteps)), axis=1)
     
     return reprojErrorAcrossFrames, reprojSuccess
 
@@ -2890,6 +3760,28 @@ def calcReprojectionError(cameraList,points2D,points3D,weights=None,normalizeErr
     weightedReprojError_u = np.mean(reprojError,axis=1)
     return weightedReprojError_u
 
+# %% Batched version of calcReprojectionError.
+# points2D: nCams x nMkrs x nFrames x 2, points3D: 3 x nMkrs x nFrames,
+# weights: nCams x nMkrs x nFrames (or broadcastable). Returns the
+# reprojection error of each camera, marker and frame: nCams x nMkrs x nFrames.
+# If normalizeError, the errors are normalized by the height of the bounding
+# box of the 2D keypoints of each camera and frame.
+def calcReprojectionErrorBatch(cameraRig,points2D,points3D,weights=None,
+                               normalizeError=False):
+    cameraRig = getCameraRig(cameraRig)
+    points2D = np.asarray(points2D, dtype=float)
+    reproj = cameraRig.project(points3D)
+    reprojError = np.linalg.norm(reproj - points2D, axis=-1)
+    if weights is not None:
+        reprojError *= np.abs(np.asarray(weights, dtype=float))
+    
+    if normalizeError: # Normalize by height of bounding box 
+        yVals = np.where(points2D[...,1]>0, points2D[...,1], np.nan)
+        boxHeight = np.fmax.reduce(yVals,axis=1) - np.fmin.reduce(yVals,axis=1)
+        reprojError /= boxHeight[:,None,:]
+        
+    return reprojError
+
 # %% Write TRC file for use with OpenSim.
 def writeTRCfrom3DKeypoints(keypoints3D, pathOutputFile, keypointNames, 
                             frameRate=60, rotationAngles={}):
@@ -3093,39 +3985,30 @@ def findOverlap(confidenceList, markers4VertVel):
     return overlapInds_clean, minConfLength
 
 #%%
+# imageSize (eg. CameraParams['imageSize']) avoids reading the video for the
+# keypoint-based tracker.
+# If trackAllPeople is True, all people are tracked (see trackPeople2D) and
+# key2D (nTracks x 25 x nFrames x 2) and confidence (nTracks x 25 x nFrames)
+# are returned for all tracks, zeros where a track is not detected.
 def loadPklVideo(pklPath, videoFullPath, imageBasedTracker=False, poseDetector='OpenPose',
-                 confidenceThresholdForBB=0.3, visualizeKeypointAnimation=False):
-    
-    open_file = open(pklPath, "rb")
-    frames = pickle.load(open_file)
-    open_file.close()
-
-    nFrames = len(frames)
-
-    # Read in JSON files.
-    allPeople = []
-    iPerson = 0
-    anotherPerson = True
-    
-    while anotherPerson is True:             
-        anotherPerson = False
-        res = np.zeros((nFrames, 75))
-        res[:] = np.nan
-        
-        for c_frame, frame in enumerate(frames):    
-            # Get this persons keypoints if they exist.
-            if len(frame) > iPerson:
-                person = frame[iPerson]
-                keypoints = person['pose_keypoints_2d']
-                res[c_frame,:] = keypoints
-            
-            # See if there are more people.
-            if len(frame) > iPerson+1:
-                # If there was someone else in any frame, loop again.
-                anotherPerson = True 
-        
-        allPeople.append(res.copy())
-        iPerson +=1     
+                 confidenceThresholdForBB=0.3, visualizeKeypointAnimation=False,
+                 imageSize=None, trackAllPeople=False):
+    
+    # All people in one nFrames x nPeople x 75 array. Use the binary pose
+    # store if it is not older than the pickle.
+    posePath = getPoseArraysPath(pklPath)
+    if os.path.exists(posePath) and (
+            not os.path.exists(pklPath) or 
+            os.path.getmtime(posePath) >= os.path.getmtime(pklPath)):
+        people = poseArraysToPeople(*loadPoseArrays(posePath))
+    else:
+        open_file = open(pklPath, "rb")
+        frames = pickle.load(open_file)
+        open_file.close()
+        people = posePklToArray(frames)
+    nFrames = people.shape[0]
+    nPeople = people.shape[1]
+    allPeople = [people[:,i] for i in range(nPeople)]
         
     # Creates a browser animation of the data in each person detected. This
     # may not be continuous yet. That happens later with person tracking.
@@ -3162,10 +4045,28 @@ def loadPklVideo(pklPath, videoFullPath, imageBasedTracker=False, poseDetector='
             # Show the animation
             fig.show()   
  
+    if trackAllPeople:
+        if imageSize is None:
+            metadata = getVideoMetadata(getDecodedVideoPath(videoFullPath))
+            imageSize = (metadata['height'], metadata['width'])
+        allBoxes = np.reshape(keypointsToBoundingBox(
+            np.reshape(people, (-1, 75)), 
+            confidenceThreshold=confidenceThresholdForBB), (nFrames, nPeople, 4))
+        tracklets = np.reshape(trackPeople2D(people, allBoxes, imageSize), 
+                               (nFrames, -1, 25, 3))
+        tracklets = np.nan_to_num(np.moveaxis(tracklets, 0, 2), nan=0)
+        key2D = np.ascontiguousarray(tracklets[...,0:2])
+        confidence = np.ascontiguousarray(tracklets[...,2])
+        
+        return key2D, confidence
+ 
     # Track People, or if only one person, skip tracking
     if len(allPeople) >1: 
         # Select the largest keypoint-based bounding box as the subject of interest
-        bbFromKeypoints = [keypointsToBoundingBox(data,confidenceThreshold=confidenceThresholdForBB) for data in allPeople]
+        allBoxes = np.reshape(keypointsToBoundingBox(
+            np.reshape(people, (-1, 75)), 
+            confidenceThreshold=confidenceThresholdForBB), (nFrames, nPeople, 4))
+        bbFromKeypoints = [allBoxes[:,i] for i in range(nPeople)]
         maxArea, maxIdx = zip(*[getLargestBoundingBox(data,bbox) for data,bbox in zip(allPeople,bbFromKeypoints)]) # may want to find largest bounding box size in future instead of height
         
         # Check if a person has been detected, ie maxArea >= 0.0. If not, set
@@ -3202,24 +4103,22 @@ def loadPklVideo(pklPath, videoFullPath, imageBasedTracker=False, poseDetector='
             # threshold (currently 20% of average image size). This percentage may need tuning
             
             # track this bounding box backwards until it can't be tracked
-            res = trackKeypointBox(videoFullPath , startBb , allPeople ,
-                                   bbFromKeypoints , res , frameStart = startFrame, 
+            res = trackKeypointBox(videoFullPath , startBb , people ,
+                                   allBoxes , res , frameStart = startFrame, 
                                    frameIncrement = -1 , visualize=False, 
-                                   poseDetector=poseDetector)
+                                   poseDetector=poseDetector, imageSize=imageSize)
             
             # track this bounding box forward until it can't be tracked            
-            res = trackKeypointBox(videoFullPath , startBb , allPeople , 
-                                   bbFromKeypoints , res , frameStart = startFrame, 
+            res = trackKeypointBox(videoFullPath , startBb , people ,
+                                   allBoxes , res , frameStart = startFrame, 
                                    frameIncrement = 1 , visualize=False, 
-                                   poseDetector=poseDetector)
+                                   poseDetector=poseDetector, imageSize=imageSize)
     else:
         res = allPeople[0]
 
-    key2D = np.zeros((25,nFrames,2))
-    confidence = np.zeros((25,nFrames))
-    for i in range(0,25):
-        key2D[i,:,0:2] = res[:,i*3:i*3+2]
-        confidence[i,:] = res[:,i*3+2]
+    res = np.reshape(res, (nFrames, 25, 3))
+    key2D = np.ascontiguousarray(np.moveaxis(res[:,:,0:2], 0, 1))
+    confidence = np.ascontiguousarray(res[:,:,2].T)
         
     # replace confidence nans with 0. 0 isn't used at all, nan is splined and used
     confidence = np.nan_to_num(confidence,nan=0)
@@ -3241,6 +4140,17 @@ def popNeutralPoseImages(cameraDirectories, camerasToUse, tSingleImage,
         videoPath = os.path.join(cameraDirectories_selectedCams[cam], 
                                  'InputMedia', 'neutral', 
                                  '{}_rotated.avi'.format(trial_id))
+        if not os.path.exists(videoPath):
+            # No rotated copy, ffmpeg applies the rotation of the original.
+            pathVideoWithoutExtension = os.path.join(
+                os.path.dirname(videoPath), trial_id)
+            try:
+                extension = getVideoExtension(pathVideoWithoutExtension)
+            except FileNotFoundError:
+                raise FileNotFoundError(
+                    'No neutral video of {} found for {}.'.format(
+                        trial_id, cam))
+            videoPath = pathVideoWithoutExtension + extension
         
         imagePath = video2Images(videoPath, tSingleImage=tSingleImage, 
                      filePrefix=(str(cam)+'_'), 
@@ -6,18 +6,40 @@ import numpy as np
 import json
 import sys
 import time
+import logging
+import queue
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 from decouple import config
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from utils import getOpenPoseMarkerNames, getMMposeMarkerNames, getVideoExtension
-from utilsChecker import getVideoRotation
+from utils import getPoseArraysPath, savePoseArrays
+from utils import loadPoseArrays
+from utilsChecker import getVideoFrameOrientation, getVideoDisplayRotation
+from utilsChecker import getRotatedVideoPath, getVideoMetadata
+from utilsPoseWorker import isPoseWorkerAvailable, submitPoseJob
 
 # %%
+# Cameras are processed concurrently by nWorkers threads, each running the
+# rotation rewrite and the pose detector of one camera. devices are the GPU
+# indices the cameras are distributed over (None: default device), a camera
+# only starts once a device is free. By default, one camera runs per device
+# locally, and all cameras are submitted at once to a pose worker. Detection through the file handshake of
+# the docker containers only supports one video at a time, and runs the
+# cameras sequentially. writeRotatedVideo forces the rotated copy of the
+# videos (see prepareVideoForDetection).
 def runPoseDetector(CameraDirectories, trialRelativePath, pathPoseDetector,
                     trialName,
                     CamParamDict=None, resolutionPoseDetection='default',
                     generateVideo=True, cams2Use=['all'],
-                    poseDetector='OpenPose', bbox_thr=0.8):
+                    poseDetector='OpenPose', bbox_thr=0.8, nWorkers=None,
+                    devices=None, writeRotatedVideo=False):
     
     # Create list of cameras.
     if cams2Use[0] == 'all':
@@ -37,25 +59,92 @@ def runPoseDetector(CameraDirectories, trialRelativePath, pathPoseDetector,
                                              trialRelativePath)
     extension = getVideoExtension(pathVideoWithoutExtension)            
     trialRelativePath += extension
+    
+    # Number of concurrent cameras and their devices.
+    dockerCompose = config("DOCKERCOMPOSE", cast=bool, default=False)
+    poseWorker = dockerCompose and isPoseWorkerAvailable("/data", poseDetector)
+    if nWorkers is None:
+        if poseWorker:
+            # The worker limits the number of jobs it runs at once.
+            nWorkers = os.cpu_count() or 1
+        elif devices:
+            nWorkers = len(devices)
+        else:
+            # Local OpenPose or mmpose instances (detection and pose models)
+            # take most of the GPU memory, one per device.
+            nWorkers = 1
+    if dockerCompose and not poseWorker:
+        nWorkers = 1
+    nWorkers = max(1, min(nWorkers, len(CameraDirectories_selectedCams)))
+    freeDevices = queue.Queue()
+    for i in range(nWorkers):
+        freeDevices.put(devices[i % len(devices)] if devices else None)
         
-    for camName in CameraDirectories_selectedCams:
+    def runCamera(camName):
         cameraDirectory = CameraDirectories_selectedCams[camName]
-        print('Running {} for {}'.format(poseDetector, camName))
-        if poseDetector == 'OpenPose':
-            runOpenPoseVideo(
-                cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
-                resolutionPoseDetection=resolutionPoseDetection,
-                generateVideo=generateVideo)
-        elif poseDetector == 'mmpose':
-            runMMposeVideo(
-                cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
-                generateVideo=generateVideo, bbox_thr=bbox_thr)
+        device = freeDevices.get()
+        try:
+            print('Running {} for {}'.format(poseDetector, camName))
+            start = time.time()
+            if poseDetector == 'OpenPose':
+                runOpenPoseVideo(
+                    cameraDirectory,trialRelativePath,pathPoseDetector, 
+                    trialName, resolutionPoseDetection=resolutionPoseDetection,
+                    generateVideo=generateVideo, gpuIndex=device,
+                    writeRotatedVideo=writeRotatedVideo)
+            elif poseDetector == 'mmpose':
+                runMMposeVideo(
+                    cameraDirectory,trialRelativePath,pathPoseDetector, 
+                    trialName, generateVideo=generateVideo, bbox_thr=bbox_thr,
+                    device='cuda:0' if device is None else 
+                    'cuda:{}'.format(device), 
+                    writeRotatedVideo=writeRotatedVideo)
+            return time.time() - start
+        finally:
+            freeDevices.put(device)
+    
+    with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+        futures = {camName: executor.submit(runCamera, camName) 
+                   for camName in CameraDirectories_selectedCams}
+        # Exceptions are raised in camera order.
+        for camName, future in futures.items():
+            print('{} for {} took {:.1f} s'.format(
+                poseDetector, camName, future.result()))
             
     return extension
             
+# %%
+# The pose detectors used to run on a copy of the video, rewritten (and
+# unrotated) by ffmpeg. The copy is now only written if requested, if the
+# video is rotated and the detector cannot apply the rotation itself, or if
+# it already exists (to match previous pose detections). Returns the path of
+# the video to run the detector on, the same video is decoded downstream
+# (see utilsChecker.openVideo).
+def prepareVideoForDetection(videoFullPath, writeRotatedVideo=False,
+                             detectorRotates=False):
+    
+    pathVideoRot = getRotatedVideoPath(videoFullPath)
+    if not (writeRotatedVideo or os.path.exists(pathVideoRot) or 
+            (not detectorRotates and 
+             getVideoDisplayRotation(videoFullPath) != 0)):
+        return videoFullPath
+    
+    cmd_fr = ' '
+    # frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
+    # if frameRate > 60.0: # previously downsampled for efficiency
+    #     cmd_fr = ' -r 60 '
+    #     frameRate = 60.0  
+    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
+        videoFullPath, cmd_fr, pathVideoRot)
+    if not os.path.exists(pathVideoRot):
+        os.system(CMD)
+        
+    return pathVideoRot
+
 # %%
 def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
-                     resolutionPoseDetection='default', generateVideo=True):
+                     resolutionPoseDetection='default', generateVideo=True,
+                     gpuIndex=None, writeRotatedVideo=False):
     
     trialPrefix, _ = os.path.splitext(os.path.basename(fileName)) 
     videoFullPath = os.path.normpath(os.path.join(cameraDirectory, fileName))
@@ -83,40 +172,23 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
     os.makedirs(pathOutputPkl, exist_ok=True)
     
     # Get number of frames.
-    thisVideo = cv2.VideoCapture(videoFullPath)
-    nFrameIn = int(thisVideo.get(cv2.CAP_PROP_FRAME_COUNT))
-    
-    # The video is rewritten, unrotated, and downsampled. There is no
-    # need to do anything specific for the rotation, just rewriting the video
-    # unrotates it.
-    trialPath, _ = os.path.splitext(fileName)        
-    fileName = trialPath + "_rotated.avi"
-    pathVideoRot = os.path.normpath(os.path.join(cameraDirectory, fileName))
-    cmd_fr = ' '
-    # frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
-    # if frameRate > 60.0: # previously downsampled for efficiency
-    #     cmd_fr = ' -r 60 '
-    #     frameRate = 60.0  
-    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
-        videoFullPath, cmd_fr, pathVideoRot)
-        
-    videoFullPath = pathVideoRot
-    trialPrefix = trialPrefix + "_rotated"
+    nFrameIn = getVideoMetadata(videoFullPath)['frameCount']
     
-    if not os.path.exists(pathVideoRot):
-        os.system(CMD)
+    # OpenPose does not apply the rotation of the video.
+    videoFullPath = prepareVideoForDetection(
+        videoFullPath, writeRotatedVideo, detectorRotates=False)
+    fileName = os.path.join(os.path.dirname(fileName), 
+                            os.path.basename(videoFullPath))
+    trialPrefix = trialPrefix + "_rotated"
 
     # Run OpenPose if this file doesn't exist in outputs
     ppPklPath = os.path.join(pathOutputPkl, trialPrefix + '_pp.pkl')    
     if not os.path.exists(ppPklPath):
-        c_path = os.getcwd()
         command = runOpenPoseCMD(
             pathOpenPose, resolutionPoseDetection, cameraDirectory,
             fileName, openposeJsonDir, pathOutputVideo, trialPrefix,
-            generateVideo, videoFullPath, pathOutputJsons)
+            generateVideo, videoFullPath, pathOutputJsons, gpuIndex=gpuIndex)
         
-        if not pathOpenPose == "docker":
-            os.chdir(c_path)            
         # Get number of frames output video. We count the number of jsons, as
         # videos are not written on server.
         nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
@@ -128,16 +200,13 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
         if not resolutionPoseDetection == 'default' and checknFrames:
             countFrames = 0
             while nFrameIn != nFrameOut:
-                # Need to get command again, as there is os.chdir(pathOpenPose)
-                # in the function.
                 command = runOpenPoseCMD(pathOpenPose, resolutionPoseDetection,
                                          cameraDirectory, fileName, 
                                          openposeJsonDir, pathOutputVideo,
                                          trialPrefix, generateVideo,
-                                         videoFullPath, pathOutputJsons)
+                                         videoFullPath, pathOutputJsons,
+                                         gpuIndex=gpuIndex)
 
-                if not pathOpenPose == "docker":
-                    os.chdir(c_path)
                 nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
                                  if f.endswith('.json')])
                 if countFrames > 4:
@@ -154,18 +223,33 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
         
     return
         
-# %%
+# %
+# Pose detection errors are raised as Exception(message, tag). Exceptions
+# with a message and a tag are raised again as is, any other exception
+# (including OSErrors, whose args are (errno, strerror)) is reported as a
+# generic pose detection failure.
+def raisePoseDetectionError(e):
+    
+    if type(e) is Exception and len(e.args) == 2: # specific exception
+        raise Exception(e.args[0], e.args[1])
+    else: # generic exception
+        exception = "Pose detection failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
+        raise Exception(exception, exception)
+
+# %
 def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
                    fileName, openposeJsonDir, pathOutputVideo, trialPrefix, 
-                   generateVideo, videoFullPath, pathOutputJsons):
+                   generateVideo, videoFullPath, pathOutputJsons, 
+                   gpuIndex=None):
     
-    rotation = getVideoRotation(videoFullPath)
+    rotation = getVideoFrameOrientation(videoFullPath)
     if rotation in [0,180]: 
         horizontal = True
     else:
         horizontal = False
     
     command = None
+    cwd = None
     if resolutionPoseDetection == 'default':
         cmd_hr = ' '
     elif resolutionPoseDetection == '1x1008_4scales':
@@ -184,7 +268,16 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
         else:
             cmd_hr = ' --net_resolution "-1x736" --scale_number 2 --scale_gap 0.75 '
         
-    if config("DOCKERCOMPOSE", cast=bool, default=False):
+    if config("DOCKERCOMPOSE", cast=bool, default=False) and \
+            isPoseWorkerAvailable("/data", "openpose"):
+        try:
+            submitPoseJob("/data", "openpose", 
+                          f"{cameraDirectory}/{fileName}",
+                          os.path.join(cameraDirectory, openposeJsonDir))
+        except Exception as e:
+            raisePoseDetectionError(e)
+            
+    elif config("DOCKERCOMPOSE", cast=bool, default=False):
         vid_path_tmp = "/data/tmp-video.mov"
         vid_path = "/data/video_openpose.mov"
         
@@ -210,23 +303,26 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
             os.system("cp /data/output_openpose/* {cameraDirectory}/{openposeJsonDir}/".format(cameraDirectory=cameraDirectory, openposeJsonDir=openposeJsonDir))
         
         except Exception as e:
-            if len(e.args) == 2: # specific exception
-                raise Exception(e.args[0], e.args[1])
-            elif len(e.args) == 1: # generic exception
-                exception = "Pose detection failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
-                raise Exception(exception, exception)   
+            raisePoseDetectionError(e)
             
     elif pathOpenPose == "docker":
         
-        command = "docker run --gpus=1 -v {}:/openpose/data stanfordnmbl/openpose-gpu\
+        cmd_gpu = "--gpus=1"
+        if gpuIndex is not None:
+            cmd_gpu = "--gpus device={}".format(gpuIndex)
+        command = "docker run {} -v {}:/openpose/data stanfordnmbl/openpose-gpu\
             /openpose/build/examples/openpose/openpose.bin\
             --video /openpose/data/{}\
             --display 0\
             --write_json /openpose/data/{}\
-            --render_pose 0{}".format(cameraDirectory, fileName,
+            --render_pose 0{}".format(cmd_gpu, cameraDirectory, fileName,
                                         openposeJsonDir, cmd_hr)
     else:
-        os.chdir(pathOpenPose)
+        # OpenPose is run from its directory, without changing the working
+        # directory of this process (cameras may run concurrently).
+        cwd = pathOpenPose
+        if gpuIndex is not None:
+            cmd_hr += '--num_gpu 1 --num_gpu_start {} '.format(gpuIndex)
         pathVideoOut = os.path.join(pathOutputVideo,
                                     trialPrefix + 'withKeypoints.avi')
         if not generateVideo:
@@ -239,7 +335,7 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
         print('Running command: {}'.format(command))
 
     if command:
-        os.system(command)
+        subprocess.run(command, shell=True, cwd=cwd)
     
     return
 
@@ -251,7 +347,7 @@ def runMMposeVideo(
         model_ckpt_person='faster_rcnn_r50_fpn_1x_coco_20200130-047c8118.pth',                  
         model_config_pose='hrnet_w48_coco_wholebody_384x288_dark_plus.py',
         model_ckpt_pose='hrnet_w48_coco_wholebody_384x288_dark-f5726563_20200918.pth',
-        ):
+        device='cuda:0', writeRotatedVideo=False):
     
     trialPrefix, _ = os.path.splitext(os.path.basename(fileName))
     videoFullPath = os.path.normpath(os.path.join(cameraDirectory, fileName))    
@@ -259,68 +355,56 @@ def runMMposeVideo(
     pathOutputVideo = os.path.join(cameraDirectory,"OutputMedia_mmpose_" + 
                                    str(bbox_thr), trialName)
     
-    mmposeBoxDir = os.path.join("OutputBox_mmpose", trialName)
-    pathOutputBox = os.path.join(cameraDirectory, mmposeBoxDir)
-    
     mmposePklDir = os.path.join("OutputPkl_mmpose_" + str(bbox_thr), 
                                 trialName)
     pathOutputPkl = os.path.join(cameraDirectory, mmposePklDir)
     
     os.makedirs(pathOutputVideo, exist_ok=True)
-    os.makedirs(pathOutputBox, exist_ok=True)
     os.makedirs(pathOutputPkl, exist_ok=True)
     
-    # Get frame rate.
-    thisVideo = cv2.VideoCapture(videoFullPath)
-    # frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
-    
-    # The video is rewritten, unrotated, and downsampled. There is no
-    # need to do anything specific for the rotation, just rewriting the video
-    # unrotates it. 
-    trialPath, _ = os.path.splitext(fileName)        
-    fileName = trialPath + "_rotated.avi"
-    pathVideoRot = os.path.normpath(os.path.join(cameraDirectory, fileName))  
-    cmd_fr = ' '
-    # if frameRate > 60.0:
-    #     cmd_fr = ' -r 60 '
-    #     frameRate = 60.0  
-    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
-        videoFullPath, cmd_fr, pathVideoRot)
-        
-    videoFullPath = pathVideoRot
+    # The mmpose container may not apply the rotation of the video, this
+    # process does (see mmpose_utils.open_video).
+    detectorRotates = (not config("DOCKERCOMPOSE", cast=bool, default=False) 
+                       and hasattr(cv2, 'CAP_PROP_ORIENTATION_AUTO'))
+    videoFullPath = prepareVideoForDetection(
+        videoFullPath, writeRotatedVideo, detectorRotates=detectorRotates)
+    fileName = os.path.join(os.path.dirname(fileName), 
+                            os.path.basename(videoFullPath))
     trialPrefix = trialPrefix + "_rotated"
-    
-    if not os.path.exists(pathVideoRot):
-        os.system(CMD)
  
     pklPath = os.path.join(pathOutputPkl, trialPrefix + '.pkl')
     ppPklPath = os.path.join(pathOutputPkl, trialPrefix + '_pp.pkl')
     # Run pose detector if this file doesn't exist in outputs
     if not os.path.exists(ppPklPath):
         if config("DOCKERCOMPOSE", cast=bool, default=False):
-            vid_path_tmp = "/data/tmp-video.mov"
-            vid_path = "/data/video_mmpose.mov"
-            
-            # copy the video to vid_path_tmp
-            shutil.copy(f"{cameraDirectory}/{fileName}", vid_path_tmp)
-            
-            # rename the video to vid_path
-            os.rename(vid_path_tmp, vid_path)
-    
             try:
-                # wait until the video is processed (i.e. until the video is removed -- then json should be ready)
-                start = time.time()
-                while True:
-                    if not os.path.isfile(vid_path):
-                        break
+                if isPoseWorkerAvailable("/data", "mmpose"):
+                    submitPoseJob("/data", "mmpose",
+                                  f"{cameraDirectory}/{fileName}",
+                                  pathOutputPkl, timeoutTag='timeout - hrnet')
+                else:
+                    vid_path_tmp = "/data/tmp-video.mov"
+                    vid_path = "/data/video_mmpose.mov"
                     
-                    if start + 60*60 < time.time():
-                        raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - hrnet')
-                
-                    time.sleep(0.1)
-                      
-                # copy /data/output to pathOutputPkl
-                os.system("cp /data/output_mmpose/* {pathOutputPkl}/".format(pathOutputPkl=pathOutputPkl))
+                    # copy the video to vid_path_tmp
+                    shutil.copy(f"{cameraDirectory}/{fileName}", vid_path_tmp)
+                    
+                    # rename the video to vid_path
+                    os.rename(vid_path_tmp, vid_path)
+                    
+                    # wait until the video is processed (i.e. until the video is removed -- then json should be ready)
+                    start = time.time()
+                    while True:
+                        if not os.path.isfile(vid_path):
+                            break
+                        
+                        if start + 60*60 < time.time():
+                            raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - hrnet')
+                    
+                        time.sleep(0.1)
+                          
+                    # copy /data/output to pathOutputPkl
+                    os.system("cp /data/output_mmpose/* {pathOutputPkl}/".format(pathOutputPkl=pathOutputPkl))
                 pkl_path_tmp = os.path.join(pathOutputPkl, 'human.pkl')
                 if os.path.exists(pkl_path_tmp):
                     os.rename(pkl_path_tmp, pklPath)
@@ -329,32 +413,26 @@ def runMMposeVideo(
                         "We could not detect any pose in your video. Please verify that the subject is correctly in front of the camera."
                     )
             except Exception as e:
-                if len(e.args) == 2: # specific exception
-                    raise Exception(e.args[0], e.args[1])
-                elif len(e.args) == 1: # generic exception
-                    exception = "Pose detection failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
-                    raise Exception(exception, exception)            
+                raisePoseDetectionError(e)
         else:           
             c_path = os.path.dirname(os.path.abspath(__file__))
-            sys.path.append(os.path.join(c_path, 'mmpose'))
-            from utilsMMpose import detection_inference, pose_inference
-            # Run human detection.
+            if os.path.join(c_path, 'mmpose') not in sys.path:
+                sys.path.append(os.path.join(c_path, 'mmpose'))
+            from utilsMMpose import detection_pose_inference
+            # Run human detection and pose detection in a single pass.
             pathModelCkptPerson = os.path.join(pathMMpose, model_ckpt_person)
-            bboxPath = os.path.join(pathOutputBox, trialPrefix + '.pkl')
             full_model_config_person = os.path.join(c_path, 'mmpose',
                                                     model_config_person)
-            detection_inference(full_model_config_person, pathModelCkptPerson,
-                                videoFullPath, bboxPath)        
-            
-            # Run pose detection.     
             pathModelCkptPose = os.path.join(pathMMpose, model_ckpt_pose)
             videoOutPath = os.path.join(pathOutputVideo,
                                         trialPrefix + 'withKeypoints.mp4')
             full_model_config_pose = os.path.join(c_path, 'mmpose',
                                                   model_config_pose)
-            pose_inference(full_model_config_pose, pathModelCkptPose, 
-                            videoFullPath, bboxPath, pklPath, videoOutPath, 
-                            bbox_thr=bbox_thr, visualize=generateVideo)
+            detection_pose_inference(
+                full_model_config_person, pathModelCkptPerson,
+                full_model_config_pose, pathModelCkptPose, videoFullPath,
+                pklPath, videoOutPath, device=device, bbox_thr=bbox_thr,
+                visualize=generateVideo)
             
         # Post-process data to have OpenPose-like file structure.        
         arrangeMMposePkl(pklPath, ppPklPath)
@@ -372,6 +450,43 @@ def runMMposeVideo(
             os.rename(ppPklPath, pklPath)
             arrangeMMposePkl(pklPath, ppPklPath)
 
+# %%
+# Indices of the two mmpose keypoints averaged for each OpenPose keypoint.
+# midHip and Neck are the mid points between both hips and both shoulders,
+# all other keypoints are the same mmpose keypoint twice.
+def getMMposeToOpenPoseIndices():
+    
+    markersMMpose = getMMposeMarkerNames()
+    markersOpenPose = getOpenPoseMarkerNames()
+    midPoints = {'midHip': ('LHip', 'RHip'), 
+                 'Neck': ('LShoulder', 'RShoulder')}
+    
+    idxLeft = []
+    idxRight = []
+    for marker in markersOpenPose:
+        left, right = midPoints.get(marker, (marker, marker))
+        idxLeft.append(markersMMpose.index(left))
+        idxRight.append(markersMMpose.index(right))
+        
+    return np.array(idxLeft), np.array(idxRight)
+
+# %%
+# Converts mmpose predictions (..., nMMposeKeypoints, 3) to the OpenPose
+# BODY_25 layout (..., 25, 3). The confidence of midHip and Neck is the lowest
+# of both keypoints.
+def mmposeToOpenPose(predictions):
+    
+    idxLeft, idxRight = getMMposeToOpenPoseIndices()
+    predictions = np.asarray(predictions, dtype=float)
+    left = predictions[...,idxLeft,:]
+    right = predictions[...,idxRight,:]
+    
+    keypoints = np.empty(left.shape)
+    keypoints[...,:2] = (left[...,:2] + right[...,:2]) / 2
+    keypoints[...,2] = np.minimum(left[...,2], right[...,2])
+    
+    return keypoints
+
 # %%
 def arrangeMMposePkl(poseInferencePklPath, outputPklPath):
     
@@ -379,76 +494,82 @@ def arrangeMMposePkl(poseInferencePklPath, outputPklPath):
     frames = pickle.load(open_file)
     open_file.close()
     
-    markersMMpose = getMMposeMarkerNames()
-    markersOpenPose = getOpenPoseMarkerNames()    
+    # Convert the people of all frames at once.
+    counts = [len(frame) for frame in frames]
+    frameOffsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    if frameOffsets[-1] > 0:
+        keypoints = mmposeToOpenPose(np.stack(
+            [person['preds_with_flip'] for frame in frames 
+             for person in frame]))
+    else:
+        keypoints = np.zeros((0, 25, 3))
+    keypointLists = np.reshape(keypoints, (-1, 25*3)).tolist()
     
     data4pkl = []
-    for c_frame, frame in enumerate(frames):
+    for c_frame in range(len(frames)):
         data4people = []
-        for c, person in enumerate(frame):        
-            coordinates = person['preds_with_flip'].tolist()        
-            c_coord_out = np.zeros((25*3,))  
-            for c_m, marker in enumerate(markersOpenPose):            
-                if marker == "midHip":
-                    leftHip = coordinates[markersMMpose.index("LHip")]
-                    rightHip = coordinates[markersMMpose.index("RHip")]
-                    c_coord = []
-                    # Mid point between both hips
-                    c_coord.append((leftHip[0] + rightHip[0]) / 2)
-                    c_coord.append((leftHip[1] + rightHip[1]) / 2)
-                    # Lowest confidence
-                    c_coord.append(np.min([leftHip[2], rightHip[2]]))                
-                elif marker == "Neck":                
-                    leftShoulder = coordinates[
-                        markersMMpose.index("LShoulder")]
-                    rightShoulder = coordinates[
-                        markersMMpose.index("RShoulder")]                
-                    c_coord = []
-                    # Mid point between both shoulders
-                    c_coord.append((leftShoulder[0] + rightShoulder[0]) / 2)
-                    c_coord.append((leftShoulder[1] + rightShoulder[1]) / 2)
-                    # Lowest confidence
-                    c_coord.append(np.min([leftShoulder[2],
-                                           rightShoulder[2]]))                
-                else:
-                    c_coord = coordinates[markersMMpose.index(marker)]            
-                idx_out = np.arange(c_m*3, c_m*3+3)
-                c_coord_out[idx_out,] = c_coord            
+        for c, idx in enumerate(range(frameOffsets[c_frame], 
+                                      frameOffsets[c_frame+1])):
             c_dict = {}
             c_dict['person_id'] = [c]
-            c_dict['pose_keypoints_2d'] = c_coord_out.tolist()
+            c_dict['pose_keypoints_2d'] = keypointLists[idx]
             data4people.append(c_dict)
         data4pkl.append(data4people)
         
     with open(outputPklPath, 'wb') as f:
         pickle.dump(data4pkl, f)
+    savePoseArrays(getPoseArraysPath(outputPklPath), keypoints, frameOffsets)
     
     return
 
 # %%
-def saveJsonsAsPkl(json_directory, outputPklPath, videoName):
+def readPoseJsons(jsonPaths):
+    # Keypoints of the people detected in each OpenPose json.
     
-    nFrames = 0
-    for file in os.listdir(json_directory):
-      if videoName + "_000" in file: # not great
-        nFrames += 1
-                
-    data4pkl = []
-    for frame in sorted(os.listdir(json_directory)):
-        image_json = os.path.join(json_directory,frame)
-        
-        if not os.path.isfile(image_json):
+    keypointsPerFrame = []
+    for jsonPath in jsonPaths:
+        if orjson is not None:
+            with open(jsonPath, 'rb') as data_file:
+                data = orjson.loads(data_file.read())
+        else:
+            with open(jsonPath, encoding='utf-8') as data_file:  
+                data = json.load(data_file)
+        keypointsPerFrame.append(
+            [person['pose_keypoints_2d'] for person in data['people']])
+            
+    return keypointsPerFrame
+
+# %%
+# The per-frame jsons are parsed in blocks of chunkSize files by a pool of
+# nWorkers threads (orjson is used if installed), which mostly hides the file
+# access latency, and written to the pickle and the binary pose store. If
+# deleteJsons is True, json_directory is deleted once both are written with
+# all frames.
+def saveJsonsAsPkl(json_directory, outputPklPath, videoName, nWorkers=None,
+                   chunkSize=256, deleteJsons=False):
+    
+    start = time.time()
+    
+    # Frames are the files of json_directory in sorted order.
+    jsonPaths = []
+    for entry in sorted(os.scandir(json_directory), key=lambda e: e.name):
+        if not entry.is_file():
             break
-        with open(image_json, encoding='utf-8') as data_file:  
-            data = json.load(data_file)
+        jsonPaths.append(entry.path)
         
+    if nWorkers is None:
+        nWorkers = min(32, (os.cpu_count() or 1) + 4)
+    chunks = [jsonPaths[i:i+chunkSize] 
+              for i in range(0, len(jsonPaths), chunkSize)]
+    with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+        keypointsPerFrame = [keypointsFrame for keypointsChunk in 
+                             executor.map(readPoseJsons, chunks) 
+                             for keypointsFrame in keypointsChunk]
+    
+    data4pkl = []
+    for keypointsFrame in keypointsPerFrame:
         data4people = []
-        for person_idx in range(len(data['people'])):
-            
-            person = data['people'][person_idx]
-            keypoints = person['pose_keypoints_2d']
-            
-            
+        for person_idx, keypoints in enumerate(keypointsFrame):
             c_dict = {}
             c_dict['person_id'] = [person_idx]
             c_dict['pose_keypoints_2d'] = keypoints
@@ -457,5 +578,25 @@ def saveJsonsAsPkl(json_directory, outputPklPath, videoName):
         
     with open(outputPklPath, 'wb') as f:
         pickle.dump(data4pkl, f)
+        
+    counts = [len(keypointsFrame) for keypointsFrame in keypointsPerFrame]
+    keypoints = np.reshape(np.array(
+        [k for keypointsFrame in keypointsPerFrame for k in keypointsFrame],
+        dtype=np.float32), (-1, 25, 3))
+    frameOffsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    posePath = savePoseArrays(getPoseArraysPath(outputPklPath), keypoints,
+                              frameOffsets)
+    
+    logging.info('{}: read {} pose jsons in {:.2f} s ({} threads{}).'.format(
+        videoName, len(jsonPaths), time.time() - start, nWorkers,
+        ', orjson' if orjson is not None else ''))
+    
+    if deleteJsons:
+        if (os.path.exists(outputPklPath) and os.path.exists(posePath) and
+                len(loadPoseArrays(posePath)[1]) == len(jsonPaths) + 1):
+            shutil.rmtree(json_directory)
+        else:
+            logging.warning('{}: pose jsons not deleted, {} not complete.'.format(
+                videoName, posePath))
                 
     return
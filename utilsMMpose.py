@@ -1,17 +1,22 @@
 import cv2
+import numpy as np
 import os
 import pickle
+import queue
+import threading
 import torch
 
 # from tqdm import tqdm
 from mmpose_utils import process_mmdet_results, frame_iter, concat, convert_instance_to_frame
+from mmpose_utils import open_video
 try:
     from mmdet.apis import inference_detector, init_detector
     has_mmdet = True
 except (ImportError, ModuleNotFoundError):
     has_mmdet = False
     
-from mmpose_data import CustomVideoDataset
+from mmpose_data import CustomVideoDataset, make_pose_input
+from mmpose_constants import get_flip_pair_dict
 from mmpose_inference import init_pose_model, init_test_pipeline, run_pose_inference, run_pose_tracking
 from mmcv.parallel import collate
 from torch.utils.data import DataLoader
@@ -39,35 +44,40 @@ def get_dataset_info():
 
     return {"TopDownCocoWholeBodyDataset": dataset_info}
 
+# %%
+def get_inference_device(device):
+    """Fall back to the CPU if a CUDA device is requested but not available"""
+    if device.lower().startswith('cuda') and not torch.cuda.is_available():
+        print("CUDA is not available, running inference on the CPU.")
+        return 'cpu'
+    return device
+
 # %%
 def detection_inference(model_config, model_ckpt, video_path, bbox_path,
-                        device='cuda:0', det_cat_id=1):
+                        device='cuda:0', det_cat_id=1, batch_size=8,
+                        frame_stride=1):
     
     """Visualize the demo images.
 
-    Using mmdet to detect the human.
+    Using mmdet to detect the human. Frames are detected in batches of
+    batch_size. With frame_stride > 1, only every frame_stride-th frame is
+    run through the detector and boxes are interpolated in between (see
+    iter_person_detections), which trades accuracy for speed on the CPU.
     """
 
+    device = get_inference_device(device)
+    frame_stride = max(1, int(frame_stride))
     det_model = init_detector(
         model_config, model_ckpt, device=device.lower())
 
-    cap = cv2.VideoCapture(video_path)
-    assert cap.isOpened(), f'Faild to load video file {video_path}'
-
     output = []
-    nFrames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    # for img in tqdm(frame_iter(cap), total=nFrames):
-    for img in frame_iter(cap):
-        # test a single image, the resulting box is (x1, y1, x2, y2)
-        mmdet_results = inference_detector(det_model, img)
-
+    for _, person_results in iter_person_detections(
+            det_model, video_path, det_cat_id, batch_size, frame_stride):
         # keep the person class bounding boxes.
-        person_results = process_mmdet_results(mmdet_results, det_cat_id)
         output.append(person_results)
 
     output_file = bbox_path
     pickle.dump(output, open(str(output_file), 'wb'))
-    cap.release()
     
 # %%
 def pose_inference(model_config, model_ckpt, video_path, bbox_path, pkl_path,
@@ -76,6 +86,7 @@ def pose_inference(model_config, model_ckpt, video_path, bbox_path, pkl_path,
     """Run pose inference on custom video dataset"""
 
     # init model
+    device = get_inference_device(device)
     model = init_pose_model(model_config, model_ckpt, device)
     model_name = os.path.basename(model_config).split(".")[0]
     print("Initializing {} Model".format(model_name))
@@ -121,27 +132,277 @@ def pose_inference(model_config, model_ckpt, video_path, bbox_path, pkl_path,
 
     # visualzize
     if visualize:
-        print("Rendering Visualization...")
-        cap = cv2.VideoCapture(video_path)
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        video_save_file = video_out_path
-        videoWriter = cv2.VideoWriter(str(video_save_file), fourcc, fps, size)
-
-        dataset = model.cfg.data.test.type
-        dataset_info_d = get_dataset_info()
-        dataset_info = DatasetInfo(dataset_info_d[dataset])
-        # for pose_results, img in tqdm(zip(results, frame_iter(cap))):
-        for pose_results, img in zip(results, frame_iter(cap)):        
-            for instance in pose_results:
-                instance['keypoints'] = instance['preds_with_flip']
-            vis_img = vis_pose_tracking_result(model, img, pose_results,
-                                               radius=4, thickness=1,
-                                               dataset=dataset,
-                                               dataset_info=dataset_info,
-                                               kpt_score_thr=0.3,
-                                               show=False)
-            videoWriter.write(vis_img)
-        videoWriter.release()
+        render_pose_video(model, video_path, video_out_path, results)
+
+# %%
+def render_pose_video(model, video_path, video_out_path, results):
+    """Render tracked pose results on top of the video"""
+    print("Rendering Visualization...")
+    cap = open_video(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    video_save_file = video_out_path
+    videoWriter = cv2.VideoWriter(str(video_save_file), fourcc, fps, size)
+
+    dataset = model.cfg.data.test.type
+    dataset_info_d = get_dataset_info()
+    dataset_info = DatasetInfo(dataset_info_d[dataset])
+    # for pose_results, img in tqdm(zip(results, frame_iter(cap))):
+    for pose_results, img in zip(results, frame_iter(cap)):        
+        for instance in pose_results:
+            instance['keypoints'] = instance['preds_with_flip']
+        vis_img = vis_pose_tracking_result(model, img, pose_results,
+                                           radius=4, thickness=1,
+                                           dataset=dataset,
+                                           dataset_info=dataset_info,
+                                           kpt_score_thr=0.3,
+                                           show=False)
+        videoWriter.write(vis_img)
+    videoWriter.release()
+    cap.release()
+
+# %%
+def run_detection(det_model, imgs, det_cat_id=1):
+    """Detect people in a batch of frames
+
+    Returns one list of person bounding boxes (x1, y1, x2, y2, score) per
+    frame.
+    """
+    mmdet_results = inference_detector(det_model, list(imgs))
+    return [process_mmdet_results(result, det_cat_id)
+            for result in mmdet_results]
+
+# %%
+def _put(frame_queue, item, stop_event):
+    # Blocking put that gives up once the consumer stopped.
+    while not stop_event.is_set():
+        try:
+            frame_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _decode_frames(video_path, frame_queue, stop_event):
+    """Producer: decode the video into frame_queue, then put None"""
+    cap = open_video(video_path)
+    try:
+        for img in frame_iter(cap):
+            if not _put(frame_queue, img, stop_event):
+                return
+        _put(frame_queue, None, stop_event)
+    except Exception as e:
+        _put(frame_queue, e, stop_event)
+    finally:
+        cap.release()
+
+
+def iter_frame_batches(video_path, batch_size, queue_size=64):
+    """Decode the video in a background thread and yield lists of up to
+    batch_size consecutive frames"""
+    cap = open_video(video_path)
+    assert cap.isOpened(), f'Faild to load video file {video_path}'
+    cap.release()
+
+    frame_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    decoder = threading.Thread(target=_decode_frames,
+                               args=(video_path, frame_queue, stop_event),
+                               daemon=True)
+    decoder.start()
+    try:
+        imgs = []
+        while True:
+            img = frame_queue.get()
+            if isinstance(img, Exception):
+                raise img
+            if img is None:
+                break
+            imgs.append(img)
+            if len(imgs) == batch_size:
+                yield imgs
+                imgs = []
+        if imgs:
+            yield imgs
+    finally:
+        stop_event.set()
+        decoder.join()
+
+# %%
+def propagate_boxes(boxes_start, boxes_end, n_frames, iou_thr=0.3):
+    """Person bounding boxes of the n_frames frames between two detected
+    frames
+
+    Boxes of both detected frames are matched greedily by intersection over
+    union and linearly interpolated, with the lowest of both scores. Boxes
+    without a match in the end frame are held, boxes that only appear in the
+    end frame start at the end frame.
+    """
+    if n_frames == 0:
+        return []
+    start = np.array([p['bbox'] for p in boxes_start], dtype=np.float32)
+    end = np.array([p['bbox'] for p in boxes_end], dtype=np.float32)
+    matches = -np.ones(len(start), dtype=int)
+    if len(start) and len(end):
+        top_left = np.maximum(start[:,None,:2], end[None,:,:2])
+        bottom_right = np.minimum(start[:,None,2:4], end[None,:,2:4])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None),
+                               axis=2)
+        area_start = np.prod(start[:,2:4] - start[:,:2], axis=1)
+        area_end = np.prod(end[:,2:4] - end[:,:2], axis=1)
+        iou = intersection / np.maximum(
+            area_start[:,None] + area_end[None] - intersection, 1e-6)
+        for i, j in zip(*np.unravel_index(np.argsort(-iou, axis=None),
+                                          iou.shape)):
+            if iou[i, j] < iou_thr:
+                break
+            if matches[i] < 0 and j not in matches:
+                matches[i] = j
+
+    weights = np.arange(1, n_frames + 1, dtype=np.float32) / (n_frames + 1)
+    boxes = [[] for _ in range(n_frames)]
+    for i, j in enumerate(matches):
+        if j < 0:
+            track = np.repeat(start[None,i], n_frames, axis=0)
+        else:
+            track = ((1 - weights[:,None]) * start[None,i] +
+                     weights[:,None] * end[None,j])
+            track[:,4] = min(start[i,4], end[j,4])
+        for c_frame in range(n_frames):
+            boxes[c_frame].append({'bbox': track[c_frame]})
+    return boxes
+
+# %%
+def iter_person_detections(det_model, video_path, det_cat_id=1, batch_size=8,
+                           frame_stride=1):
+    """Yield (frame, person bounding boxes) for each frame of the video
+
+    Every frame_stride-th frame, and the last frame, is run through the
+    detector in batches of batch_size. The boxes of the frames in between are
+    propagated from the two closest detected frames (see propagate_boxes).
+    """
+    def detect(segments, last_boxes):
+        person_results = run_detection(
+            det_model, [key for _, key in segments], det_cat_id)
+        for (between, key), persons in zip(segments, person_results):
+            yield from zip(between, propagate_boxes(
+                last_boxes, persons, len(between)))
+            yield key, persons
+            last_boxes = persons
+
+    # segments are the frames since the previous detected frame and the next
+    # frame to detect.
+    segments = []
+    between = []
+    last_boxes = []
+    c_frame = 0
+    for imgs in iter_frame_batches(video_path, batch_size):
+        for img in imgs:
+            if c_frame % frame_stride == 0:
+                segments.append((between, img))
+                between = []
+                if len(segments) == batch_size:
+                    for img_boxes in detect(segments, last_boxes):
+                        yield img_boxes
+                    last_boxes = img_boxes[1]
+                    segments = []
+            else:
+                between.append(img)
+            c_frame += 1
+    if between:
+        segments.append((between[:-1], between[-1]))
+    if segments:
+        yield from detect(segments, last_boxes)
+
+# %%
+def init_detection_pose_models(det_config, det_ckpt, pose_config, pose_ckpt,
+                               device='cuda:0'):
+    """Initialize the person detector and the pose model, such that they can
+    be reused across videos (see detection_pose_inference)"""
+    device = get_inference_device(device)
+    det_model = init_detector(det_config, det_ckpt, device=device.lower())
+    model = init_pose_model(pose_config, pose_ckpt, device)
+    model_name = os.path.basename(pose_config).split(".")[0]
+    print("Initializing {} Model".format(model_name))
+    return det_model, model
+
+# %%
+def detection_pose_inference(det_config, det_ckpt, pose_config, pose_ckpt,
+                             video_path, pkl_path, video_out_path,
+                             bbox_path=None, device='cuda:0', det_cat_id=1,
+                             det_batch_size=8, frame_stride=1,
+                             batch_size=64, bbox_thr=0.95, visualize=True,
+                             save_results=True, models=None):
+    """Run person detection and pose inference in a single pass
+
+    Frames are decoded once, in a background thread. Each batch of frames goes
+    through the person detector (every frame_stride-th frame, see
+    iter_person_detections), and the person crops above bbox_thr are fed to
+    the pose model in batches of batch_size. The bounding boxes are only saved
+    if bbox_path is given, in the format of detection_inference. models are
+    the (detector, pose model) returned by init_detection_pose_models, they
+    are initialized from the configs if None.
+    """
+
+    # init models
+    device = get_inference_device(device)
+    frame_stride = max(1, int(frame_stride))
+    if models is None:
+        models = init_detection_pose_models(det_config, det_ckpt, pose_config,
+                                            pose_ckpt, device)
+    det_model, model = models
+    test_pipeline = init_test_pipeline(model)
+    flip_pairs = get_flip_pair_dict()[model.cfg.data.test.type]
+
+    def infer(pending):
+        batch = collate(pending)
+        batch['img'] = batch['img'].to(device)
+        batch['img_metas'] = [img_metas[0] for img_metas in batch['img_metas'].data]
+        with torch.no_grad():
+            return run_pose_inference(model, batch)
+
+    print("Running detection and pose inference...")
+    boxes = []
+    frame_to_instance = []
+    instances = []
+    pending = []
+    n_instances = 0
+    for img, persons in iter_person_detections(
+            det_model, video_path, det_cat_id, det_batch_size, frame_stride):
+        boxes.append(persons)
+        frame_to_instance.append([])
+        for person in persons:
+            if person['bbox'][4] < bbox_thr:
+                continue
+            pending.append(test_pipeline(make_pose_input(
+                model.cfg, img, person['bbox'], flip_pairs)))
+            frame_to_instance[-1].append(n_instances)
+            n_instances += 1
+            if len(pending) == batch_size:
+                instances.append(infer(pending))
+                pending = []
+    if pending:
+        instances.append(infer(pending))
+
+    if bbox_path is not None:
+        pickle.dump(boxes, open(str(bbox_path), 'wb'))
+
+    # concat results and transform to per frame format
+    results = concat(instances)
+    results = convert_instance_to_frame(results, frame_to_instance)
+
+    # run pose tracking
+    results = run_pose_tracking(results)
+
+    # save results
+    if save_results:
+        print("Saving Pose Results...")
+        with open(pkl_path, 'wb') as f:
+            pickle.dump(results, f)
+
+    # visualzize
+    if visualize:
+        render_pose_video(model, video_path, video_out_path, results)
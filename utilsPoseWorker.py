@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+# Pose detection workers (mmpose and openpose containers) listen on a unix
+# socket in the data volume shared with the opencap container. Each job is a
+# video copied into its own directory jobs/<jobId> of the volume, the reply is
+# sent on the same connection once the outputs are written, such that several
+# jobs (e.g., cameras) can be in flight and nothing is polled. Paths in
+# messages are relative to the volume, which is mounted at different places
+# in each container. This file must stay compatible with python 3.6 (openpose
+# container).
+
+# %%
+def getPoseWorkerSocketPath(dataDir, poseDetector):
+
+    return os.path.join(dataDir, poseDetector.lower() + '.sock')
+
+# %%
+def sendPoseWorkerMessage(connection, message):
+
+    connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+# %%
+def receivePoseWorkerMessage(connection):
+
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(4096)
+        if not chunk:
+            raise ConnectionError('Pose worker closed the connection.')
+        data += chunk
+
+    return json.loads(data.decode('utf-8'))
+
+# %% Worker side.
+class PoseJobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+
+        line = self.rfile.readline()
+        if not line:
+            # Availability check from isPoseWorkerAvailable.
+            return
+        request = json.loads(line.decode('utf-8'))
+        jobId = request['jobId']
+        videoPath = os.path.join(self.server.dataDir, request['video'])
+        outputDir = os.path.join(self.server.dataDir, request['outputDir'])
+
+        logging.info("Job {} queued.".format(jobId))
+        start = time.time()
+        try:
+            with self.server.jobSlots:
+                logging.info("Processing job {}...".format(jobId))
+                os.makedirs(outputDir, exist_ok=True)
+                self.server.processJob(videoPath, outputDir)
+            reply = {'jobId': jobId, 'status': 'done',
+                     'duration': time.time() - start}
+            logging.info("Job {} done in {:.1f} s.".format(
+                jobId, reply['duration']))
+        except Exception as e:
+            logging.exception("Job {} failed.".format(jobId))
+            reply = {'jobId': jobId, 'status': 'failed', 'error': str(e)}
+        sendPoseWorkerMessage(self.connection, reply)
+
+# %%
+# Starts listening for jobs in a background thread. processJob(videoPath,
+# outputDir) runs the pose detector, at most nJobs at a time. Callers
+# processing videos outside of the socket (file handshake) should hold
+# server.jobSlots as well.
+def startPoseWorker(dataDir, poseDetector, processJob, nJobs=1):
+
+    socketPath = getPoseWorkerSocketPath(dataDir, poseDetector)
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socketserver.ThreadingUnixStreamServer(socketPath,
+                                                    PoseJobHandler)
+    server.daemon_threads = True
+    server.dataDir = dataDir
+    server.processJob = processJob
+    server.jobSlots = threading.BoundedSemaphore(nJobs)
+    os.chmod(socketPath, 0o777)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info("Listening for {} jobs on {}.".format(poseDetector,
+                                                       socketPath))
+
+    return server
+
+# %% Client side.
+def isPoseWorkerAvailable(dataDir, poseDetector):
+
+    socketPath = getPoseWorkerSocketPath(dataDir, poseDetector)
+    if not os.path.exists(socketPath):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(1)
+            connection.connect(socketPath)
+    except OSError:
+        return False
+
+    return True
+
+# %%
+# Runs the pose detector of the worker on videoPath and moves its outputs to
+# outputDir. Blocks until the worker replies. Raises the same exceptions as
+# the file handshake in utilsDetector.
+def submitPoseJob(dataDir, poseDetector, videoPath, outputDir,
+                  timeout=60*60, timeoutTag=None):
+
+    if timeoutTag is None:
+        timeoutTag = 'timeout - ' + poseDetector.lower()
+
+    jobId = uuid.uuid4().hex
+    jobRelativeDir = 'jobs/' + jobId
+    jobDir = os.path.join(dataDir, jobRelativeDir)
+    os.makedirs(jobDir)
+    _, extension = os.path.splitext(videoPath)
+    shutil.copy(videoPath, os.path.join(jobDir, 'video' + extension))
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(getPoseWorkerSocketPath(dataDir, poseDetector))
+            sendPoseWorkerMessage(connection, {
+                'jobId': jobId,
+                'video': jobRelativeDir + '/video' + extension,
+                'outputDir': jobRelativeDir + '/output'})
+            try:
+                reply = receivePoseWorkerMessage(connection)
+            except socket.timeout:
+                raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", timeoutTag)
+        if reply['status'] != 'done':
+            raise Exception(reply.get('error', 'Pose detection failed.'))
+
+        os.makedirs(outputDir, exist_ok=True)
+        jobOutputDir = os.path.join(jobDir, 'output')
+        for fileName in os.listdir(jobOutputDir):
+            shutil.move(os.path.join(jobOutputDir, fileName),
+                        os.path.join(outputDir, fileName))
+    finally:
+        shutil.rmtree(jobDir, ignore_errors=True)
+
+    return reply